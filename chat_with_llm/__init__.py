@@ -1,10 +1,28 @@
-from importlib.metadata import PackageNotFoundError, version
+import importlib
 
-try:
-    __version__ = version("chat_with_llm")
-except PackageNotFoundError:
-    # package is not installed
-    __version__ = "unknown"
+# 子模块在第一次访问时才导入 (PEP 562), `import chat_with_llm` 不会加载llm, langfuse等耗时的依赖
+_SUBMODULES = ['accounting', 'config', 'hedging', 'llm', 'logutils', 'mapreduce', 'openai_stub', 'ratelimit', 'registry',
+               'resilience', 'singleflight', 'storage', 'tokens', 'tracing', 'web']
 
-# 导出logutils模块
-from chat_with_llm import logutils
\ No newline at end of file
+def _get_version():
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        return version("chat_with_llm")
+    except PackageNotFoundError:
+        # package is not installed
+        return "unknown"
+
+def __getattr__(name):
+    if name == '__version__':
+        value = _get_version()
+    elif name in _SUBMODULES:
+        value = importlib.import_module(f'{__name__}.{name}')
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES) | {'__version__'})
@@ -0,0 +1,181 @@
+"""
+LLM调用的token用量和费用统计.
+
+每次调用(包括map-reduce的中间步骤和中断的流式调用)在 {STORAGE_BASE_DIR}/llm_state/usage.db 的usage表中记录一行:
+时间, use_case, 模型, 输入/输出/reasoning/缓存token数和耗时.
+共享了相同请求结果的调用 (见singleflight模块) 记为cache_hit, token数为0. 费用在统计时按models.yaml中的price计算,
+价格调整后历史数据也按新价格计算.
+
+    accounting.get_usage_log().summarize(group_by=['use_case', 'model'], since='20250601')
+"""
+
+import os.path
+import sqlite3
+import threading
+import time
+
+from chat_with_llm import config
+
+__all__ = ['UsageLog', 'get_usage_log', 'record_usage', 'estimate_cost', 'GROUP_BY_FIELDS']
+
+GROUP_BY_FIELDS = ['day', 'use_case', 'model']
+
+def estimate_cost(price, prompt_tokens, completion_tokens, cached_tokens=0):
+    """
+    按价格表计算费用. price为models.yaml中模型的price, 单位为每百万token:
+        input: 输入价格
+        output: 输出价格 (reasoning token按输出计费, 已包含在completion_tokens中)
+        cached_input: 命中缓存的输入价格, 未配置时按input计算
+    price为空时返回None
+    """
+    if not price:
+        return None
+
+    input_price = float(price.get('input', 0))
+    cached_price = float(price.get('cached_input', input_price))
+    output_price = float(price.get('output', 0))
+
+    cached_tokens = cached_tokens or 0
+    cost = ((prompt_tokens - cached_tokens) * input_price
+            + cached_tokens * cached_price
+            + completion_tokens * output_price)
+    return cost / 1e6
+
+class UsageLog:
+    """
+    params:
+        db_path: sqlite数据库路径. 多个进程可以同时写入同一个数据库
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS usage '
+                '(ts REAL, day TEXT, use_case TEXT, model TEXT, '
+                'prompt_tokens INTEGER, completion_tokens INTEGER, reasoning_tokens INTEGER, cached_tokens INTEGER, '
+                'latency REAL, complete INTEGER, cache_hit INTEGER DEFAULT 0)'
+            )
+            # 旧版本创建的数据库没有cache_hit列
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(usage)')]
+            if 'cache_hit' not in columns:
+                conn.execute('ALTER TABLE usage ADD COLUMN cache_hit INTEGER DEFAULT 0')
+            conn.execute('CREATE INDEX IF NOT EXISTS usage_day ON usage (day)')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # sqlite连接不能跨线程共享, 每次调用单独建立连接
+        return sqlite3.connect(self.db_path, timeout=60)
+
+    def record(self, use_case, model_id, stats, ts=None):
+        """记录一次调用. stats为chat_impl或ChatStream的统计"""
+        ts = ts or time.time()
+        row = (
+            ts,
+            time.strftime('%Y%m%d', time.localtime(ts)),
+            use_case,
+            model_id,
+            stats.get('prompt_tokens', stats.get('prompt_tokens_estimated', 0)),
+            stats.get('completion_tokens', 0),
+            stats.get('reasoning_tokens', 0),
+            stats.get('cached_tokens', 0),
+            stats.get('duration'),
+            int(stats.get('complete', True)),
+            int(stats.get('cache_hit', False)),
+        )
+
+        conn = self._connect()
+        try:
+            conn.execute(
+                'INSERT INTO usage (ts, day, use_case, model, prompt_tokens, completion_tokens, reasoning_tokens, '
+                'cached_tokens, latency, complete, cache_hit) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def summarize(self, group_by=('use_case', 'model'), since=None, until=None, use_case=None, model=None,
+                  get_price=None):
+        """
+        按group_by中的字段汇总. since/until为'YYYYMMDD'格式的日期(含).
+        get_price: 可选的函数(model_id) -> price, 提供时结果中包含cost. 按model分组以外的汇总会先按模型计算费用再相加
+        returns: [dict], 按group_by字段排序
+        """
+        for field in group_by:
+            if field not in GROUP_BY_FIELDS:
+                raise ValueError(f'Unknown group_by field {field}, expecting one of {GROUP_BY_FIELDS}')
+
+        where = []
+        params = []
+        for sql, value in (('day >= ?', since), ('day <= ?', until), ('use_case = ?', use_case), ('model = ?', model)):
+            if value is not None:
+                where.append(sql)
+                params.append(value)
+
+        # 总是按model分组, 以便按模型计算费用
+        keys = list(group_by) + (['model'] if 'model' not in group_by else [])
+        sql = (f'SELECT {", ".join(keys)}, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), '
+               f'SUM(reasoning_tokens), SUM(cached_tokens), SUM(latency), SUM(1 - complete), SUM(cache_hit) FROM usage')
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += f' GROUP BY {", ".join(keys)}'
+
+        conn = self._connect()
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+        fields = ['calls', 'prompt_tokens', 'completion_tokens', 'reasoning_tokens', 'cached_tokens', 'latency',
+                  'incomplete', 'cache_hits']
+        results = {}
+        for row in rows:
+            group = dict(zip(keys, row[:len(keys)]))
+            values = dict(zip(fields, row[len(keys):]))
+
+            cost = None
+            if get_price is not None:
+                cost = estimate_cost(get_price(group['model']), values['prompt_tokens'], values['completion_tokens'],
+                                     values['cached_tokens'])
+
+            key = tuple(group[k] for k in group_by)
+            if key not in results:
+                results[key] = dict(zip(group_by, key), **{f: 0 for f in fields})
+                if get_price is not None:
+                    results[key]['cost'] = None
+
+            result = results[key]
+            for f in fields:
+                result[f] += values[f] or 0
+            if cost is not None:
+                result['cost'] = (result['cost'] or 0) + cost
+
+        for result in results.values():
+            result['avg_latency'] = result.pop('latency') / result['calls'] if result['calls'] else None
+
+        return [results[k] for k in sorted(results, key=lambda k: tuple(str(v) for v in k))]
+
+_usage_logs = {}
+_usage_logs_lock = threading.Lock()
+def get_usage_log():
+    # 按数据库路径缓存, STORAGE_BASE_DIR改变 (config.reload) 后读写新的数据库
+    db_path = os.path.join(config.get('STORAGE_BASE_DIR'), 'llm_state', 'usage.db')
+    with _usage_logs_lock:
+        if db_path not in _usage_logs:
+            _usage_logs[db_path] = UsageLog(db_path)
+
+        return _usage_logs[db_path]
+
+def record_usage(use_case, model_id, stats):
+    """记录一次调用的用量. 记录失败只打印警告, 不影响调用结果"""
+    try:
+        get_usage_log().record(use_case, model_id, stats)
+    except sqlite3.Error as ex:
+        print(f'Warning: failed to record usage: {ex}')
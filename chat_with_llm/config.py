@@ -1,18 +1,24 @@
 import copy
+import dataclasses
 import os
-import yaml
+import threading
 
 class ConfigNotFoundError(Exception):
     pass
 
 class Config():
     def __init__(self, config_name):
-        # load config from config.yaml
+        # load config from config.yaml. 环境变量CHAT_WITH_LLM_CONFIG_DIR指定的目录优先 (例如测试使用临时的models.yaml)
         config_candidates = [os.path.expanduser(f'~/.chat_with_llm/{config_name}'),
                              os.path.join(os.path.dirname(__file__), '..', config_name),]
+        if os.environ.get('CHAT_WITH_LLM_CONFIG_DIR'):
+            config_candidates.insert(0, os.path.join(os.environ['CHAT_WITH_LLM_CONFIG_DIR'], config_name))
         for config_file in config_candidates:
             if os.path.exists(config_file):
+                # 只在需要读取配置时才导入yaml
+                import yaml
                 self.cfg = yaml.load(open(config_file), yaml.FullLoader)
+                self.path = config_file
                 break
         else:
             raise Exception('No config file found in %s' % config_candidates)
@@ -23,27 +29,121 @@ class Config():
         else:
             raise ConfigNotFoundError(f'Config key {key} not found in config.yaml')
 
+@dataclasses.dataclass(frozen=True)
+class Settings:
+    """常用配置项的类型化快照. 未配置的项为默认值"""
+    openai_api_key: str = None
+    openai_api_base: str = None
+    storage_base_dir: str = None
+    online_content_workers: int = 2
+    linkseek_base_url: str = 'http://localhost:8000'
+    linkseek_proxy: str = None
+    linkseek_retries: int = 2
+    linkseek_backoff: float = 0.5
+    url_strip_params: str = None
+    public_suffix_list: str = None
+    langfuse_public_key: str = None
+    tracing_sample_rate: float = 1.0
+    tracing_use_cases: str = None
+    tracing_queue_size: int = 1000
+    tracing_batch_size: int = 64
+    tracing_flush_interval: float = 5.0
+
+# 配置文件在第一次使用时才加载, 只用到storage等模块的脚本不需要解析models.yaml
+_the_config = None
+_the_models_config = None
+# reload_models()/reload()时加1, registry据此立即重新加载
+_models_version = 0
+_the_settings = None
+_environ_set = False
+_lock = threading.RLock()
+
+def _get_config():
+    global _the_config
+    with _lock:
+        if _the_config is None:
+            _the_config = Config('config.yaml')
+
+    return _the_config
+
+def _get_models_config():
+    global _the_models_config
+    with _lock:
+        if _the_models_config is None:
+            _the_models_config = Config('models.yaml')
+
+    return _the_models_config
+
 def get(name, default=None):
     try:
-        value = os.environ.get(name) or _the_config[name]
+        value = os.environ.get(name) or _get_config()[name]
     except ConfigNotFoundError:
         if default is None:
             raise
         value = default
-    
+
     if name.endswith('_DIR') and isinstance(value, str) and value.startswith('~'):
         value = os.path.expanduser(value)
 
     return value
 
 def get_model_configs():
-    return copy.deepcopy(_the_models_config.cfg)
+    return copy.deepcopy(_get_models_config().cfg)
 
-def set_environ():
-    for key, value in _the_config.cfg.items():
-        os.environ[key] = str(value)
+def get_models_config_path():
+    return _get_models_config().path
 
-_the_config = Config('config.yaml')
-_the_models_config = Config('models.yaml')
-set_environ()
+def get_models_version():
+    return _models_version
+
+def reload_models():
+    """清空缓存的models.yaml, 下次使用时重新读取"""
+    global _the_models_config, _models_version
+    with _lock:
+        _the_models_config = None
+        _models_version += 1
+
+def snapshot():
+    """
+    返回Settings快照. 第一次调用时读取 (环境变量优先), 之后直接返回缓存.
+    修改环境变量或配置文件后需要调用reload()
+    """
+    global _the_settings
+    with _lock:
+        if _the_settings is None:
+            values = {}
+            for field in dataclasses.fields(Settings):
+                try:
+                    value = get(field.name.upper())
+                except ConfigNotFoundError:
+                    continue
+
+                values[field.name] = field.type(value) if field.type in (int, float) else value
+
+            _the_settings = Settings(**values)
+
+    return _the_settings
+
+def reload():
+    """清空缓存的配置, 下次使用时重新读取配置文件和环境变量"""
+    global _the_config, _the_models_config, _models_version, _the_settings, _environ_set
+    with _lock:
+        _the_config = None
+        _the_models_config = None
+        _models_version += 1
+        _the_settings = None
+        _environ_set = False
+
+def set_environ():
+    """
+    将config.yaml中的配置项写入环境变量, 供langfuse等直接读取环境变量的库使用. 只执行一次.
+    已经存在的环境变量不会被覆盖 (与get()中环境变量优先的规则一致)
+    """
+    global _environ_set
+    with _lock:
+        if _environ_set:
+            return
 
+        for key, value in _get_config().cfg.items():
+            os.environ.setdefault(key, str(value))
+        _environ_set = True
@@ -0,0 +1,228 @@
+"""
+对冲请求 (hedged requests), 降低长尾延迟.
+
+主模型在阈值时间内没有返回第一个token时, 向备用模型发送同样的请求, 使用先完成的结果, 并关闭另一个请求的连接.
+阈值按模型计算: 该模型最近的首token延迟的percentile分位数. 样本少于min_samples时使用after秒, 未配置after时不对冲
+(只记录延迟).
+
+models.yaml中的配置:
+
+    - name: deepseek-v4-pro
+      hedge:
+        backup: gpt4.1        # 备用模型的id或alias
+        percentile: 95        # 默认95
+        after: 30             # 样本不足时的阈值(秒), 可选
+        min_samples: 20       # 默认20
+
+请求以流式发出, 才能知道首token时间, 也才能在中途取消.
+"""
+
+import collections
+import math
+import threading
+import time
+
+__all__ = ['HedgePolicy', 'LatencyTracker', 'get_latency_tracker', 'race']
+
+class HedgePolicy:
+    """
+    params:
+        backup: 备用模型的id或alias
+        percentile: 阈值使用的首token延迟分位数
+        after: 样本不足时使用的阈值(秒), None表示样本不足时不对冲
+        min_samples: 使用分位数需要的最少样本数
+    """
+    def __init__(self, backup, percentile=95, after=None, min_samples=20):
+        self.backup = backup
+        self.percentile = float(percentile)
+        self.after = float(after) if after is not None else None
+        self.min_samples = int(min_samples)
+
+    @classmethod
+    def parse(cls, value):
+        """models.yaml或chat()的hedge参数: 备用模型名, 或包含backup等字段的dict. 空值返回None"""
+        if not value:
+            return None
+        if isinstance(value, HedgePolicy):
+            return value
+        if isinstance(value, str):
+            return cls(value)
+        if isinstance(value, dict):
+            if 'backup' not in value:
+                raise ValueError(f'hedge config needs a backup model: {value}')
+            return cls(**value)
+
+        raise ValueError(f'Invalid hedge config: {value}')
+
+    def threshold(self, model_id):
+        """主模型model_id的对冲阈值(秒). None表示不对冲"""
+        value = get_latency_tracker(model_id).percentile(self.percentile, self.min_samples)
+        return value if value is not None else self.after
+
+class LatencyTracker:
+    """记录一个模型最近window次请求的首token延迟"""
+    def __init__(self, window=200):
+        self.samples = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+
+    def percentile(self, p, min_samples=1):
+        """nearest-rank百分位数. 样本少于min_samples时返回None"""
+        with self.lock:
+            if len(self.samples) < max(1, min_samples):
+                return None
+            values = sorted(self.samples)
+
+        ind = max(0, math.ceil(p / 100 * len(values)) - 1)
+        return values[ind]
+
+_latency_trackers = {}
+_latency_trackers_lock = threading.Lock()
+def get_latency_tracker(model_id):
+    with _latency_trackers_lock:
+        if model_id not in _latency_trackers:
+            _latency_trackers[model_id] = LatencyTracker()
+
+        return _latency_trackers[model_id]
+
+class Attempt:
+    """
+    在后台线程中发出一个流式请求并读取全部内容.
+    params:
+        model_id: 模型
+        create: 发出请求的函数, 返回openai的Stream
+        cond: 收到第一个token或结束时通知的Condition
+    """
+    def __init__(self, model_id, create, cond):
+        self.model_id = model_id
+        self.response = None
+        self.reasoning = None
+        self.usage = None
+        self.ttft = None
+        self.duration = None
+        self.error = None
+        self.done = False
+        self.cancelled = False
+        # 请求已经发出 (被取消前可能已经产生了费用)
+        self.sent = False
+
+        self._create = create
+        self._callbacks = []
+        self._cond = cond
+        self._stream = None
+        self._t0 = time.time()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        response_parts = []
+        reasoning_parts = []
+        try:
+            self._stream = self._create()
+            self.sent = True
+            if self.cancelled:
+                self._stream.close()
+                return
+
+            for chunk in self._stream:
+                if getattr(chunk, 'usage', None) is not None:
+                    self.usage = chunk.usage
+                if not chunk.choices:
+                    continue
+
+                delta = chunk.choices[0].delta
+                reasoning = getattr(delta, 'reasoning_content', None)
+                if reasoning:
+                    reasoning_parts.append(reasoning)
+                if delta.content:
+                    response_parts.append(delta.content)
+
+                if (reasoning or delta.content) and self.ttft is None:
+                    self.ttft = time.time() - self._t0
+                    with self._cond:
+                        self._cond.notify_all()
+        except Exception as ex:
+            # 被取消时关闭连接导致的异常不是错误
+            if not self.cancelled:
+                self.error = ex
+        finally:
+            self.response = ''.join(response_parts)
+            self.reasoning = ''.join(reasoning_parts) or None
+            self.duration = time.time() - self._t0
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+                callbacks, self._callbacks = self._callbacks, []
+
+            for fn in callbacks:
+                fn(self)
+
+    def add_done_callback(self, fn):
+        """结束 (包括被取消) 后在后台线程中调用fn(attempt). 已经结束时立即调用"""
+        with self._cond:
+            if not self.done:
+                self._callbacks.append(fn)
+                return
+
+        fn(self)
+
+    def succeeded(self):
+        return self.done and self.error is None and not self.cancelled
+
+    def elapsed(self):
+        return time.time() - self._t0
+
+    def cancel(self):
+        self.cancelled = True
+        stream = self._stream
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+def race(model_id, create, backup, create_backup, threshold):
+    """
+    发出主模型的请求, threshold秒内没有收到第一个token时发出备用模型的请求, 返回先完成的请求.
+    params:
+        create/create_backup: 在后台线程中调用, 发出流式请求. create_backup只在触发对冲时调用
+        threshold: 对冲阈值(秒), None表示不对冲
+    returns: (winner, losers, stats). winner为Attempt, losers为没有胜出的Attempt (已取消或失败),
+        stats记录是否触发对冲以及胜出的模型
+    raises: 所有请求都失败时抛出主模型的异常
+    """
+    cond = threading.Condition()
+    primary = Attempt(model_id, create, cond)
+    attempts = [primary]
+    stats = {'backup': backup, 'threshold': threshold, 'fired': False}
+
+    if threshold is not None and backup and backup != model_id:
+        with cond:
+            cond.wait_for(lambda: primary.ttft is not None or primary.done, timeout=threshold)
+
+        # 主模型失败时不对冲, 由调用方按重试和备用模型的规则处理
+        if primary.ttft is None and not primary.done:
+            print(f'{model_id} has not responded in {threshold:.1f}s, hedging with {backup}')
+            stats['fired'] = True
+            attempts.append(Attempt(backup, create_backup, cond))
+
+    with cond:
+        cond.wait_for(lambda: any(a.succeeded() for a in attempts) or all(a.done for a in attempts))
+
+    winner = next((a for a in attempts if a.succeeded()), None)
+    for a in attempts:
+        if a is not winner and not a.done:
+            a.cancel()
+
+        # 被取消时还没有首token, 用已等待的时间作为下限, 避免分位数只统计快的请求
+        latency = a.ttft if a.ttft is not None else (a.elapsed() if a.cancelled else None)
+        if latency is not None:
+            get_latency_tracker(a.model_id).record(latency)
+
+    if winner is None:
+        raise primary.error
+
+    stats['winner'] = winner.model_id
+    return winner, [a for a in attempts if a is not winner], stats
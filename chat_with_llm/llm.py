@@ -1,104 +1,58 @@
-import fnmatch
+import hashlib
+import json
 import os.path
-import random
+import threading
 import time
 
-import langfuse
-from langfuse.openai import openai
-
-#from openai import OpenAI, OpenAIError
+import openai
 
+from chat_with_llm import accounting
 from chat_with_llm import config
+from chat_with_llm import hedging
+from chat_with_llm import ratelimit
+from chat_with_llm import registry
+from chat_with_llm import resilience
+from chat_with_llm import singleflight
 from chat_with_llm import storage
+from chat_with_llm import tokens
+from chat_with_llm import tracing
 
 CUR_DIR = os.path.dirname(os.path.abspath(__file__))
 
-__all__ = ['list_models', 'get_model', 'get_storage', 'get_model_query_delay', 'chat', 'reason']
-
-# 所有enabled模型都出现在g_model_delays中
-# 所有模型(即使disabled的模型)都出现在g_model_to_display_name中
-# 只有具有alias的模型才出现在g_alias_to_model中
-def _load_model_from_config():
-    models = config.get_model_configs()
-
-    model_to_display_name = {}
-    alias_to_model = {}
-    model_delays = {}
-
-    for data in models:
-        model_id = data.get('name')
-        alias = data.get('alias')
-        display = data.get('display')
-        delay = float(data.get('delay', 0))
-        disabled = data.get('disabled', False)
-
-        # 显示名的最低优先级
-        model_to_display_name[model_id] = model_id
-
-        if isinstance(alias, str):
-            alias = [alias]
-
-        if alias:
-            model_to_display_name[model_id] = alias[0] if len(alias) > 0 else model_id
-            
-            if not disabled:
-                for a in alias:
-                    if a in alias_to_model:
-                        print(f'Warning: alias {a} already exists, overwriting with {model_id}')
-
-                    alias_to_model[a] = model_id
-
-        if display:
-            model_to_display_name[model_id] = display
-
-        # 用delay=-1标识被禁用的模型
-        if disabled:
-            model_delays[model_id] = -1
-        else:
-            model_delays[model_id] = delay
-
-    return model_to_display_name, alias_to_model, model_delays
-
-g_model_to_display_name, g_alias_to_model, g_model_delays = _load_model_from_config()
+__all__ = ['list_models', 'get_model', 'get_storage', 'get_model_query_delay', 'chat', 'chat_stream', 'ChatStream', 'reason',
+           'submit_batch', 'wait_batch', 'chat_batch']
+
+# 模型表由registry模块管理, models.yaml修改后自动重新加载. 以下属性保持兼容 (PEP 562):
+#   g_model_to_display_name: 所有模型(即使disabled的模型)的显示名
+#   g_alias_to_model: 只有enabled模型的alias
+#   g_model_delays: 所有模型的delay, -1表示disabled
+#   g_model_configs: models.yaml中每个模型的原始配置
+_REGISTRY_ATTRS = {
+    'g_model_to_display_name': 'display_names',
+    'g_alias_to_model': 'aliases',
+    'g_model_delays': 'delays',
+    'g_model_configs': 'configs',
+}
+def __getattr__(name):
+    if name in _REGISTRY_ATTRS:
+        return getattr(registry.get_registry(), _REGISTRY_ATTRS[name])
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 def list_models():
-    models = [m for m, delay in g_model_delays.items() if delay != -1]
-    return models
+    return list(registry.get_registry().enabled)
 
 def get_model(model_id_or_alias, fail_on_unknown=True):
-    if model_id_or_alias == 'random':
-        models = list_models()
-        model = random.choice(models)
-    elif '*' in model_id_or_alias:
-        models = list_models()
-        models = fnmatch.filter(models, model_id_or_alias)
-        if len(model) == 0:
-            raise ValueError(f'No model found for {model_id_or_alias}')
-        
-        model = random.choice(models)
-    else:
-        model = g_alias_to_model.get(model_id_or_alias, model_id_or_alias)
-        
-    delay = g_model_delays.get(model)
-    if delay is None and fail_on_unknown:
-        raise ValueError(f'Unknown model name {model_id_or_alias}')
-    if delay == -1:
-        raise ValueError(f'Model {model} is disabled')
-    
-    return model
+    return registry.get_registry().resolve(model_id_or_alias, fail_on_unknown)
 
 def get_model_short_name(model_id):
-    return g_model_to_display_name.get(model_id, model_id)
+    return registry.get_registry().display_names.get(model_id, model_id)
 
 def get_model_from_save_name(save_name):
-    for model_id in g_model_to_display_name.keys():
-        if get_model_save_name(model_id) == save_name:
-            return model_id
-        
-    return None
+    return registry.get_registry().save_names.get(save_name)
 
 def get_model_save_name(model_id):
-    return model_id.replace("/", "_").replace(":", "_")
+    return registry.save_name(model_id)
 
 llm_storages = {}
 def get_storage(use_case):
@@ -110,13 +64,227 @@ def get_storage(use_case):
 def get_model_query_delay(model_id_or_alias):
     model = get_model(model_id_or_alias, fail_on_unknown=False)
 
-    return g_model_delays.get(model_id_or_alias, 0)
+    return registry.get_registry().delays.get(model, 0)
+
+def get_model_config(model_id):
+    return registry.get_registry().configs.get(model_id, {})
+
+def get_model_price(model_id):
+    """models.yaml中的price (每百万token的价格: input, output, cached_input). 未配置时返回None"""
+    return get_model_config(model_id).get('price')
+
+def get_model_chain(model_id, fallback=None):
+    """
+    返回依次尝试的模型列表.
+    fallback: None时使用models.yaml中该模型的fallback配置; False表示不使用备用模型;
+              列表表示显式指定的备用模型(id或alias)
+    """
+    delay = get_model_query_delay(model_id)
+    if delay == -1:
+        raise ValueError(f'Model {model_id} is disabled')
+
+    if fallback is None:
+        fallback = get_model_config(model_id).get('fallback', [])
+    elif fallback is False:
+        fallback = []
+
+    if isinstance(fallback, str):
+        fallback = [fallback]
+
+    chain = [model_id]
+    for m in fallback:
+        try:
+            m = get_model(m)
+        except ValueError as ex:
+            print(f'Warning: skip fallback model {m}: {ex}')
+            continue
+
+        if m not in chain:
+            chain.append(m)
+
+    return chain
+
+# 按models.yaml中的delay/rps/tpm限速. 该限速跨进程共享, 见ratelimit模块
+#   delay: 两次请求的最小间隔(秒), 等价于 rps = 1 / delay
+#   rps: 每秒请求数 (与delay同时设置时取较严格者)
+#   tpm: 每分钟token数 (输入按估计值预扣, 输出在请求结束后按实际用量补扣)
+def _get_rate_limits(model_id):
+    model_config = get_model_config(model_id)
+
+    rps = float(model_config.get('rps', 0))
+    delay = get_model_query_delay(model_id)
+    if delay and delay > 0:
+        rps = min(rps, 1 / delay) if rps else 1 / delay
+
+    tpm = float(model_config.get('tpm', 0))
+    return rps, tpm
+
+def _acquire_rate_limit(model_id, request_tokens):
+    rps, tpm = _get_rate_limits(model_id)
+    if not rps and not tpm:
+        return 0
+
+    limiter = ratelimit.get_rate_limiter()
+    waited = 0
+    if rps:
+        waited += limiter.acquire(f'{model_id}:requests', rate=rps, capacity=max(1, rps))
+    if tpm:
+        waited += limiter.acquire(f'{model_id}:tokens', rate=tpm / 60, capacity=tpm,
+                                  amount=request_tokens)
+
+    return waited
+
+def _consume_output_tokens(model_id, completion_tokens):
+    rps, tpm = _get_rate_limits(model_id)
+    if tpm and completion_tokens:
+        ratelimit.get_rate_limiter().consume(f'{model_id}:tokens', rate=tpm / 60, capacity=tpm,
+                                             amount=completion_tokens)
 
 def chat(prompt, contents, model_id, **kwargs):
     response, reasoning, filename = chat_impl(prompt, contents, model_id, **kwargs)
     return response
 
-@langfuse.observe()
+def chat_stream(prompt, contents, model_id, **kwargs):
+    """流式调用. 返回ChatStream, 迭代得到(kind, text), kind为'reasoning'或'content'."""
+    return ChatStream(prompt, contents, model_id, **kwargs)
+
+_clients = {}
+_clients_lock = threading.Lock()
+def _get_client():
+    # client在第一次调用时创建并复用, 复用连接池. 追踪由tracing模块单独记录, 不包装client
+    settings = config.snapshot()
+    key = (settings.openai_api_key, settings.openai_api_base)
+    with _clients_lock:
+        if key not in _clients:
+            # 重试和模型切换由resilience模块负责, 关闭SDK自带的重试
+            _clients[key] = openai.OpenAI(
+                api_key=settings.openai_api_key,
+                base_url=settings.openai_api_base,
+                max_retries=0,
+            )
+
+    return _clients[key]
+
+def _build_request_message(prompt, contents, sep, prompt_follow_contents):
+    return f'{prompt}{sep}{contents}' if not prompt_follow_contents else f'{contents}{sep}{prompt}'
+
+# 消息布局. 上游的prompt缓存按前缀匹配, 把不变的prompt放在最前面, 每天变化的contents放在后面,
+# 重复运行的任务就能命中缓存:
+#   'prefix': prompt和contents用sep拼接为一条user消息, prompt在前 (默认, 与原来的请求相同)
+#   'system': prompt作为system消息, contents作为user消息, 不使用sep. 在models.yaml中按模型开启
+# prompt_follow_contents=True时contents在前, 无法命中缓存
+MESSAGE_LAYOUTS = ['prefix', 'system']
+
+_warned_prompt_follow_contents = set()
+
+def get_message_layout(model_id):
+    layout = get_model_config(model_id).get('message_layout', 'prefix')
+    if layout not in MESSAGE_LAYOUTS:
+        raise ValueError(f'Unknown message_layout {layout} for model {model_id}')
+
+    return layout
+
+def _build_messages(model_id, prompt, contents, sep, prompt_follow_contents):
+    if prompt_follow_contents and model_id not in _warned_prompt_follow_contents:
+        # 每个模型只提示一次
+        _warned_prompt_follow_contents.add(model_id)
+        print(f'Warning: prompt_follow_contents puts the prompt after the contents, '
+              f'requests to {model_id} cannot hit the upstream prompt cache')
+
+    if prompt_follow_contents or get_message_layout(model_id) == 'prefix':
+        return [{'role': 'user', 'content': _build_request_message(prompt, contents, sep, prompt_follow_contents)}]
+
+    return [{'role': 'system', 'content': prompt}, {'role': 'user', 'content': contents}]
+
+def _usage_to_stats(usage, stats):
+    """从usage中提取token数. cached_tokens兼容OpenAI(prompt_tokens_details)和DeepSeek(prompt_cache_hit_tokens)"""
+    stats['prompt_tokens'] = usage.prompt_tokens
+    stats['completion_tokens'] = usage.completion_tokens
+
+    prompt_details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = getattr(prompt_details, 'cached_tokens', None) if prompt_details else None
+    if cached_tokens is None:
+        cached_tokens = getattr(usage, 'prompt_cache_hit_tokens', None)
+    if cached_tokens is not None:
+        stats['cached_tokens'] = cached_tokens
+
+    completion_details = getattr(usage, 'completion_tokens_details', None)
+    reasoning_tokens = getattr(completion_details, 'reasoning_tokens', None) if completion_details else None
+    if reasoning_tokens is not None:
+        stats['reasoning_tokens'] = reasoning_tokens
+
+def get_context_budget(model_id):
+    """返回可用于输入的token数. models.yaml中未配置context_window时返回None"""
+    model_config = get_model_config(model_id)
+    context_window = model_config.get('context_window')
+    if not context_window:
+        return None
+
+    return int(context_window) - int(model_config.get('max_output_tokens', 0))
+
+def _prepare_request(model_id, prompt, contents, sep, prompt_follow_contents, on_overflow):
+    """
+    估计请求的token数, 超过模型上下文窗口时按on_overflow处理:
+        'error': 抛出ContextOverflowError, 不发出请求
+        'trim': 截断contents的尾部 (prompt保持完整)
+        'ignore': 不检查
+    returns: messages, 实际发送的contents, 估计的token数
+    """
+    def build(contents):
+        messages = _build_messages(model_id, prompt, contents, sep, prompt_follow_contents)
+        return messages, tokens.estimate_tokens(''.join(m['content'] for m in messages), model_id)
+
+    messages, estimated = build(contents)
+
+    budget = get_context_budget(model_id)
+    if budget is None or estimated <= budget or on_overflow == 'ignore':
+        return messages, contents, estimated
+
+    if on_overflow != 'trim':
+        raise tokens.ContextOverflowError(model_id, estimated, budget)
+
+    contents_budget = budget - tokens.estimate_tokens(prompt + sep, model_id)
+    if contents_budget <= 0:
+        raise tokens.ContextOverflowError(model_id, estimated, budget)
+
+    print(f'Request to {model_id} needs ~{estimated} tokens, trimming contents to fit {budget}')
+    contents = tokens.truncate_to_tokens(contents, contents_budget, model_id)
+    messages, estimated = build(contents)
+
+    return messages, contents, estimated
+
+def _new_chat_filename(storage_obj, model_id, save_date=None):
+    model_save_name = get_model_save_name(model_id)
+    if save_date is None:
+        timestamp = time.strftime('%Y%m%d_%H%M%S')
+    else:
+        timestamp = time.strftime(f'{save_date}_%H%M%S')
+
+    filename = f'{timestamp}_{model_save_name}.txt'
+    while storage_obj.has(filename):
+        if filename.endswith(f'{model_save_name}.txt'):
+            filename = filename[:-len('.txt')] + '@1.txt'
+        else:
+            base, seq = filename[:-len('.txt')].rsplit('@', 1)
+            filename = f'{base}@{int(seq) + 1}.txt'
+
+    return filename
+
+def _save_chat(storage_obj, filename, model_id, prompt, reasoning, response, contents=None, stats=None):
+    data = f'model: {model_id}\n'
+    data += f'prompt:\n{prompt}\n'
+    data += f'reasoning:\n{reasoning}\n' if reasoning else ''
+    data += f'response:\n{response}\n'
+
+    storage_obj.save(filename, data)
+
+    base = filename[:-len('.txt')]
+    if contents is not None:
+        storage_obj.save(base + '.input.txt', contents)
+
+    if stats is not None:
+        storage_obj.save(base + '.stats.json', json.dumps(stats, indent=4))
+
 def chat_impl(prompt,
               contents,
               model_id,
@@ -126,116 +294,550 @@ def chat_impl(prompt,
               sep='\n',
               prompt_follow_contents=False,
               retries=0,
-              throw_ex=True):
-    
-    delay = get_model_query_delay(model_id)
-    if delay == -1:
-        raise ValueError(f'Model {model_id} is disabled')
-    
-    client = openai.OpenAI(
-        api_key=config.get("OPENAI_API_KEY"),
-        base_url=config.get('OPENAI_API_BASE'),
-    )
-
-    request_message = f'{prompt}{sep}{contents}' if not prompt_follow_contents else f'{contents}{sep}{prompt}'
-    chat_completion = None
-    retry_cnt = 0
-    while chat_completion is None:
+              throw_ex=True,
+              stream=False,
+              fallback=None,
+              on_overflow='error',
+              hedge=None,
+              coalesce=False):
+
+    if stream:
+        # 流式调用, 内容边接收边保存, 避免超时时丢失已生成的部分
+        stream_obj = ChatStream(prompt, contents, model_id,
+                                use_case=use_case, save=save, save_date=save_date, sep=sep,
+                                prompt_follow_contents=prompt_follow_contents, retries=retries,
+                                fallback=fallback, on_overflow=on_overflow)
         try:
-            chat_completion = client.chat.completions.create(
-                messages=[
-                    {
-                        "role": "user",
-                        "content": request_message,
-                    }
-                ],
-                model=model_id,
-            )
-        except openai.OpenAIError as ex:
-            if retry_cnt < retries:
-                print('openai api failed, retrying...')
+            for _ in stream_obj:
+                pass
+        except (openai.OpenAIError, tokens.ContextOverflowError):
+            if throw_ex:
+                raise
+            return None, None, None
+
+        return stream_obj.response, stream_obj.reasoning, stream_obj.filename
+
+    if coalesce:
+        # 同时发出的相同请求只执行一次 (包括其他进程中的), 其余的等待并共享结果, 见singleflight模块
+        key = _coalesce_key(prompt, contents, model_id, use_case, save, save_date, sep, prompt_follow_contents,
+                            retries, fallback, on_overflow, hedge)
+        t0 = time.time()
+        try:
+            result, shared = singleflight.get_single_flight().do(key, lambda: tuple(chat_impl(
+                prompt, contents, model_id, use_case=use_case, save=save, save_date=save_date, sep=sep,
+                prompt_follow_contents=prompt_follow_contents, retries=retries, throw_ex=True,
+                fallback=fallback, on_overflow=on_overflow, hedge=hedge, coalesce=False)))
+        except (openai.OpenAIError, tokens.ContextOverflowError):
+            if throw_ex:
+                raise
+            return None, None, None
+
+        if shared:
+            print(f'Identical request to {model_id} already in flight, shared its result')
+            accounting.record_usage(use_case, model_id, {'cache_hit': True, 'duration': time.time() - t0})
+
+        return tuple(result)
+
+    model_chain = get_model_chain(model_id, fallback)
+    client = _get_client()
+    generation = tracing.start_generation(use_case, model_id, prompt, contents)
+
+    def prepare_backup(backup):
+        prepared = _prepare_request(backup, prompt, contents, sep, prompt_follow_contents, on_overflow)
+        _acquire_rate_limit(backup, prepared[2])
+        return prepared
+
+    plan = resilience.FailoverPlan(model_chain, retries=retries)
+    try:
+        for model_id in plan:
+            try:
+                messages, sent_contents, estimated = _prepare_request(
+                    model_id, prompt, contents, sep, prompt_follow_contents, on_overflow)
+            except tokens.ContextOverflowError as ex:
                 print(ex)
-                time.sleep(min(5 * retry_cnt, 60))
-                retry_cnt += 1
+                plan.record_failure(model_id, ex)
                 continue
-            else:
-                print('openai api failed, giving up')
-                print('input_len: ', len(prompt), len(contents))
-                print(prompt)
-                print(contents[:min(256, len(contents))])
-
-                if throw_ex:
-                    raise ex
-                else:
-                    return None, None, None
 
-    response = chat_completion.choices[0].message.content
+            _acquire_rate_limit(model_id, estimated)
+            # 显式指定的hedge只用于请求的模型, 备用模型使用各自在models.yaml中的配置
+            hedge_policy = get_hedge_policy(model_id, hedge if model_id == model_chain[0] else None)
+            hedge_stats = None
+            t0 = time.time()
+            try:
+                if hedge_policy:
+                    winner, losers, hedge_stats, backup_prepared = _hedged_request(
+                        client, model_id, messages, hedge_policy, prepare_backup, use_case, estimated)
+                    for loser in losers:
+                        # 主模型通过了allow(), 可能持有探测名额, 输掉时也要有结果; 备用模型可重试的失败同样计入熔断
+                        if loser.model_id == model_id or resilience.is_retryable(loser.error):
+                            plan.record_lost(loser.model_id, loser.error)
+                    if winner.model_id != model_id:
+                        model_id = winner.model_id
+                        messages, sent_contents, estimated = backup_prepared
+                    response, reasoning, usage = winner.response, winner.reasoning, winner.usage
+                else:
+                    chat_completion = client.chat.completions.create(
+                        messages=messages,
+                        model=model_id,
+                    )
+                    response = chat_completion.choices[0].message.content
+                    reasoning = getattr(chat_completion.choices[0].message, 'reasoning_content', None)
+                    usage = chat_completion.usage
+            except openai.OpenAIError as ex:
+                print(f'openai api failed ({model_id}): {ex}')
+                plan.record_failure(model_id, ex)
+                continue
 
-    if 'reasoning_content' in chat_completion.choices[0].message:
-        reasoning = chat_completion.choices[0].message.reasoning_content
-    else:
-        reasoning = None
+            plan.record_success(model_id)
+            break
+    except (openai.OpenAIError, tokens.ContextOverflowError) as ex:
+        print('openai api failed, giving up')
+        print('input_len: ', len(prompt), len(contents))
+        print(prompt)
+        print(contents[:min(256, len(contents))])
+        generation.end(error=ex)
+
+        if throw_ex:
+            raise ex
+        else:
+            return None, None, None
+
+    stats = {
+        'model': model_id,
+        'duration': time.time() - t0,
+        'prompt_tokens_estimated': estimated,
+    }
+    if len(sent_contents) < len(contents):
+        stats['trimmed_chars'] = len(contents) - len(sent_contents)
+    if hedge_stats:
+        stats['hedge'] = hedge_stats
+
+    if usage is not None:
+        _usage_to_stats(usage, stats)
+        tokens.record_actual_tokens(model_id, estimated, usage.prompt_tokens)
+        _consume_output_tokens(model_id, usage.completion_tokens)
+
+    accounting.record_usage(use_case, model_id, stats)
+    generation.end(model=model_id, output=response, reasoning=reasoning, stats=stats)
 
     filename = None
     if save:
         storage_obj = get_storage(use_case)
-
-        model_save_name = get_model_save_name(model_id)
-        if save_date is None:
-            timestamp = time.strftime('%Y%m%d_%H%M%S')
-        else:
-            timestamp = time.strftime(f'{save_date}_%H%M%S')
-            
-        filename = f'{timestamp}_{model_save_name}.txt'
-        while storage_obj.has(filename):
-            if filename.endswith(f'{model_id}.txt'):
-                filename = filename[:-len('.txt')] + '@1.txt'
-            else:
-                filename_parts = filename.split('_')
-                filename = '_'.join(filename_parts[:-1]) + f'@{int(filename_parts[-1]) + 1}.txt'
-
-        data = f'model: {model_id}\n'
-        data += f'prompt:\n{prompt}\n'
-        data += f'reasoning:\n{reasoning}\n' if reasoning else ''
-        data += f'response:\n{response}\n'
-
-        storage_obj.save(filename, data)
-        storage_obj.save(filename[:-len('.txt')] + '.input.txt', contents)
+        filename = _new_chat_filename(storage_obj, model_id, save_date)
+        _save_chat(storage_obj, filename, model_id, prompt, reasoning, response,
+                   contents=sent_contents, stats=stats)
                                                                   
     return response, reasoning, filename
 
-if __name__ == '__main__':
-    # Quick test of models
+def _coalesce_key(prompt, contents, model_id, use_case, save, save_date, sep, prompt_follow_contents,
+                  retries, fallback, on_overflow, hedge):
+    # 影响结果 (备用模型, 超长时的处理) 和失败方式 (重试, 对冲) 的参数都要包括, 否则会共享不同请求的结果
+    data = [prompt, contents, model_id, use_case, save, save_date, sep, prompt_follow_contents,
+            retries, fallback, on_overflow, hedge]
+    return hashlib.sha1(json.dumps(data, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def get_hedge_policy(model_id, hedge=None):
+    """
+    返回模型的对冲策略 (hedging.HedgePolicy), 不对冲时返回None.
+    hedge: None时使用models.yaml中该模型的hedge配置; False表示不对冲; 备用模型名或dict表示显式指定的策略
+    """
+    if hedge is False:
+        return None
+    if hedge is None:
+        hedge = get_model_config(model_id).get('hedge')
+
+    return hedging.HedgePolicy.parse(hedge)
+
+def _hedged_request(client, model_id, messages, policy, prepare_backup, use_case, estimated):
+    """
+    以流式发出请求, 超过阈值没有收到第一个token时向备用模型发出同样的请求, 见hedging模块.
+    prepare_backup: prepare_backup(backup)返回备用模型的(messages, sent_contents, estimated), 并等待限速
+    use_case/estimated: 用于记录输掉的请求的用量, estimated为主模型的输入token估计
+    returns: (胜出的hedging.Attempt, 输掉的Attempt列表, 对冲的统计, 备用模型的prepare_backup结果)
+    """
+    try:
+        backup = get_model(policy.backup)
+    except ValueError as ex:
+        print(f'Warning: cannot hedge {model_id}: {ex}')
+        backup = None
+
+    def create(model, messages):
+        return client.chat.completions.create(messages=messages, model=model, stream=True,
+                                              stream_options={'include_usage': True})
+
+    backup_prepared = None
+    def create_backup():
+        nonlocal backup_prepared
+        backup_prepared = prepare_backup(backup)
+        return create(backup, backup_prepared[0])
+
+    def record_loser(attempt):
+        # 在attempt的线程中结束后调用, 此时backup_prepared已经确定
+        _record_hedge_loser(use_case, attempt,
+                            estimated if attempt.model_id == model_id else backup_prepared and backup_prepared[2])
+
+    winner, losers, hedge_stats = hedging.race(model_id, lambda: create(model_id, messages), backup,
+                                               create_backup, policy.threshold(model_id))
+    if winner.model_id != model_id:
+        print(f'hedged request to {backup} finished first')
+    for loser in losers:
+        loser.add_done_callback(record_loser)
+
+    hedge_stats['ttft'] = winner.ttft
+    return winner, losers, hedge_stats, backup_prepared
+
+def _record_hedge_loser(use_case, attempt, estimated):
+    """
+    记录对冲中被取消的请求的用量. 上游在流结束时才返回usage, 取消的请求收不到,
+    按估计的输入token和已经收到的输出估计 (complete为False). 没有发出或失败的请求不记录
+    """
+    if not attempt.sent or attempt.error is not None:
+        return
+
+    stats = {'model': attempt.model_id, 'duration': attempt.duration, 'complete': False, 'hedge_loser': True}
+    if attempt.usage is not None:
+        _usage_to_stats(attempt.usage, stats)
+    else:
+        stats['prompt_tokens_estimated'] = estimated or 0
+        stats['completion_tokens'] = tokens.count_tokens((attempt.response or '') + (attempt.reasoning or ''))
+    accounting.record_usage(use_case, attempt.model_id, stats)
+
+class ChatStream:
+    """
+    流式调用LLM. 迭代时逐块返回(kind, text), kind为'reasoning'或'content'.
+    save=True时, 收到第一个token后即创建聊天记录, 之后每隔save_interval秒把已收到的内容写入,
+    中途超时或出错也能保留已生成的部分. 迭代结束后可通过response/reasoning/filename/stats获取结果.
+
+    stats包含:
+        ttft: 从发出请求到收到第一个token(含reasoning)的秒数
+        ttft_content: 到收到第一个content token的秒数
+        duration: 总耗时
+        completion_tokens: 输出token数 (上游未返回usage时用chunk数估计)
+        tokens_per_sec: 首个token之后的输出速度
+        complete: 是否正常结束
+    """
+    def __init__(self,
+                 prompt,
+                 contents,
+                 model_id,
+                 use_case='default',
+                 save=True,
+                 save_date=None,
+                 sep='\n',
+                 prompt_follow_contents=False,
+                 retries=0,
+                 fallback=None,
+                 on_overflow='error',
+                 save_interval=5.0):
+        self.prompt = prompt
+        self.contents = contents
+        self.model_id = model_id
+        self.use_case = use_case
+        self.save = save
+        self.save_date = save_date
+        self.sep = sep
+        self.prompt_follow_contents = prompt_follow_contents
+        self.retries = retries
+        self.fallback = fallback
+        self.on_overflow = on_overflow
+        self.save_interval = save_interval
+
+        self.response = None
+        self.reasoning = None
+        self.filename = None
+        self.stats = {}
+
+        self._response_parts = []
+        self._reasoning_parts = []
+        self._storage = None
+        self._last_save = 0
+        self._first_token_time = None
+        self._sent_contents = contents
+
+    def __iter__(self):
+        generation = tracing.start_generation(self.use_case, self.model_id, self.prompt, self.contents)
+        try:
+            yield from self._iter_models()
+        except (openai.OpenAIError, tokens.ContextOverflowError) as ex:
+            generation.end(model=self.model_id, output=self.response, reasoning=self.reasoning,
+                           stats=self.stats, error=ex)
+            raise
+
+        generation.end(model=self.model_id, output=self.response, reasoning=self.reasoning, stats=self.stats)
+
+    def _iter_models(self):
+        model_chain = get_model_chain(self.model_id, self.fallback)
+        client = _get_client()
+
+        plan = resilience.FailoverPlan(model_chain, retries=self.retries)
+        for model_id in plan:
+            # 切换到备用模型时, 聊天记录和统计使用实际响应的模型
+            self.model_id = model_id
+            self.stats = {'model': model_id, 'complete': False}
+            try:
+                messages, self._sent_contents, estimated = _prepare_request(
+                    model_id, self.prompt, self.contents, self.sep, self.prompt_follow_contents, self.on_overflow)
+            except tokens.ContextOverflowError as ex:
+                print(ex)
+                plan.record_failure(model_id, ex)
+                continue
 
-    client = openai.OpenAI(
-        api_key=config.get("OPENAI_API_KEY"),
-        base_url=config.get('OPENAI_API_BASE'),
-    )
+            self.stats['prompt_tokens_estimated'] = estimated
+            if len(self._sent_contents) < len(self.contents):
+                self.stats['trimmed_chars'] = len(self.contents) - len(self._sent_contents)
+
+            waited = _acquire_rate_limit(model_id, estimated)
+            if waited:
+                self.stats['rate_limit_wait'] = waited
+
+            t0 = time.time()
+            try:
+                chunk_iter = client.chat.completions.create(
+                    messages=messages,
+                    model=model_id,
+                    stream=True,
+                    stream_options={'include_usage': True},
+                )
+                yield from self._consume(chunk_iter, t0)
+            except openai.OpenAIError as ex:
+                # 已经收到部分内容时不再重试或切换模型, 保留已生成的部分
+                if self._response_parts or self._reasoning_parts:
+                    print('openai api failed, giving up')
+                    print(ex)
+                    resilience.get_circuit_breaker(model_id).record_failure()
+                    self._finish(t0)
+                    raise
+
+                print(f'openai api failed ({model_id}): {ex}')
+                plan.record_failure(model_id, ex)
+                continue
 
-    upstream_models = client.models.list().data
-    upstream_models = {m.id: m.owned_by for m in upstream_models}
+            plan.record_success(model_id)
+            break
 
-    for model in list_models():
-        short_name = get_model_short_name(model)
+        self._finish(t0, complete=True)
+        _consume_output_tokens(self.model_id, self.stats.get('completion_tokens'))
+        tokens.record_actual_tokens(self.model_id, self.stats['prompt_tokens_estimated'], self.stats.get('prompt_tokens'))
 
-        owned_by = upstream_models.get(model)
-        if not owned_by:
-            print(f'model {model} not found in upstream models')
+    def _consume(self, chunk_iter, t0):
+        chunk_cnt = 0
+        for chunk in chunk_iter:
+            usage = getattr(chunk, 'usage', None)
+            if usage is not None:
+                _usage_to_stats(usage, self.stats)
+
+            if not chunk.choices:
+                continue
+
+            delta = chunk.choices[0].delta
+            reasoning = getattr(delta, 'reasoning_content', None)
+            content = delta.content
+
+            now = time.time()
+            if (reasoning or content) and 'ttft' not in self.stats:
+                self.stats['ttft'] = now - t0
+                self._first_token_time = now
+                if self.save:
+                    self._storage = get_storage(self.use_case)
+                    self.filename = _new_chat_filename(self._storage, self.model_id, self.save_date)
+                    self._storage.save(self.filename[:-len('.txt')] + '.input.txt', self._sent_contents)
+
+            if reasoning:
+                chunk_cnt += 1
+                self._reasoning_parts.append(reasoning)
+                yield 'reasoning', reasoning
+
+            if content:
+                chunk_cnt += 1
+                if 'ttft_content' not in self.stats:
+                    self.stats['ttft_content'] = now - t0
+                self._response_parts.append(content)
+                yield 'content', content
+
+            if self.save and self.filename and now - self._last_save >= self.save_interval:
+                self._save_partial(t0)
+
+        self.stats.setdefault('completion_tokens', chunk_cnt)
+
+    def _save_partial(self, t0):
+        self._last_save = time.time()
+        self._update_stats(t0)
+        _save_chat(self._storage, self.filename, self.model_id, self.prompt,
+                   ''.join(self._reasoning_parts), ''.join(self._response_parts), stats=self.stats)
+
+    def _update_stats(self, t0):
+        now = time.time()
+        self.stats['duration'] = now - t0
+        completion_tokens = self.stats.get('completion_tokens')
+        if self._first_token_time is not None and completion_tokens and now > self._first_token_time:
+            self.stats['tokens_per_sec'] = completion_tokens / (now - self._first_token_time)
+
+    def _finish(self, t0, complete=False):
+        self.response = ''.join(self._response_parts)
+        self.reasoning = ''.join(self._reasoning_parts) or None
+        self.stats['complete'] = complete
+        self._update_stats(t0)
+        accounting.record_usage(self.use_case, self.model_id, self.stats)
+
+        if self.save and self.filename:
+            _save_chat(self._storage, self.filename, self.model_id, self.prompt,
+                       self.reasoning, self.response, stats=self.stats)
+
+# 批量调用 (OpenAI batch API): 不需要立即返回的大量请求提交为一个batch, 价格更低, 不占用同步接口的限速.
+# 提交后的任务保存在 llm_batches/{use_case}/{batch_id}.json 中, 进程退出后仍可以用wait_batch()继续等待和保存结果
+BATCH_TERMINAL_STATUSES = ['completed', 'failed', 'expired', 'cancelled']
+
+def _get_batch_storage(use_case):
+    return storage.get_storage('llm_batches', use_case)
+
+def _per_item(value, n, name):
+    if isinstance(value, (list, tuple)):
+        if len(value) != n:
+            raise ValueError(f'{name} has {len(value)} items, expecting {n}')
+        return list(value)
+
+    return [value] * n
+
+def submit_batch(prompt,
+                 contents_list,
+                 model_id,
+                 use_case='default',
+                 save_date=None,
+                 sep='\n',
+                 prompt_follow_contents=False,
+                 on_overflow='error',
+                 completion_window='24h'):
+    """
+    把多个请求写成JSONL提交为一个batch. 返回batch id, 用wait_batch()等待并保存结果.
+    params:
+        prompt: 所有请求共用的prompt, 或每个请求一个的列表
+        contents_list: 每个请求的contents
+        save_date: 同chat_impl, 也可以是每个请求一个的列表
+        其他参数同chat_impl. batch不支持备用模型和对冲
+    raises: on_overflow='error'时, 先检查所有请求, 有超出上下文预算的请求时抛出ValueError (列出所有超出的序号), 不提交
+    """
+    n = len(contents_list)
+    prompts = _per_item(prompt, n, 'prompt')
+    save_dates = _per_item(save_date, n, 'save_date')
+
+    lines = []
+    items = []
+    overflows = []
+    for ind, (prompt, contents) in enumerate(zip(prompts, contents_list)):
+        try:
+            messages, sent_contents, estimated = _prepare_request(
+                model_id, prompt, contents, sep, prompt_follow_contents, on_overflow)
+        except tokens.ContextOverflowError as ex:
+            # 继续检查其他请求, 一次报告所有超出的请求
+            overflows.append((ind, ex))
             continue
-        else:
-            print(f'{model} ({short_name}), {owned_by}. testing...', end=' ')
 
-            try:
-                delay = get_model_query_delay(model)
-                t0 = time.time()
-                if delay:
-                    time.sleep(delay)
-                response = chat('Please response with "OK" and nothing else.', '', model, save=False, retries=0)
-                t1 = time.time()
-                if response.strip() == 'OK':
-                    print(f'Done, {t1 - t0:.2f}s')
-                else:
-                    print(f'Model return response of length {len(response)} ({response[:32]}...), {t1 - t0:.2f}s')
-            except openai.OpenAIError as ex:
-                print(f'Failed: {ex}')
-                
+        custom_id = f'req-{ind}'
+        lines.append(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions',
+                                 'body': {'model': model_id, 'messages': messages}}, ensure_ascii=False))
+        items.append({'custom_id': custom_id, 'prompt': prompt, 'contents': sent_contents,
+                      'trimmed_chars': len(contents) - len(sent_contents), 'estimated': estimated,
+                      'save_date': save_dates[ind]})
+
+    if overflows:
+        details = ', '.join(f'{ind} (~{ex.tokens} tokens)' for ind, ex in overflows)
+        raise ValueError(f'{len(overflows)} of {n} batch requests exceed the context budget of {model_id} '
+                         f'({overflows[0][1].limit} tokens): {details}. Shorten them or use on_overflow="trim"')
+
+    client = _get_client()
+    input_file = client.files.create(file=('batch.jsonl', ('\n'.join(lines) + '\n').encode('utf-8')),
+                                     purpose='batch')
+    batch = client.batches.create(input_file_id=input_file.id, endpoint='/v1/chat/completions',
+                                  completion_window=completion_window)
+
+    job = {'batch_id': batch.id, 'model': model_id, 'submitted': time.strftime('%Y%m%d_%H%M%S'),
+           'items': items, 'results': None}
+    _get_batch_storage(use_case).save(f'{batch.id}.json', json.dumps(job, ensure_ascii=False, indent=1))
+    print(f'Submitted batch {batch.id} with {n} requests to {model_id}')
+
+    return batch.id
+
+def _read_batch_file(client, file_id):
+    if not file_id:
+        return {}
+
+    results = {}
+    for line in client.files.content(file_id).text.splitlines():
+        if line.strip():
+            result = json.loads(line)
+            results[result['custom_id']] = result
+
+    return results
+
+def wait_batch(batch_id, use_case='default', save=True, poll_interval=60, timeout=None):
+    """
+    等待batch完成, 把结果按chat_impl的格式保存到chat_history (save=True时), 并记录用量.
+    returns: 与提交顺序一致的列表, 每项为(response, reasoning, filename), 失败的请求为None
+    raises: timeout秒内没有完成时抛出TimeoutError, 之后可以再次调用wait_batch
+    """
+    batch_storage = _get_batch_storage(use_case)
+    job = json.loads(batch_storage.load(f'{batch_id}.json'))
+    if job['results'] is not None:
+        return [tuple(r) if r else None for r in job['results']]
+
+    client = _get_client()
+    t0 = time.time()
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in BATCH_TERMINAL_STATUSES:
+            break
+
+        if timeout is not None and time.time() - t0 >= timeout:
+            raise TimeoutError(f'Batch {batch_id} is still {batch.status} after {timeout}s')
+        time.sleep(poll_interval)
+
+    if batch.status != 'completed':
+        print(f'Batch {batch_id} {batch.status}, saving the finished requests')
+
+    outputs = _read_batch_file(client, batch.output_file_id)
+    errors = _read_batch_file(client, batch.error_file_id)
+
+    model_id = job['model']
+    storage_obj = get_storage(use_case) if save else None
+    results = []
+    for item in job['items']:
+        output = outputs.get(item['custom_id'])
+        response = (output or {}).get('response') or {}
+        if response.get('status_code') != 200:
+            error = errors.get(item['custom_id'], output) or {}
+            print(f'batch request {item["custom_id"]} failed: {error.get("error") or error.get("response")}')
+            results.append(None)
+            continue
+
+        chat_completion = openai.types.chat.ChatCompletion.model_validate(response['body'])
+        message = chat_completion.choices[0].message
+        reasoning = getattr(message, 'reasoning_content', None)
+
+        stats = {'model': model_id, 'prompt_tokens_estimated': item['estimated'], 'batch_id': batch_id}
+        if item['trimmed_chars']:
+            stats['trimmed_chars'] = item['trimmed_chars']
+        if chat_completion.usage is not None:
+            _usage_to_stats(chat_completion.usage, stats)
+            tokens.record_actual_tokens(model_id, item['estimated'], chat_completion.usage.prompt_tokens)
+        accounting.record_usage(use_case, model_id, stats)
+
+        filename = None
+        if save:
+            filename = _new_chat_filename(storage_obj, model_id, item['save_date'])
+            _save_chat(storage_obj, filename, model_id, item['prompt'], reasoning, message.content,
+                       contents=item['contents'], stats=stats)
+
+        results.append((message.content, reasoning, filename))
+
+    # 记录结果, 重复调用wait_batch时不会重复保存
+    job['status'] = batch.status
+    job['results'] = results
+    batch_storage.save(f'{batch_id}.json', json.dumps(job, ensure_ascii=False, indent=1))
+
+    return results
+
+def chat_batch(prompt, contents_list, model_id, use_case='default', save=True, poll_interval=60, timeout=None,
+               **kwargs):
+    """提交batch并等待结果. 参数见submit_batch和wait_batch"""
+    batch_id = submit_batch(prompt, contents_list, model_id, use_case=use_case, **kwargs)
+    return wait_batch(batch_id, use_case=use_case, save=save, poll_interval=poll_interval, timeout=timeout)
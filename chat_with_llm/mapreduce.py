@@ -0,0 +1,223 @@
+"""
+超长输入的map-reduce摘要.
+
+输入按结构边界(字幕段落, 评论子树, 文章分隔线)切分后, 打包成不超过chunk_tokens的块, 并发地对每块调用LLM(map),
+再把结果分组逐层合并(reduce), 直到只剩一个结果. 最后一次合并与llm.chat一样保存到chat_history.
+
+每个map/reduce步骤的结果缓存在llm_cache存储中, 以模型, prompt和输入的hash为key.
+部分块失败时抛出MapReduceError, 已成功的块已经缓存, 重新运行时只会重做失败的块.
+"""
+
+import hashlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from chat_with_llm import llm
+from chat_with_llm import storage
+from chat_with_llm import tokens
+
+__all__ = ['MapReduceError', 'summarize', 'split_paragraphs', 'split_by_separator', 'split_indented_tree', 'pack_chunks']
+
+CHUNK_SEP = '\n' + '-' * 80 + '\n'
+
+# 模型未配置context_window时使用的输入预算 (token数), 按常见的128K上下文并给输出留出余量
+DEFAULT_CONTEXT_BUDGET = 96000
+# 去掉prompt后每块至少要有的token数, 否则块被截断为空或者每行一块
+MIN_CHUNK_TOKENS = 512
+
+DEFAULT_MAP_PROMPT = ('{prompt}\n\n注意: 下面只是一份完整内容的第{index}/{total}部分. '
+                      '请尽量保留细节, 关键信息和链接, 之后会与其他部分的结果合并.')
+DEFAULT_REDUCE_PROMPT = ('下面是对一份较长内容分段处理后的结果, 各段结果之间用长--连线分割. '
+                         '请按照以下要求将它们合并为一个完整的结果, 去掉重复的内容:\n{prompt}')
+
+class MapReduceError(RuntimeError):
+    def __init__(self, failed, total):
+        super().__init__(f'{len(failed)} of {total} chunks failed. Re-run to retry the failed chunks.')
+        self.failed = failed
+        self.total = total
+
+def split_paragraphs(text):
+    """按空行切分, 例如字幕按停顿分成的段落"""
+    return [p for p in re.split(r'\n\s*\n', text) if p.strip()]
+
+def split_by_separator(text, sep):
+    """按分隔线切分, 例如多篇文章之间的 '-' * 80"""
+    return [p for p in text.split(sep) if p.strip()]
+
+def split_indented_tree(text, indent='  '):
+    """按没有缩进的行切分, 每块是一棵完整的子树. 例如HNComments.parse输出的评论树"""
+    pieces = []
+    cur = []
+    for line in text.split('\n'):
+        if cur and line and not line.startswith(indent):
+            pieces.append('\n'.join(cur))
+            cur = []
+        cur.append(line)
+
+    if cur and any(l.strip() for l in cur):
+        pieces.append('\n'.join(cur))
+
+    return pieces
+
+def pack_chunks(pieces, chunk_tokens, model_id=None, sep='\n\n'):
+    """按顺序把pieces合并为估计token数不超过chunk_tokens的块. 单个过大的piece按行拆分, 单行过长时截断"""
+    chunks = []
+    cur = []
+    cur_tokens = 0
+
+    def flush():
+        nonlocal cur, cur_tokens
+        if cur:
+            chunks.append(sep.join(cur))
+        cur = []
+        cur_tokens = 0
+
+    for piece in pieces:
+        piece_tokens = tokens.estimate_tokens(piece, model_id)
+        if piece_tokens > chunk_tokens:
+            lines = piece.split('\n')
+            if len(lines) > 1:
+                for chunk in pack_chunks(lines, chunk_tokens, model_id, sep='\n'):
+                    flush()
+                    cur = [chunk]
+                    cur_tokens = tokens.estimate_tokens(chunk, model_id)
+                continue
+
+            piece = tokens.truncate_to_tokens(piece, chunk_tokens, model_id)
+            piece_tokens = tokens.estimate_tokens(piece, model_id)
+
+        if cur and cur_tokens + piece_tokens > chunk_tokens:
+            flush()
+
+        cur.append(piece)
+        cur_tokens += piece_tokens
+
+    flush()
+    return chunks
+
+def _cache_key(model_id, prompt, contents):
+    h = hashlib.sha1()
+    for s in (model_id, prompt, contents):
+        h.update(s.encode('utf-8'))
+        h.update(b'\0')
+
+    return h.hexdigest() + '.txt'
+
+def _run_step(cache, model_id, prompt, contents, chat_kwargs):
+    key = _cache_key(model_id, prompt, contents)
+    if cache is not None:
+        cached = cache.load(key)
+        if cached is not None:
+            return cached
+
+    response = llm.chat(prompt, contents, model_id, save=False, throw_ex=True, **chat_kwargs)
+    if cache is not None and response:
+        cache.save(key, response)
+
+    return response
+
+def _run_parallel(cache, model_id, jobs, max_workers, chat_kwargs):
+    # jobs: [(prompt, contents)]. 全部完成后才检查失败, 保证成功的结果都已缓存
+    def run(job):
+        prompt, contents = job
+        try:
+            return _run_step(cache, model_id, prompt, contents, chat_kwargs)
+        except Exception as ex:
+            print(f'map-reduce step failed: {ex}')
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(run, jobs))
+
+    failed = [ind for ind, r in enumerate(results) if not r]
+    if failed:
+        raise MapReduceError(failed, len(jobs))
+
+    return results
+
+def summarize(prompt,
+              contents,
+              model_id,
+              splitter=split_paragraphs,
+              chunk_tokens=None,
+              map_prompt=None,
+              reduce_prompt=None,
+              max_workers=4,
+              use_case='default',
+              cache=True,
+              **chat_kwargs):
+    """
+    对contents执行prompt, 超长时使用map-reduce.
+    params:
+        splitter: 将contents切分为结构单元的函数
+        chunk_tokens: 每块的最大token数. 默认使用模型的上下文预算, 模型未配置context_window时使用DEFAULT_CONTEXT_BUDGET.
+            需要切分但预算去掉prompt后少于MIN_CHUNK_TOKENS时抛出ValueError
+        map_prompt/reduce_prompt: 可使用{prompt}, map_prompt还可以使用{index}和{total}. 默认基于prompt生成
+        max_workers: map阶段的最大并发数
+        cache: 是否缓存每一步的结果
+        其他参数(save, save_date, retries, fallback等)传给最后一次llm.chat
+    returns: 与llm.chat相同. throw_ex=False时有块失败返回None
+    """
+    map_prompt = map_prompt or DEFAULT_MAP_PROMPT
+    reduce_prompt = (reduce_prompt or DEFAULT_REDUCE_PROMPT).format(prompt=prompt)
+
+    prompt_tokens = None
+    if chunk_tokens is None:
+        chunk_tokens = llm.get_context_budget(model_id)
+        if chunk_tokens is None:
+            print(f'Warning: no context_window for {model_id} in models.yaml, '
+                  f'map-reduce uses the default budget of {DEFAULT_CONTEXT_BUDGET} tokens')
+            chunk_tokens = DEFAULT_CONTEXT_BUDGET
+        prompt_tokens = max(tokens.estimate_tokens(map_prompt.format(prompt=prompt, index=0, total=0), model_id),
+                            tokens.estimate_tokens(reduce_prompt, model_id))
+        chunk_tokens -= prompt_tokens
+
+    final_kwargs = dict(chat_kwargs, use_case=use_case)
+    if tokens.estimate_tokens(contents, model_id) <= chunk_tokens:
+        return llm.chat(prompt, contents, model_id, **final_kwargs)
+
+    if prompt_tokens is not None and chunk_tokens < MIN_CHUNK_TOKENS:
+        raise ValueError(f'Only {chunk_tokens} tokens left for contents after the {prompt_tokens}-token prompt '
+                         f'in the context budget of {model_id}, need at least {MIN_CHUNK_TOKENS}. '
+                         f'Use a shorter prompt or a model with a larger context_window')
+    if chunk_tokens <= 0:
+        raise ValueError(f'chunk_tokens must be positive, got {chunk_tokens}')
+
+    # 块按预算切分, 只有无法继续合并时才可能超出, 此时截断
+    final_kwargs.setdefault('on_overflow', 'trim')
+    step_kwargs = {k: v for k, v in final_kwargs.items() if k not in ('save', 'save_date', 'throw_ex')}
+    cache_obj = storage.get_storage('llm_cache', use_case) if cache else None
+
+    try:
+        contents = _map_reduce(prompt, contents, model_id, splitter, chunk_tokens, map_prompt, reduce_prompt,
+                               max_workers, cache_obj, step_kwargs)
+    except MapReduceError as ex:
+        print(ex)
+        if chat_kwargs.get('throw_ex', True):
+            raise
+        return None
+
+    return llm.chat(reduce_prompt, contents, model_id, **final_kwargs)
+
+def _map_reduce(prompt, contents, model_id, splitter, chunk_tokens, map_prompt, reduce_prompt,
+                max_workers, cache_obj, step_kwargs):
+    """执行map和中间层的reduce, 返回最后一次reduce的输入"""
+    chunks = pack_chunks(splitter(contents), chunk_tokens, model_id)
+    print(f'map-reduce: {len(chunks)} chunks of at most {chunk_tokens} tokens')
+
+    jobs = [(map_prompt.format(prompt=prompt, index=i + 1, total=len(chunks)), chunk)
+            for i, chunk in enumerate(chunks)]
+    results = _run_parallel(cache_obj, model_id, jobs, max_workers, step_kwargs)
+
+    # 逐层合并, 直到所有结果能放进一次请求
+    while True:
+        groups = pack_chunks(results, chunk_tokens, model_id, sep=CHUNK_SEP)
+        if len(groups) > 1 and len(groups) == len(results):
+            # 每个结果都接近chunk_tokens, 无法按预算合并, 改为两两合并(超出部分会被截断)
+            groups = [CHUNK_SEP.join(results[i:i + 2]) for i in range(0, len(results), 2)]
+
+        if len(groups) == 1:
+            return groups[0]
+
+        print(f'map-reduce: reducing {len(results)} results into {len(groups)}')
+        results = _run_parallel(cache_obj, model_id, [(reduce_prompt, g) for g in groups], max_workers, step_kwargs)
@@ -0,0 +1,556 @@
+"""
+本地的OpenAI兼容服务, 用于离线的压力测试和回归测试.
+
+实现 /v1/chat/completions (含流式和reasoning_content) 和 /v1/models. 延迟和输出速度可以配置为随机分布,
+可以按概率或对前N个请求注入错误(429/500/503/超时/断开连接), usage中包含reasoning_tokens和cached_tokens.
+
+另外实现了batch接口 (/v1/files, /v1/batches): 创建batch后等待batch_latency秒, 逐条按chat请求的规则生成结果,
+成功的写入output文件, 失败的(注入的错误)写入error文件.
+
+    with openai_stub.StubServer(latency='lognormal:0.3,0.5', token_rate=50, errors={429: 0.1}, seed=1) as server:
+        client = openai.OpenAI(api_key='stub', base_url=server.base_url)
+        ...
+        print(server.counts)
+
+llm模块通过环境变量使用stub (配置中环境变量优先):
+
+    os.environ['OPENAI_API_BASE'] = server.base_url
+    config.reload()
+
+也可以独立运行: python -m chat_with_llm.openai_stub --port 8400 --latency uniform:0.1,0.5 --error 429=0.1
+"""
+
+import argparse
+import email.parser
+import hashlib
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__all__ = ['StubServer', 'parse_distribution', 'ERROR_KINDS']
+
+# 可以注入的错误. 数字为HTTP状态码
+#   timeout: 挂起timeout秒后断开连接, 不返回任何内容
+#   disconnect: 流式请求输出一半后断开连接; 非流式请求直接断开
+ERROR_KINDS = [429, 500, 503, 'timeout', 'disconnect']
+
+DEFAULT_OPTIONS = {
+    'latency': 0.1,         # 收到请求到返回第一个token的秒数
+    'token_rate': 100,      # 每秒输出的token数, 0表示不限制
+    'output_tokens': 16,    # 请求中没有max_tokens时的输出token数
+    'reasoning_tokens': 0,  # 在content之前输出的reasoning_content token数
+    'errors': {},           # {错误类型: 概率}
+    'fail_first': 0,        # 前N个请求固定返回fail_kind错误, 用于确定性的重试测试
+    'fail_kind': 429,
+    'retry_after': None,    # 429响应的Retry-After秒数
+    'timeout': 30,          # timeout错误挂起的秒数
+    'batch_latency': 0.5,   # batch从创建到完成的秒数
+}
+
+def parse_distribution(spec):
+    """
+    解析延迟或速度的分布, 返回以random.Random为参数的采样函数. 支持:
+        0.2 或 '0.2': 常数
+        'uniform:a,b': [a, b]均匀分布
+        'normal:mean,std': 正态分布 (负值取0)
+        'lognormal:median,sigma': 对数正态分布, 适合有长尾的延迟
+        'exp:mean': 指数分布
+    """
+    if callable(spec):
+        return spec
+
+    if isinstance(spec, (int, float)):
+        return lambda rng: float(spec)
+
+    name, _, params = str(spec).partition(':')
+    if not params:
+        value = float(name)
+        return lambda rng: value
+
+    params = [float(p) for p in params.split(',')]
+    if name == 'uniform':
+        return lambda rng: rng.uniform(params[0], params[1])
+    elif name == 'normal':
+        return lambda rng: max(0.0, rng.gauss(params[0], params[1]))
+    elif name == 'lognormal':
+        mu = math.log(params[0])
+        return lambda rng: rng.lognormvariate(mu, params[1])
+    elif name == 'exp':
+        return lambda rng: rng.expovariate(1 / params[0])
+    else:
+        raise ValueError(f'Unknown distribution {spec}')
+
+def _count_tokens(text):
+    # 与tokens模块的估计方式无关, 简单按4个字符一个token计算
+    return len(text) // 4 + 1
+
+def _error_body(message, error_type, code=None):
+    return {'error': {'message': message, 'type': error_type, 'code': code}}
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端提前断开连接(例如取消流式请求, 超时)是正常情况
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # header和body分开写入, 不关闭Nagle时keep-alive连接上每个请求会多等待约40ms的delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, obj, headers=None):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def _send_chunk(self, data):
+        payload = f'data: {data}\n\n'.encode('utf-8')
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(payload), payload))
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _send_bytes(self, data):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_not_found(self):
+        self._send_json(404, _error_body(f'Unknown path {self.path}', 'invalid_request_error'))
+
+    def do_GET(self):
+        stub = self.server.stub
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if parts[-1] == 'models':
+            models = [{'id': m, 'object': 'model', 'created': 0, 'owned_by': 'stub'}
+                      for m in stub.models or ['stub-model']]
+            self._send_json(200, {'object': 'list', 'data': models})
+        elif len(parts) >= 3 and parts[-3] == 'files' and parts[-1] == 'content' and parts[-2] in stub.files:
+            self._send_bytes(stub.files[parts[-2]]['content'])
+        elif len(parts) >= 2 and parts[-2] == 'files' and parts[-1] in stub.files:
+            self._send_json(200, stub.files[parts[-1]]['meta'])
+        elif len(parts) >= 2 and parts[-2] == 'batches' and parts[-1] in stub.batches:
+            self._send_json(200, stub.batches[parts[-1]])
+        else:
+            self._send_not_found()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        path = self.path.split('?')[0].rstrip('/')
+
+        if path.endswith('/files'):
+            self.server.stub.handle_file_upload(self, body)
+            return
+
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError:
+            self._send_json(400, _error_body('Invalid JSON body', 'invalid_request_error'))
+            return
+
+        if path.endswith('/chat/completions'):
+            self.server.stub.handle_chat(self, request)
+        elif path.endswith('/batches'):
+            self.server.stub.handle_batch_create(self, request)
+        else:
+            self._send_not_found()
+
+class StubServer:
+    """
+    params:
+        models: /v1/models返回的模型列表, 请求其他模型返回404. None表示接受任意模型
+        model_options: {model: {选项}}, 按模型覆盖DEFAULT_OPTIONS中的选项, 例如让某个模型总是失败
+        responder: 可选的函数(request) -> str, 生成回复内容. 默认输出 'tok0 tok1 ...'
+        seed: 随机数种子, 固定后延迟和错误注入可以复现 (并发时请求的顺序仍不确定)
+        其他参数见DEFAULT_OPTIONS. latency和token_rate可以是parse_distribution支持的分布
+
+    运行时统计:
+        requests: 收到的所有chat请求 (json), 包括batch中的请求
+        counts: {'requests': n, 'ok': n, 错误类型: n}
+        files/batches: 上传的文件和创建的batch
+    """
+    def __init__(self, host='127.0.0.1', port=0, models=None, model_options=None, responder=None, seed=None,
+                 **options):
+        unknown = set(options) - set(DEFAULT_OPTIONS)
+        if unknown:
+            raise ValueError(f'Unknown options {sorted(unknown)}')
+
+        self.host = host
+        self.port = port
+        self.models = models
+        self.model_options = model_options or {}
+        self.responder = responder
+        self.options = dict(DEFAULT_OPTIONS, **options)
+
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.counts = {'requests': 0, 'ok': 0}
+        self._prefix_cache = set()
+        self.files = {}
+        self.batches = {}
+
+        self.httpd = None
+        self.thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def base_url(self):
+        return f'http://{self.host}:{self.port}/v1'
+
+    def start(self):
+        self._stopped.clear()
+        self.httpd = _Server((self.host, self.port), _Handler)
+        self.httpd.stub = self
+        self.port = self.httpd.server_address[1]
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _sleep(self, seconds):
+        # stop()时立即返回, 避免挂起的请求拖住测试
+        if seconds > 0:
+            self._stopped.wait(seconds)
+
+    def _options_for(self, model):
+        return dict(self.options, **self.model_options.get(model, {}))
+
+    def _plan_request(self, request, opts):
+        """在锁内决定本次请求的错误类型和随机参数, 保证固定seed时结果可复现"""
+        with self.lock:
+            self.requests.append(request)
+            self.counts['requests'] += 1
+
+            error = None
+            if self.counts['requests'] <= opts['fail_first']:
+                error = opts['fail_kind']
+            else:
+                r = self.rng.random()
+                for kind, p in opts['errors'].items():
+                    if r < p:
+                        error = kind
+                        break
+                    r -= p
+
+            latency = parse_distribution(opts['latency'])(self.rng)
+            token_rate = parse_distribution(opts['token_rate'])(self.rng)
+
+            key = str(error) if error is not None else 'ok'
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+        return error, latency, token_rate
+
+    def _cached_tokens(self, messages):
+        # 模拟上游的前缀缓存: 第一条消息之前出现过时, 它的token计为cached
+        if len(messages) < 2:
+            return 0
+
+        first = str(messages[0].get('content', ''))
+        digest = hashlib.sha1(first.encode('utf-8')).hexdigest()
+        with self.lock:
+            if digest in self._prefix_cache:
+                return _count_tokens(first)
+            if len(self._prefix_cache) > 10000:
+                self._prefix_cache.clear()
+            self._prefix_cache.add(digest)
+
+        return 0
+
+    def _send_error(self, handler, error, opts):
+        if error in ('timeout', 'disconnect'):
+            if error == 'timeout':
+                self._sleep(opts['timeout'])
+            handler.close_connection = True
+            return
+
+        headers = {}
+        if error == 429:
+            body = _error_body('Rate limit exceeded (stub)', 'rate_limit_error', 'rate_limit_exceeded')
+            if opts['retry_after'] is not None:
+                headers['Retry-After'] = str(opts['retry_after'])
+        else:
+            body = _error_body(f'Injected error {error} (stub)', 'server_error')
+
+        handler._send_json(int(error), body, headers)
+
+    def handle_chat(self, handler, request):
+        model = request.get('model')
+        if self.models is not None and model not in self.models:
+            handler._send_json(404, _error_body(f'The model {model} does not exist', 'invalid_request_error',
+                                                'model_not_found'))
+            return
+
+        opts = self._options_for(model)
+        error, latency, token_rate = self._plan_request(request, opts)
+
+        self._sleep(latency)
+        if error is not None and error != 'disconnect':
+            self._send_error(handler, error, opts)
+            return
+
+        words, reasoning_words, finish_reason, usage = self._generate(request, opts)
+        completion_tokens = usage['completion_tokens']
+        completion_id = f'chatcmpl-{uuid.uuid4().hex[:12]}'
+        created = int(time.time())
+
+        if not request.get('stream'):
+            if error == 'disconnect':
+                self._send_error(handler, error, opts)
+                return
+
+            if token_rate:
+                self._sleep(completion_tokens / token_rate)
+
+            handler._send_json(200, self._completion_body(completion_id, created, model, words, reasoning_words,
+                                                          finish_reason, usage))
+            return
+
+        handler._start_stream()
+
+        base = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model}
+        deltas = [('reasoning_content', w) for w in reasoning_words] + [('content', w) for w in words]
+        stop_at = len(deltas) // 2 if error == 'disconnect' else len(deltas)
+
+        for ind, (kind, word) in enumerate(deltas[:stop_at]):
+            if ind > 0 and deltas[ind - 1][0] == kind:
+                word = ' ' + word
+            delta = {kind: word}
+            if ind == 0:
+                delta['role'] = 'assistant'
+
+            handler._send_chunk(json.dumps({**base, 'choices': [{'index': 0, 'delta': delta}]}))
+            if token_rate:
+                self._sleep(1 / token_rate)
+
+        if error == 'disconnect':
+            handler.close_connection = True
+            return
+
+        handler._send_chunk(json.dumps({**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': finish_reason}]}))
+        if (request.get('stream_options') or {}).get('include_usage'):
+            handler._send_chunk(json.dumps({**base, 'choices': [], 'usage': usage}))
+        handler._send_chunk('[DONE]')
+        handler._end_stream()
+
+    def _generate(self, request, opts):
+        """生成回复. returns: (words, reasoning_words, finish_reason, usage)"""
+        messages = request.get('messages') or []
+        max_tokens = request.get('max_tokens') or request.get('max_completion_tokens')
+
+        if self.responder:
+            words = self.responder(request).split(' ')
+        else:
+            words = [f'tok{i}' for i in range(max_tokens or opts['output_tokens'])]
+
+        finish_reason = 'stop'
+        if max_tokens and len(words) > max_tokens:
+            words = words[:max_tokens]
+            finish_reason = 'length'
+
+        reasoning_words = [f'think{i}' for i in range(opts['reasoning_tokens'])]
+
+        prompt_tokens = sum(_count_tokens(str(m.get('content', ''))) for m in messages)
+        completion_tokens = len(words) + len(reasoning_words)
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'prompt_tokens_details': {'cached_tokens': self._cached_tokens(messages)},
+            'completion_tokens_details': {'reasoning_tokens': len(reasoning_words)},
+        }
+
+        return words, reasoning_words, finish_reason, usage
+
+    def _completion_body(self, completion_id, created, model, words, reasoning_words, finish_reason, usage):
+        message = {'role': 'assistant', 'content': ' '.join(words)}
+        if reasoning_words:
+            message['reasoning_content'] = ' '.join(reasoning_words)
+
+        return {
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': created,
+            'model': model,
+            'choices': [{'index': 0, 'finish_reason': finish_reason, 'message': message}],
+            'usage': usage,
+        }
+
+    def _save_file(self, content, filename, purpose):
+        file_id = f'file-{uuid.uuid4().hex[:12]}'
+        meta = {'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+                'filename': filename, 'purpose': purpose, 'status': 'processed'}
+        with self.lock:
+            self.files[file_id] = {'meta': meta, 'content': content}
+
+        return meta
+
+    def handle_file_upload(self, handler, body):
+        # multipart/form-data, 字段: purpose, file
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + handler.headers.get('Content-Type', '').encode('latin-1') + b'\r\n\r\n' + body)
+        fields = {}
+        for part in message.get_payload() if message.is_multipart() else []:
+            fields[part.get_param('name', header='content-disposition')] = part
+
+        if 'file' not in fields:
+            handler._send_json(400, _error_body('Missing file', 'invalid_request_error'))
+            return
+
+        file_part = fields['file']
+        purpose = fields['purpose'].get_payload(decode=True).decode('utf-8') if 'purpose' in fields else 'batch'
+        meta = self._save_file(file_part.get_payload(decode=True), file_part.get_filename() or 'upload', purpose)
+        handler._send_json(200, meta)
+
+    def handle_batch_create(self, handler, request):
+        input_file_id = request.get('input_file_id')
+        if input_file_id not in self.files:
+            handler._send_json(404, _error_body(f'No such file {input_file_id}', 'invalid_request_error'))
+            return
+
+        batch_id = f'batch_{uuid.uuid4().hex[:12]}'
+        batch = {
+            'id': batch_id,
+            'object': 'batch',
+            'endpoint': request.get('endpoint', '/v1/chat/completions'),
+            'input_file_id': input_file_id,
+            'completion_window': request.get('completion_window', '24h'),
+            'status': 'in_progress',
+            'created_at': int(time.time()),
+            'output_file_id': None,
+            'error_file_id': None,
+            'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+            'metadata': request.get('metadata'),
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+
+        threading.Thread(target=self._run_batch, args=(batch,), daemon=True).start()
+        handler._send_json(200, batch)
+
+    def _run_batch(self, batch):
+        self._sleep(self.options['batch_latency'])
+
+        outputs = []
+        errors = []
+        for line in self.files[batch['input_file_id']]['content'].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+
+            item = json.loads(line)
+            request = item.get('body') or {}
+            model = request.get('model')
+            result = {'id': f'batch_req_{uuid.uuid4().hex[:12]}', 'custom_id': item.get('custom_id'),
+                      'response': None, 'error': None}
+
+            opts = self._options_for(model)
+            error, _, _ = self._plan_request(request, opts)
+            if self.models is not None and model not in self.models:
+                result['response'] = {'status_code': 404,
+                                      'body': _error_body(f'The model {model} does not exist', 'invalid_request_error')}
+            elif error in ('timeout', 'disconnect'):
+                result['error'] = {'code': 'server_error', 'message': f'Injected error {error} (stub)'}
+            elif error is not None:
+                result['response'] = {'status_code': int(error),
+                                      'body': _error_body(f'Injected error {error} (stub)', 'server_error')}
+            else:
+                words, reasoning_words, finish_reason, usage = self._generate(request, opts)
+                body = self._completion_body(f'chatcmpl-{uuid.uuid4().hex[:12]}', int(time.time()), model,
+                                             words, reasoning_words, finish_reason, usage)
+                result['response'] = {'status_code': 200, 'request_id': result['id'], 'body': body}
+
+            (outputs if result['response'] and result['response']['status_code'] == 200 else errors).append(result)
+
+        def to_file(results, name):
+            if not results:
+                return None
+            content = ''.join(json.dumps(r) + '\n' for r in results).encode('utf-8')
+            return self._save_file(content, name, 'batch_output')['id']
+
+        output_file_id = to_file(outputs, f'{batch["id"]}_output.jsonl')
+        error_file_id = to_file(errors, f'{batch["id"]}_error.jsonl')
+        with self.lock:
+            batch['output_file_id'] = output_file_id
+            batch['error_file_id'] = error_file_id
+            batch['request_counts'] = {'total': len(outputs) + len(errors), 'completed': len(outputs),
+                                       'failed': len(errors)}
+            batch['completed_at'] = int(time.time())
+            batch['status'] = 'completed'
+
+def _parse_error(spec):
+    kind, _, p = spec.partition('=')
+    kind = int(kind) if kind.isdigit() else kind
+    if kind not in ERROR_KINDS:
+        raise argparse.ArgumentTypeError(f'Unknown error kind {kind}, expecting one of {ERROR_KINDS}')
+    return kind, float(p)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local OpenAI compatible stub server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8400)
+    parser.add_argument('--latency', default='0.1', help='Seconds before the first token, e.g. 0.1 or lognormal:0.3,0.5')
+    parser.add_argument('--token_rate', default='100', help='Output tokens per second, e.g. 100 or uniform:20,80')
+    parser.add_argument('--output_tokens', type=int, default=16)
+    parser.add_argument('--reasoning_tokens', type=int, default=0)
+    parser.add_argument('--error', type=_parse_error, nargs='*', default=[],
+                        help='Injected errors as kind=probability, e.g. 429=0.1 500=0.02 timeout=0.01')
+    parser.add_argument('--fail_first', type=int, default=0)
+    parser.add_argument('--retry_after', type=float, default=None)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--batch_latency', type=float, default=0.5, help='Seconds before a batch completes')
+    parser.add_argument('--models', nargs='+', default=None)
+    parser.add_argument('--seed', type=int, default=None)
+
+    args = parser.parse_args()
+
+    server = StubServer(host=args.host, port=args.port, models=args.models, seed=args.seed,
+                        latency=args.latency, token_rate=args.token_rate, output_tokens=args.output_tokens,
+                        reasoning_tokens=args.reasoning_tokens, errors=dict(args.error),
+                        fail_first=args.fail_first, retry_after=args.retry_after, timeout=args.timeout,
+                        batch_latency=args.batch_latency)
+    server.start()
+    print(f'Stub server listening on {server.base_url}')
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+        print(server.counts)
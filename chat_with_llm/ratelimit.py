@@ -0,0 +1,119 @@
+"""
+跨进程的令牌桶限速器.
+
+桶的状态保存在 {STORAGE_BASE_DIR}/llm_state/ratelimit.db 中, 多个cron任务同时调用同一个上游时共享配额.
+每次acquire在一个 BEGIN IMMEDIATE 事务内完成 "补充令牌 -> 扣减" 的操作, 保证多进程下的原子性.
+"""
+
+import os.path
+import sqlite3
+import threading
+import time
+
+from chat_with_llm import config
+
+__all__ = ['RateLimiter', 'get_rate_limiter']
+
+class RateLimiter:
+    """
+    令牌桶限速器.
+    params:
+        db_path: sqlite数据库路径. 同一路径的RateLimiter(包括其他进程中的)共享桶的状态
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS buckets '
+                '(key TEXT PRIMARY KEY, tokens REAL, updated REAL)'
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # sqlite连接不能跨线程共享, 每次调用单独建立连接. isolation_level=None以便手动控制事务
+        return sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+
+    def _take(self, conn, key, rate, capacity, amount, allow_wait):
+        """在事务中补充并尝试扣减令牌. 返回还需等待的秒数, 0表示已扣减成功."""
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, row[0] + max(0, now - row[1]) * rate)
+
+            # 超过桶容量的请求(例如很长的输入)在桶满时放行, 令牌数变为负值, 后续请求相应等待
+            need = min(amount, capacity)
+            if tokens >= need or not allow_wait:
+                tokens -= amount
+                wait = 0
+            else:
+                wait = (need - tokens) / rate
+
+            conn.execute(
+                'INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                (key, tokens, now)
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        return wait
+
+    def acquire(self, key, rate, capacity, amount=1):
+        """
+        从key对应的桶中取出amount个令牌, 不足时阻塞等待.
+        params:
+            rate: 每秒补充的令牌数
+            capacity: 桶容量, 即允许的突发量
+        returns: 等待的总秒数
+        """
+        if rate <= 0 or amount <= 0:
+            return 0
+
+        waited = 0
+        conn = self._connect()
+        try:
+            while True:
+                wait = self._take(conn, key, rate, capacity, amount, allow_wait=True)
+                if wait <= 0:
+                    return waited
+
+                time.sleep(wait)
+                waited += wait
+        finally:
+            conn.close()
+
+    def consume(self, key, rate, capacity, amount):
+        """扣减令牌但不等待, 用于请求结束后按实际用量补扣 (例如输出的token数)."""
+        if rate <= 0 or amount <= 0:
+            return
+
+        conn = self._connect()
+        try:
+            self._take(conn, key, rate, capacity, amount, allow_wait=False)
+        finally:
+            conn.close()
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+def get_rate_limiter():
+    # 按数据库路径缓存, STORAGE_BASE_DIR改变 (config.reload) 后使用新的数据库
+    db_path = os.path.join(config.get('STORAGE_BASE_DIR'), 'llm_state', 'ratelimit.db')
+    with _rate_limiters_lock:
+        if db_path not in _rate_limiters:
+            _rate_limiters[db_path] = RateLimiter(db_path)
+
+        return _rate_limiters[db_path]
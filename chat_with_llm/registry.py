@@ -0,0 +1,166 @@
+"""
+models.yaml中模型的注册表.
+
+ModelRegistry在创建时建立所有索引 (alias, 显示名, 保存名, 原始配置), 查找都是O(1); 通配符的匹配结果按pattern缓存.
+get_registry()返回当前的注册表, 并在models.yaml修改后自动重新加载 (每RELOAD_CHECK_INTERVAL秒最多检查一次mtime),
+长时间运行的进程不需要重启即可使用新的模型配置. 新配置解析失败时继续使用旧的注册表, 直到文件再次修改.
+"""
+
+import fnmatch
+import os
+import random
+import re
+import threading
+import time
+
+from chat_with_llm import config
+
+__all__ = ['ModelRegistry', 'get_registry', 'save_name']
+
+RELOAD_CHECK_INTERVAL = 1.0
+
+def save_name(model_id):
+    """用于文件名的模型名"""
+    return model_id.replace("/", "_").replace(":", "_")
+
+class ModelRegistry:
+    """
+    params:
+        model_configs: models.yaml的内容, 每个模型一个dict
+
+    索引:
+        display_names: model_id -> 显示名 (所有模型, 含disabled)
+        aliases: alias -> model_id (仅enabled模型)
+        delays: model_id -> delay秒数 (-1表示disabled)
+        configs: model_id -> 原始配置
+        save_names: 保存名 -> model_id
+        enabled: 所有enabled模型, 按models.yaml中的顺序
+    """
+    def __init__(self, model_configs):
+        self.display_names = {}
+        self.aliases = {}
+        self.delays = {}
+        self.configs = {}
+        self.save_names = {}
+
+        for data in model_configs:
+            model_id = data.get('name')
+            alias = data.get('alias')
+            display = data.get('display')
+            delay = float(data.get('delay', 0))
+            disabled = data.get('disabled', False)
+
+            self.configs[model_id] = data
+            self.save_names.setdefault(save_name(model_id), model_id)
+
+            # 显示名的最低优先级
+            self.display_names[model_id] = model_id
+
+            if isinstance(alias, str):
+                alias = [alias]
+
+            if alias:
+                self.display_names[model_id] = alias[0]
+
+                if not disabled:
+                    for a in alias:
+                        if a in self.aliases:
+                            print(f'Warning: alias {a} already exists, overwriting with {model_id}')
+
+                        self.aliases[a] = model_id
+
+            if display:
+                self.display_names[model_id] = display
+
+            # 用delay=-1标识被禁用的模型
+            self.delays[model_id] = -1 if disabled else delay
+
+        self.enabled = [m for m, delay in self.delays.items() if delay != -1]
+
+        self._patterns = {}
+        self._patterns_lock = threading.Lock()
+
+    def match(self, pattern):
+        """返回匹配通配符pattern的enabled模型. 编译后的pattern和匹配结果都会缓存"""
+        models = self._patterns.get(pattern)
+        if models is None:
+            regex = re.compile(fnmatch.translate(pattern))
+            models = tuple(m for m in self.enabled if regex.match(m))
+            with self._patterns_lock:
+                self._patterns[pattern] = models
+
+        return models
+
+    def resolve(self, model_id_or_alias, fail_on_unknown=True):
+        if model_id_or_alias == 'random':
+            model = random.choice(self.enabled)
+        elif '*' in model_id_or_alias:
+            models = self.match(model_id_or_alias)
+            if len(models) == 0:
+                raise ValueError(f'No model found for {model_id_or_alias}')
+
+            model = random.choice(models)
+        else:
+            model = self.aliases.get(model_id_or_alias, model_id_or_alias)
+
+        delay = self.delays.get(model)
+        if delay is None and fail_on_unknown:
+            raise ValueError(f'Unknown model name {model_id_or_alias}')
+        if delay == -1:
+            raise ValueError(f'Model {model} is disabled')
+
+        return model
+
+_registry = None
+_registry_mtime = None
+_registry_version = None
+_last_check = 0
+_registry_lock = threading.Lock()
+
+def _models_config_mtime():
+    try:
+        return os.stat(config.get_models_config_path()).st_mtime_ns
+    except OSError:
+        return None
+
+def get_registry():
+    global _registry, _registry_mtime, _registry_version, _last_check
+
+    now = time.monotonic()
+    if (_registry is not None and config.get_models_version() == _registry_version
+            and now - _last_check < RELOAD_CHECK_INTERVAL):
+        return _registry
+
+    with _registry_lock:
+        version = config.get_models_version()
+        if _registry is not None and version == _registry_version and now - _last_check < RELOAD_CHECK_INTERVAL:
+            return _registry
+
+        _last_check = now
+        if _registry is None or version != _registry_version:
+            # 第一次使用, 或者调用了config.reload_models()/reload() (例如配置目录改变)
+            _registry = ModelRegistry(config.get_model_configs())
+            _registry_mtime = _models_config_mtime()
+            _registry_version = version
+            return _registry
+
+        mtime = _models_config_mtime()
+        if mtime == _registry_mtime:
+            return _registry
+
+        try:
+            config.reload_models()
+            registry = ModelRegistry(config.get_model_configs())
+        except Exception as ex:
+            # 格式错误时保留旧配置, 文件再次修改后重试
+            print(f'Warning: failed to reload models.yaml, keep using the old config: {ex}')
+            _registry_mtime = mtime
+            _registry_version = config.get_models_version()
+            return _registry
+
+        print('models.yaml changed, model registry reloaded')
+        _registry = registry
+        _registry_mtime = mtime
+        _registry_version = config.get_models_version()
+
+    return _registry
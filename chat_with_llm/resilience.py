@@ -0,0 +1,214 @@
+"""
+LLM调用的容错: 带抖动的指数退避, Retry-After, 按模型的熔断器, 以及备用模型链.
+
+典型用法:
+
+    plan = resilience.FailoverPlan([model_id, backup_model_id], retries=2)
+    for model in plan:
+        try:
+            result = call(model)
+        except openai.OpenAIError as ex:
+            plan.record_failure(model, ex)
+            continue
+
+        plan.record_success(model)
+        break
+
+所有模型都失败时, 迭代plan会抛出最后一次的异常.
+"""
+
+import email.utils
+import random
+import threading
+import time
+
+import openai
+
+__all__ = ['CircuitOpenError', 'CircuitBreaker', 'FailoverPlan',
+           'get_circuit_breaker', 'is_retryable', 'retry_delay', 'get_retry_after']
+
+class CircuitOpenError(openai.OpenAIError):
+    """模型的熔断器处于打开状态, 请求未发出"""
+    def __init__(self, model_id, retry_in):
+        super().__init__(f'Circuit breaker for {model_id} is open, retry in {retry_in:.0f}s')
+        self.model_id = model_id
+        self.retry_in = retry_in
+
+class CircuitBreaker:
+    """
+    熔断器. 连续failure_threshold次可重试类错误(限流, 5xx, 连接失败)后打开,
+    recovery_time秒内直接拒绝请求; 之后放行一个探测请求(half-open), 成功则关闭, 失败则重新打开.
+    探测请求遇到不可重试的错误(参数错误, 上下文超长等)或被取消时调用release, 不改变状态, 下一个请求重新探测.
+    """
+    def __init__(self, failure_threshold=3, recovery_time=60):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+
+            if time.time() - self.opened_at < self.recovery_time or self.probing:
+                return False
+
+            # half-open: 只放行一个探测请求
+            self.probing = True
+            return True
+
+    def retry_in(self):
+        if self.opened_at is None:
+            return 0
+        return max(0, self.opened_at + self.recovery_time - time.time())
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def release(self):
+        """结束探测但不记录结果. 不释放时allow()会一直拒绝"""
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+            self.probing = False
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+def get_circuit_breaker(model_id):
+    with _circuit_breakers_lock:
+        if model_id not in _circuit_breakers:
+            _circuit_breakers[model_id] = CircuitBreaker()
+
+        return _circuit_breakers[model_id]
+
+def is_retryable(ex):
+    # 参数错误, 鉴权失败等重试也不会成功
+    if isinstance(ex, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+
+    if isinstance(ex, openai.APIStatusError):
+        return ex.status_code in (408, 409, 429) or ex.status_code >= 500
+
+    return False
+
+def get_retry_after(ex):
+    """从异常的响应头中读取Retry-After (秒). 没有时返回None"""
+    response = getattr(ex, 'response', None)
+    if response is None:
+        return None
+
+    headers = response.headers
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+
+    # 也可能是HTTP日期格式
+    try:
+        retry_time = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0, retry_time.timestamp() - time.time())
+
+def retry_delay(ex, attempt, base=1.0, cap=60.0):
+    """第attempt次(从0开始)重试前需要等待的秒数. 优先使用Retry-After, 否则指数退避加抖动"""
+    retry_after = get_retry_after(ex)
+    if retry_after is not None:
+        return retry_after + random.uniform(0, 0.5)
+
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class FailoverPlan:
+    """
+    按顺序尝试model_chain中的模型. 每个模型最多重试retries次, 熔断器打开的模型直接跳过.
+    有备用模型时, 如果需要等待超过max_wait秒(例如Retry-After很长)则不再等待, 直接切换.
+    """
+    def __init__(self, model_chain, retries=0, max_wait=10.0):
+        self.model_chain = model_chain
+        self.retries = retries
+        self.max_wait = max_wait
+
+        self.last_error = None
+        self._failed = False
+
+    def __iter__(self):
+        for ind, model_id in enumerate(self.model_chain):
+            has_next = ind + 1 < len(self.model_chain)
+            breaker = get_circuit_breaker(model_id)
+
+            attempt = 0
+            while True:
+                if not breaker.allow():
+                    if self.last_error is None:
+                        self.last_error = CircuitOpenError(model_id, breaker.retry_in())
+                    break
+
+                self._failed = False
+                yield model_id
+
+                if not self._failed:
+                    return
+
+                ex = self.last_error
+                if not is_retryable(ex) or attempt >= self.retries:
+                    break
+
+                delay = retry_delay(ex, attempt)
+                if has_next and delay > self.max_wait:
+                    break
+
+                print(f'openai api failed, retrying in {delay:.1f}s...')
+                time.sleep(delay)
+                attempt += 1
+
+            if has_next:
+                print(f'{model_id} is unavailable, fail over to {self.model_chain[ind + 1]}')
+
+        raise self.last_error
+
+    def record_failure(self, model_id, ex):
+        self._failed = True
+        self.last_error = ex
+        if is_retryable(ex):
+            get_circuit_breaker(model_id).record_failure()
+        else:
+            # 模型可以访问, 只是这个请求本身有问题, 不计入熔断
+            get_circuit_breaker(model_id).release()
+
+    def record_lost(self, model_id, ex=None):
+        """
+        对冲请求中输掉的模型. 请求失败(ex)且可重试时计入熔断; 被取消时没有结果, 只释放可能持有的探测名额.
+        已经有了胜出的结果, 不影响重试和切换
+        """
+        if ex is not None and is_retryable(ex):
+            get_circuit_breaker(model_id).record_failure()
+        else:
+            get_circuit_breaker(model_id).release()
+
+    def record_success(self, model_id):
+        get_circuit_breaker(model_id).record_success()
@@ -0,0 +1,180 @@
+"""
+相同请求的合并 (single-flight).
+
+同时发出的相同请求只有第一个真正执行, 其他的等待并共享它的结果:
+    - 进程内: 等待第一个请求的Future
+    - 跨进程: {STORAGE_BASE_DIR}/llm_state/singleflight.db 中的一行作为锁, 执行完成后写入结果,
+      其他进程轮询读取. 结果只给执行期间已经在等待的调用, 之后才发出的相同请求重新执行;
+      结果保留RESULT_TTL秒 (足够等待的进程轮询到), 之后删除
+第一个请求失败时, 同一进程内等待的调用收到同样的异常; 其他进程中等待的调用自己重新执行.
+持有锁的进程退出(崩溃)或超过LOCK_TTL秒没有完成时, 锁失效.
+
+    result, shared = singleflight.get_single_flight().do(key, lambda: call())
+"""
+
+import json
+import os
+import os.path
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from chat_with_llm import config
+
+__all__ = ['SingleFlight', 'get_single_flight']
+
+# 需要大于等待的进程的轮询间隔
+RESULT_TTL = 5
+LOCK_TTL = 3600
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+class SingleFlight:
+    """
+    params:
+        db_path: sqlite数据库路径. 同一路径的SingleFlight(包括其他进程中的)合并相同的请求
+        poll_interval: 等待其他进程时查询结果的间隔(秒)
+    """
+    def __init__(self, db_path, poll_interval=0.5):
+        self.db_path = db_path
+        self.poll_interval = poll_interval
+
+        self._futures = {}
+        self._lock = threading.Lock()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS flights '
+                '(key TEXT PRIMARY KEY, pid INTEGER, started REAL, finished REAL, result TEXT)'
+            )
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # sqlite连接不能跨线程共享, 每次调用单独建立连接. isolation_level=None以便手动控制事务
+        return sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+
+    def do(self, key, func):
+        """
+        执行func, 或者等待正在执行的相同key的调用.
+        returns: (结果, 是否共享了其他调用的结果). 跨进程共享的结果经过JSON序列化 (tuple变为list)
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._futures[key] = future
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            result, shared = self._do_across_processes(key, func)
+            future.set_result(result)
+            return result, shared
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        finally:
+            with self._lock:
+                del self._futures[key]
+
+    def _do_across_processes(self, key, func):
+        waited = False
+        while True:
+            try:
+                state, result = self._try_acquire(key, waited)
+            except sqlite3.Error as ex:
+                print(f'Warning: single-flight lock failed, running without it: {ex}')
+                return func(), False
+
+            if state == 'leader':
+                break
+            if state == 'done':
+                return json.loads(result), True
+
+            waited = True
+            time.sleep(self.poll_interval)
+
+        try:
+            result = func()
+        except BaseException:
+            self._finish(key, failed=True)
+            raise
+
+        self._finish(key, result)
+        return result, False
+
+    def _try_acquire(self, key, waited=False):
+        """
+        waited: 是否已经在等待其他进程. 没有等待过的调用不使用已经完成的结果, 与之前的调用不重叠
+        returns: ('leader', None) 获得锁; ('done', 结果json) 已有结果; ('wait', None) 其他进程正在执行
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM flights WHERE finished < ? OR (finished IS NULL AND started < ?)',
+                             (now - RESULT_TTL, now - LOCK_TTL))
+
+                row = conn.execute('SELECT pid, finished, result FROM flights WHERE key = ?', (key,)).fetchone()
+                if row is not None and row[1] is not None and waited:
+                    state = 'done'
+                elif row is not None and row[1] is None and _pid_alive(row[0]):
+                    state = 'wait'
+                else:
+                    conn.execute('INSERT OR REPLACE INTO flights (key, pid, started) VALUES (?, ?, ?)',
+                                 (key, os.getpid(), now))
+                    state = 'leader'
+
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+
+        return state, row[2] if state == 'done' else None
+
+    def _finish(self, key, result=None, failed=False):
+        """写入结果. 执行失败时删除锁, 等待的进程自己重新执行"""
+        try:
+            conn = self._connect()
+            try:
+                if failed:
+                    conn.execute('DELETE FROM flights WHERE key = ? AND pid = ?', (key, os.getpid()))
+                else:
+                    conn.execute('UPDATE flights SET finished = ?, result = ? WHERE key = ? AND pid = ?',
+                                 (time.time(), json.dumps(result), key, os.getpid()))
+            finally:
+                conn.close()
+        except sqlite3.Error as ex:
+            print(f'Warning: failed to release single-flight lock: {ex}')
+
+_single_flights = {}
+_single_flights_lock = threading.Lock()
+def get_single_flight():
+    # 按数据库路径缓存, STORAGE_BASE_DIR改变 (config.reload) 后使用新的数据库, 与同样配置的其他进程合并
+    db_path = os.path.join(config.get('STORAGE_BASE_DIR'), 'llm_state', 'singleflight.db')
+    with _single_flights_lock:
+        if db_path not in _single_flights:
+            _single_flights[db_path] = SingleFlight(db_path)
+
+        return _single_flights[db_path]
@@ -245,8 +245,10 @@ class ContentStorage_Combined(StorageBase):
         self.sqlite_storage.close()
 
 def get_storage(storage_type, identifier, storage_class='file', readonly=False):
-    storage_base = config.get('STORAGE_BASE_DIR')
-    assert storage_type in ['chat_history', 'web_cache', 'subtitle_cache', 'video_summary', 'browser_state'], f'Unknown storage type: {storage_type}'
+    storage_base = config.snapshot().storage_base_dir
+    if not storage_base:
+        raise config.ConfigNotFoundError('Config key STORAGE_BASE_DIR not found in config.yaml')
+    assert storage_type in ['chat_history', 'web_cache', 'subtitle_cache', 'video_summary', 'browser_state', 'llm_cache', 'llm_batches'], f'Unknown storage type: {storage_type}'
 
     if storage_class == 'file':
         return ContentStorage_File(os.path.join(storage_base, storage_type), identifier, readonly)
@@ -0,0 +1,175 @@
+"""
+token数估计和上下文窗口预算.
+
+安装了tiktoken时使用o200k_base编码计数; 否则按字符类别估计 (中日韩字符与其他字符的token密度差别很大).
+不同模型的分词器不同, 两种方式都只是估计值. 每次调用结束后用usage中的prompt_tokens校准,
+校准系数按模型保存在 {STORAGE_BASE_DIR}/llm_state/token_calibration.db, 多个进程共享.
+"""
+
+import os.path
+import re
+import sqlite3
+import threading
+import time
+
+from chat_with_llm import config
+
+__all__ = ['ContextOverflowError', 'count_tokens', 'estimate_tokens', 'truncate_to_tokens',
+           'record_actual_tokens', 'get_calibration', 'CalibrationStore', 'get_calibration_store']
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 不使用tiktoken时的估计: 中日韩字符每个约0.7个token, 其他字符约4个一个token
+CJK_TOKENS_PER_CHAR = 0.7
+OTHER_TOKENS_PER_CHAR = 0.25
+
+_cjk_re = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+class ContextOverflowError(ValueError):
+    """请求的token数超过模型的上下文窗口"""
+    def __init__(self, model_id, tokens, limit):
+        super().__init__(f'Request to {model_id} needs ~{tokens} tokens, exceeding the limit of {limit}')
+        self.model_id = model_id
+        self.tokens = tokens
+        self.limit = limit
+
+_encoding = None
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        _encoding = tiktoken.get_encoding('o200k_base')
+
+    return _encoding
+
+def count_tokens(text):
+    """未校准的token数"""
+    if not text:
+        return 0
+
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    cjk = len(_cjk_re.findall(text))
+    return int(cjk * CJK_TOKENS_PER_CHAR + (len(text) - cjk) * OTHER_TOKENS_PER_CHAR) + 1
+
+def estimate_tokens(text, model_id=None):
+    """按模型校准后的token数估计"""
+    return int(count_tokens(text) * get_calibration(model_id)) + 1
+
+def truncate_to_tokens(text, max_tokens, model_id=None):
+    """截断text使其估计token数不超过max_tokens. 保留开头部分"""
+    tokens = estimate_tokens(text, model_id)
+    while tokens > max_tokens and text:
+        # 按比例截断, 留一点余量以减少循环次数
+        text = text[:int(len(text) * max_tokens / tokens * 0.95)]
+        tokens = estimate_tokens(text, model_id)
+
+    return text
+
+class CalibrationStore:
+    """
+    按模型保存的校准系数.
+    更新在一个 BEGIN IMMEDIATE 事务内读取当前值并按滑动平均写回, 多个进程同时更新时不会互相覆盖.
+    读取在内存中缓存cache_ttl秒 (estimate_tokens调用很频繁), 本进程的更新立即生效.
+    params:
+        db_path: sqlite数据库路径
+    """
+    def __init__(self, db_path, cache_ttl=60):
+        self.db_path = db_path
+        self.cache_ttl = cache_ttl
+
+        self._cache = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS calibration '
+                '(model TEXT PRIMARY KEY, factor REAL, updated REAL)'
+            )
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # sqlite连接不能跨线程共享, 每次调用单独建立连接. isolation_level=None以便手动控制事务
+        return sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+
+    def get(self, model_id):
+        with self._lock:
+            if self._cache is None or time.monotonic() - self._loaded_at >= self.cache_ttl:
+                try:
+                    conn = self._connect()
+                    try:
+                        self._cache = dict(conn.execute('SELECT model, factor FROM calibration').fetchall())
+                    finally:
+                        conn.close()
+                except sqlite3.Error as ex:
+                    print(f'Warning: failed to load token calibration: {ex}')
+                    self._cache = self._cache or {}
+                self._loaded_at = time.monotonic()
+
+            return self._cache.get(model_id, 1.0)
+
+    def update(self, model_id, ratio, weight):
+        """按滑动平均更新校准系数, 返回新的系数"""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT factor FROM calibration WHERE model = ?', (model_id,)).fetchone()
+                factor = row[0] * (1 - weight) + ratio * weight if row else ratio
+                conn.execute('INSERT OR REPLACE INTO calibration (model, factor, updated) VALUES (?, ?, ?)',
+                             (model_id, factor, time.time()))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+
+        with self._lock:
+            if self._cache is not None:
+                self._cache[model_id] = factor
+
+        return factor
+
+_calibration_stores = {}
+_calibration_stores_lock = threading.Lock()
+def get_calibration_store():
+    # 按数据库路径缓存, STORAGE_BASE_DIR改变 (config.reload) 后使用新的数据库
+    db_path = os.path.join(config.get('STORAGE_BASE_DIR'), 'llm_state', 'token_calibration.db')
+    with _calibration_stores_lock:
+        if db_path not in _calibration_stores:
+            _calibration_stores[db_path] = CalibrationStore(db_path)
+
+        return _calibration_stores[db_path]
+
+def get_calibration(model_id):
+    if model_id is None:
+        return 1.0
+
+    return get_calibration_store().get(model_id)
+
+def record_actual_tokens(model_id, estimated, actual, weight=0.2):
+    """用上游返回的实际token数更新模型的校准系数 (指数滑动平均). 写入失败只打印警告"""
+    if not model_id or not estimated or not actual:
+        return
+
+    store = get_calibration_store()
+    ratio = actual / (estimated / store.get(model_id))
+    # 限制单次校准的范围, 避免上游异常的usage导致估计失真
+    ratio = min(4.0, max(0.25, ratio))
+    try:
+        store.update(model_id, ratio, weight)
+    except sqlite3.Error as ex:
+        print(f'Warning: failed to record token calibration: {ex}')
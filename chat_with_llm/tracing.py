@@ -0,0 +1,140 @@
+"""
+Langfuse追踪.
+
+langfuse的导入耗时较长 (约0.4秒), 因此延迟到第一次需要记录时才导入; 未配置LANGFUSE_PUBLIC_KEY时不导入,
+也不记录任何追踪数据.
+
+追踪不在调用路径上阻塞:
+    - 按TRACING_SAMPLE_RATE采样, TRACING_USE_CASES (逗号分隔, 为空表示全部) 限制记录的use_case.
+      未被采样的调用返回空的Generation, 不创建任何span
+    - 被采样的调用只在内存中创建span, 由后台线程按TRACING_BATCH_SIZE条或每TRACING_FLUSH_INTERVAL秒批量上传.
+      队列最多TRACING_QUEUE_SIZE条, 上传跟不上时丢弃新的span, 不会拖慢LLM调用
+"""
+
+import os
+import random
+import threading
+
+from chat_with_llm import config
+
+__all__ = ['is_enabled', 'should_trace', 'start_generation', 'flush', 'shutdown']
+
+# None: 尚未初始化; False: 未启用
+_client = None
+_use_cases = None
+_lock = threading.Lock()
+
+def _get_client():
+    global _client, _use_cases
+    if _client is not None:
+        return _client or None
+
+    with _lock:
+        if _client is None:
+            settings = config.snapshot()
+            if settings.langfuse_public_key:
+                # langfuse从环境变量读取LANGFUSE_*配置, 队列大小只能通过OTEL_BSP_MAX_QUEUE_SIZE设置
+                config.set_environ()
+                os.environ.setdefault('OTEL_BSP_MAX_QUEUE_SIZE', str(settings.tracing_queue_size))
+
+                import langfuse
+                _client = langfuse.Langfuse(flush_at=settings.tracing_batch_size,
+                                            flush_interval=settings.tracing_flush_interval)
+            else:
+                _client = False
+
+            use_cases = settings.tracing_use_cases
+            _use_cases = {u.strip() for u in use_cases.split(',') if u.strip()} if use_cases else None
+
+    return _client or None
+
+def is_enabled():
+    return _get_client() is not None
+
+def should_trace(use_case):
+    """是否记录这次调用: 已启用, use_case在TRACING_USE_CASES中, 且被采样"""
+    if not is_enabled():
+        return False
+    if _use_cases is not None and use_case not in _use_cases:
+        return False
+
+    return random.random() < config.snapshot().tracing_sample_rate
+
+class Generation:
+    """一次LLM调用的追踪记录, end()之后才会进入上传队列"""
+    def __init__(self, observation):
+        self._observation = observation
+
+    def end(self, model=None, output=None, reasoning=None, stats=None, error=None):
+        """
+        params:
+            model: 实际响应的模型
+            output: 响应内容
+            reasoning: 推理内容
+            stats: chat_impl/ChatStream的stats, token数写入usage_details, 其余写入metadata
+            error: 调用失败时的异常
+        """
+        update = {}
+        if model:
+            update['model'] = model
+        if output is not None or reasoning:
+            update['output'] = {'content': output, 'reasoning': reasoning} if reasoning else output
+        if stats:
+            update['metadata'] = stats
+            update['usage_details'] = _usage_details(stats)
+        if error is not None:
+            update['level'] = 'ERROR'
+            update['status_message'] = str(error)
+
+        try:
+            self._observation.update(**update)
+            self._observation.end()
+        except Exception as ex:
+            print(f'Warning: failed to record trace: {ex}')
+
+class _NullGeneration:
+    def end(self, *args, **kwargs):
+        pass
+
+_NULL_GENERATION = _NullGeneration()
+
+def _usage_details(stats):
+    # 与langfuse.openai记录的字段名一致
+    usage = {}
+    for stats_key, usage_key in [('prompt_tokens', 'input'),
+                                 ('completion_tokens', 'output'),
+                                 ('cached_tokens', 'input_cached_tokens'),
+                                 ('reasoning_tokens', 'output_reasoning_tokens')]:
+        if stats.get(stats_key) is not None:
+            usage[usage_key] = stats[stats_key]
+
+    return usage
+
+def start_generation(use_case, model, prompt, contents, name='chat'):
+    """开始记录一次LLM调用. 未启用或未被采样时返回什么都不做的Generation"""
+    if not should_trace(use_case):
+        return _NULL_GENERATION
+
+    try:
+        observation = _client.start_observation(name=name, as_type='generation', model=model,
+                                                input={'prompt': prompt, 'contents': contents},
+                                                metadata={'use_case': use_case})
+    except Exception as ex:
+        print(f'Warning: failed to record trace: {ex}')
+        return _NULL_GENERATION
+
+    return Generation(observation)
+
+def flush():
+    """等待队列中的追踪数据上传完成. 短时间运行的脚本退出前调用"""
+    client = _get_client()
+    if client is not None:
+        client.flush()
+
+def shutdown():
+    """上传剩余数据并关闭后台线程, 之后的调用重新初始化"""
+    global _client
+    with _lock:
+        if _client:
+            _client.shutdown()
+        _client = None
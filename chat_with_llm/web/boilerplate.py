@@ -0,0 +1,183 @@
+"""
+按网站统计的行频率模型, 用于去除样板内容 (导航, 页脚, 订阅提示等).
+
+每个网站 (web.utils.url_to_site) 的每一行 (去掉首尾空白, 用64位hash表示) 记录出现过的页面数, 按half_life指数衰减.
+同一网站衰减后的页面数不少于threshold的行视为样板. 统计保存在 {STORAGE_BASE_DIR}/llm_state/boilerplate.db 中,
+跨多次运行和多个进程累积, 因此只有一篇文章时也可以去除样板.
+
+    model = boilerplate.get_line_model()
+    model.add_page(url, contents)        # 缓存新页面时 (OnlineContent的learn_boilerplate参数)
+    contents = model.strip(url, contents)
+
+同一个URL在max_age内只统计一次, 重新抓取同一页面不会使其中的正文变成样板.
+"""
+
+import hashlib
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+from chat_with_llm import config
+from chat_with_llm.web import utils as web_utils
+
+__all__ = ['LineModel', 'get_line_model', 'line_hash']
+
+DAY = 86400
+
+def line_hash(line):
+    """行的64位hash (sqlite的INTEGER), 忽略首尾空白. 空行返回None"""
+    line = line.strip()
+    if not line:
+        return None
+
+    return int.from_bytes(hashlib.blake2b(line.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+class LineModel:
+    """
+    params:
+        db_path: sqlite数据库路径
+        threshold: 衰减后的页面数不少于threshold的行是样板
+        half_life: 页面数衰减一半的秒数 (默认30天)
+        max_age: 超过这个秒数没有再出现的行和页面记录被删除 (默认half_life的8倍, 此时页面数已衰减到1/256)
+        cache_ttl: 每个网站的样板hash集合在内存中缓存的秒数. 本进程add_page后立即失效
+    """
+    def __init__(self, db_path, threshold=3, half_life=30 * DAY, max_age=None, cache_ttl=60):
+        self.db_path = db_path
+        self.threshold = float(threshold)
+        # 几乎同时出现的页面衰减后的页面数略小于整数, 比较时留一点余量
+        self._min_score = self.threshold - 1e-3
+        self.half_life = float(half_life)
+        self.max_age = float(max_age) if max_age else self.half_life * 8
+        self.cache_ttl = cache_ttl
+
+        self._cache = {}
+        self._lock = threading.Lock()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS lines '
+                '(site TEXT, hash INTEGER, score REAL, updated REAL, PRIMARY KEY (site, hash))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS pages '
+                '(site TEXT, page INTEGER, updated REAL, PRIMARY KEY (site, page))'
+            )
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # sqlite连接不能跨线程共享, 每次调用单独建立连接. isolation_level=None以便手动控制事务
+        return sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+
+    def _decay(self, score, updated, now):
+        return score * 0.5 ** (max(0.0, now - updated) / self.half_life)
+
+    def add_page(self, url, contents, now=None):
+        """
+        统计一个页面中的行, 每行在一个页面中只计一次.
+        returns: 是否统计了. 同一URL在max_age内已经统计过时返回False
+        """
+        now = time.time() if now is None else now
+        site = web_utils.url_to_site(url)
+        hashes = {h for h in map(line_hash, contents.split('\n')) if h is not None}
+        page = line_hash(url)
+
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM lines WHERE site = ? AND updated < ?', (site, now - self.max_age))
+                conn.execute('DELETE FROM pages WHERE site = ? AND updated < ?', (site, now - self.max_age))
+
+                if conn.execute('SELECT 1 FROM pages WHERE site = ? AND page = ?', (site, page)).fetchone():
+                    conn.execute('COMMIT')
+                    return False
+
+                conn.execute('INSERT INTO pages (site, page, updated) VALUES (?, ?, ?)', (site, page, now))
+
+                existing = {}
+                hash_list = list(hashes)
+                # sqlite的参数个数有上限, 分批查询
+                for i in range(0, len(hash_list), 500):
+                    chunk = hash_list[i:i + 500]
+                    rows = conn.execute(
+                        f'SELECT hash, score, updated FROM lines WHERE site = ? AND hash IN ({",".join("?" * len(chunk))})',
+                        [site] + chunk).fetchall()
+                    existing.update((h, (score, updated)) for h, score, updated in rows)
+
+                conn.executemany(
+                    'INSERT OR REPLACE INTO lines (site, hash, score, updated) VALUES (?, ?, ?, ?)',
+                    [(site, h, self._decay(*existing[h], now) + 1 if h in existing else 1.0, now) for h in hash_list])
+
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._cache.pop(site, None)
+
+        return True
+
+    def boilerplate_hashes(self, site, now=None):
+        """网站site的样板行的hash集合"""
+        with self._lock:
+            cached = self._cache.get(site)
+            if cached is not None and now is None and time.monotonic() - cached[0] < self.cache_ttl:
+                return cached[1]
+
+        t = time.time() if now is None else now
+        conn = self._connect()
+        try:
+            # 衰减只会使页面数变小, 先用没有衰减的页面数过滤
+            rows = conn.execute('SELECT hash, score, updated FROM lines WHERE site = ? AND score >= ?',
+                                (site, self._min_score)).fetchall()
+        finally:
+            conn.close()
+
+        hashes = frozenset(h for h, score, updated in rows if self._decay(score, updated, t) >= self._min_score)
+        if now is None:
+            with self._lock:
+                self._cache[site] = (time.monotonic(), hashes)
+
+        return hashes
+
+    def strip(self, url, contents, now=None):
+        """去掉contents中url所在网站的样板行, 并将三个以上的空行压缩为两个"""
+        hashes = self.boilerplate_hashes(web_utils.url_to_site(url), now=now)
+
+        lines = []
+        empty = 0
+        for line in contents.split('\n'):
+            if not line.strip():
+                empty += 1
+                if empty <= 2:
+                    lines.append('')
+            elif line_hash(line) not in hashes:
+                empty = 0
+                lines.append(line)
+
+        return '\n'.join(lines)
+
+_line_models = {}
+_line_models_lock = threading.Lock()
+def get_line_model(threshold=3):
+    """threshold: 衰减后的页面数不少于threshold的行是样板. 统计与threshold无关, 不同threshold共享同一个数据库"""
+    # 按数据库路径缓存, STORAGE_BASE_DIR改变 (config.reload) 后使用新的数据库
+    db_path = os.path.join(config.get('STORAGE_BASE_DIR'), 'llm_state', 'boilerplate.db')
+    key = (db_path, float(threshold))
+    with _line_models_lock:
+        if key not in _line_models:
+            _line_models[key] = LineModel(db_path, threshold=threshold)
+
+        return _line_models[key]
@@ -9,12 +9,12 @@ from lxml import etree
 
 from chat_with_llm import config
 from chat_with_llm import storage
+from chat_with_llm.web import canonical
 from chat_with_llm.web import online_content
 from chat_with_llm.web import utils as web_utils
-from chat_with_llm.web import linkseek
 
 # 利用LinkSeek服务爬取任意页面
-class Crawl4AI(online_content.OnlineContent):
+class Crawl4AI(online_content.AsyncOnlineContent):
     NAME = 'crawl4ai'
     DESCRIPTION = '通用爬取器'
 
@@ -41,12 +41,18 @@ class Crawl4AI(online_content.OnlineContent):
         self.opt_strip_boilerplate = str(params.get('strip_boilerplate', False)).lower() in ['true', '1', 'yes']
 
     def url2id(self, url):
-        parts = url.replace('https://', '').replace('http://', '').split('/')
+        return self.url_key(url) + '_' + self.time_tag()
+
+    def url_key(self, url):
+        """
+        site_id中不含时间标签的部分. url先经过canonical.canonicalize_url, 同一页面的不同写法
+        (http/https, www./m., 跟踪参数, fragment, 末尾的'/') 使用同一个缓存
+        """
+        url = canonical.canonicalize_url(url, host_aliases=True)
+        parts = url.replace('https://', '').split('/')
 
         domain = parts[0]
         domain_parts = domain.split('.')
-        if domain_parts[0] == 'www':
-            domain_parts = domain_parts[1:]
         if domain_parts[-1] == 'com':
             domain_parts = domain_parts[:-1]
 
@@ -54,12 +60,14 @@ class Crawl4AI(online_content.OnlineContent):
         path = '/'.join(parts[1:])
         path_hash = hashlib.md5(path.encode()).hexdigest()[:8]
 
+        return domain_reverse + '_' + path_hash
+
+    def time_tag(self):
+        # 按cache_expire小时划分的缓存周期, 进入新的周期后重新抓取
         delta = dt.datetime.now() - self.time_base
         hours = int(delta.total_seconds() / 3600) // self.cache_expire * self.cache_expire
         tag_time = self.time_base + dt.timedelta(hours=hours)
-        time_tag = tag_time.strftime('%Y%m%d%H')
-
-        return domain_reverse + '_' + path_hash + '_' + time_tag
+        return tag_time.strftime('%Y%m%d%H')
 
     def id2url(self, site_id):
         return None
@@ -67,6 +75,14 @@ class Crawl4AI(online_content.OnlineContent):
     def list(self, n):
         return []
 
+    def parser_config(self):
+        # parse()只用到这些属性, HNComments等子类的parse也可以在子进程中运行
+        return {
+            'opt_parser': self.opt_parser,
+            'opt_link_extractor': self.opt_link_extractor,
+            'opt_strip_boilerplate': self.opt_strip_boilerplate,
+        }
+
     def parse(self, url, raw):
         if self.opt_parser == 'markdown':
             return self.parse_as_markdown(url, raw)
@@ -125,7 +141,7 @@ class Crawl4AI(online_content.OnlineContent):
 
         return json.dumps(links, indent=4, ensure_ascii=False)
 
-    def fetch(self, url):
+    def crawl_params(self, url):
         if self.opt_parser == 'link_extractor':
             formats = ["html"]
         else:
@@ -133,10 +149,9 @@ class Crawl4AI(online_content.OnlineContent):
 
         proxy = None
         if self.opt_use_proxy:
-            proxy = config.get('LINKSEEK_PROXY', '') or None
+            proxy = config.snapshot().linkseek_proxy or None
 
-        return linkseek.crawl(
-            url=url,
+        return dict(
             formats=formats,
             use_browser=True,
             proxy=proxy,
@@ -0,0 +1,205 @@
+"""
+URL规范化, 用于生成缓存的key和判断网站.
+
+canonicalize_url把指向同一页面的不同写法变成同一个URL:
+    - scheme统一为https, 域名小写, 去掉默认端口和末尾的'.'
+    - 去掉fragment (#...) 和跟踪参数 (utm_*, fbclid等, 可以用配置URL_STRIP_PARAMS增加), 其余参数按名字排序
+    - 去掉路径末尾的'/' (根路径除外)
+    - host_aliases=True时去掉域名开头的www. / m. / mobile. (只用于缓存的key, 抓取仍使用原来的URL)
+
+registered_domain按public suffix list返回可注册的域名 (例如www.bbc.co.uk -> bbc.co.uk).
+默认使用内置的常见后缀; 配置PUBLIC_SUFFIX_LIST为 https://publicsuffix.org/list/public_suffix_list.dat
+的本地路径时使用完整的列表.
+"""
+
+import ipaddress
+import threading
+import urllib.parse
+
+from chat_with_llm import config
+
+__all__ = ['canonicalize_url', 'registered_domain', 'url_host', 'PublicSuffixTrie', 'get_public_suffixes',
+           'TRACKING_PARAMS']
+
+# 跟踪参数. 以'*'结尾的是前缀
+TRACKING_PARAMS = (
+    'utm_*', 'fbclid', 'gclid', 'gclsrc', 'dclid', 'msclkid', 'yclid', 'twclid', 'igshid', 'mc_cid', 'mc_eid',
+    '_ga', '_gl', '_hsenc', '_hsmi', 'mkt_tok', 'oly_anon_id', 'oly_enc_id', 'vero_id', 'wickedid',
+    'ref_src', 'ref_url', 'spm', 'scm', 'share_source', 'from_source', 'ncid', 'guccounter',
+)
+
+HOST_ALIASES = ('www.', 'm.', 'mobile.')
+
+# 内置的公共后缀: 常见的顶级域名和二级后缀
+BUILTIN_SUFFIXES = (
+    'com', 'org', 'net', 'edu', 'gov', 'mil', 'int', 'vip', 'app', 'dev', 'me', 'tv', 'co', 'io', 'ai', 'cc',
+    'info', 'biz', 'name', 'pro', 'top', 'xyz', 'site', 'online', 'store', 'news', 'blog', 'tech',
+    'cn', 'us', 'jp', 'uk', 'au', 'de', 'fr', 'ru', 'it', 'es', 'br', 'in', 'ca', 'kr', 'mx', 'nl', 'se', 'no',
+    'fi', 'dk', 'pl', 'tr', 'hu', 'cz', 'ro', 'gr', 'pt', 'il', 'ae', 'sa', 'hk', 'tw', 'sg', 'my', 'th', 'ph',
+    'vn', 'id', 'pk', 'bd', 'lk', 'np', 'kh', 'la', 'mm', 'mn', 'ch', 'at', 'be', 'ie', 'nz', 'za', 'eu',
+    'com.cn', 'net.cn', 'org.cn', 'gov.cn', 'edu.cn', 'ac.cn',
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk', 'me.uk',
+    'com.au', 'net.au', 'org.au', 'edu.au', 'gov.au',
+    'co.jp', 'ne.jp', 'or.jp', 'ac.jp', 'go.jp',
+    'co.kr', 'or.kr', 'ac.kr', 'go.kr',
+    'com.hk', 'org.hk', 'edu.hk', 'gov.hk', 'com.tw', 'org.tw', 'edu.tw', 'gov.tw',
+    'com.sg', 'edu.sg', 'gov.sg', 'com.my', 'co.th', 'co.id', 'com.vn', 'com.ph', 'com.pk', 'com.bd',
+    'co.in', 'net.in', 'org.in', 'com.br', 'com.mx', 'com.tr', 'com.sa', 'co.il', 'co.nz', 'co.za',
+    'github.io', 'gitlab.io', 'blogspot.com', 'substack.com', 'medium.com', 'herokuapp.com', 'vercel.app',
+    'netlify.app', 'pages.dev', 'workers.dev',
+)
+
+class PublicSuffixTrie:
+    """
+    public suffix list的规则编译成的trie, 按域名的label从后向前匹配.
+    支持列表的全部语法: 普通规则, 通配符 (*.ck) 和例外 (!www.ck). 没有匹配任何规则时后缀为最后一个label.
+    """
+    _EXCEPTION = '!'
+    _SUFFIX = '$'
+
+    def __init__(self, rules):
+        self.root = {}
+        for rule in rules:
+            rule = rule.strip().lower()
+            if not rule or rule.startswith('//'):
+                continue
+
+            # 列表中每行的第一个空白之后是注释
+            rule = rule.split()[0]
+            exception = rule.startswith('!')
+            node = self.root
+            for label in reversed(rule.lstrip('!').split('.')):
+                node = node.setdefault(label, {})
+            node[self._EXCEPTION if exception else self._SUFFIX] = True
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(f)
+
+    def suffix_length(self, labels):
+        """labels (从前向后的域名label) 中公共后缀的label数"""
+        length = 1
+        nodes = [(self.root, 0)]
+        # 通配符可能和普通规则同时匹配, 同时跟踪所有匹配的节点
+        while nodes:
+            next_nodes = []
+            for node, depth in nodes:
+                if depth:
+                    if node.get(self._EXCEPTION):
+                        # 例外规则: 后缀是规则去掉最左边的label
+                        return depth - 1
+                    if node.get(self._SUFFIX):
+                        length = max(length, depth)
+
+                if depth == len(labels):
+                    continue
+
+                label = labels[-1 - depth]
+                for key in (label, '*'):
+                    if key in node:
+                        next_nodes.append((node[key], depth + 1))
+            nodes = next_nodes
+
+        return length
+
+    def is_public_suffix(self, host):
+        labels = host.lower().rstrip('.').split('.')
+        return self.suffix_length(labels) >= len(labels)
+
+    def registered_domain(self, host):
+        """可注册的域名, 即公共后缀加上前面一个label. host本身是公共后缀或IP地址时返回host"""
+        host = host.lower().rstrip('.')
+        if not host or _is_ip(host):
+            return host
+
+        labels = host.split('.')
+        n = self.suffix_length(labels)
+        if n >= len(labels):
+            return host
+
+        return '.'.join(labels[-n - 1:])
+
+def _is_ip(host):
+    try:
+        ipaddress.ip_address(host.strip('[]'))
+        return True
+    except ValueError:
+        return False
+
+_suffixes = {}
+_suffixes_lock = threading.Lock()
+def get_public_suffixes():
+    """配置PUBLIC_SUFFIX_LIST时使用该文件, 否则使用BUILTIN_SUFFIXES. 按路径缓存"""
+    path = config.snapshot().public_suffix_list or None
+    with _suffixes_lock:
+        if path not in _suffixes:
+            try:
+                _suffixes[path] = PublicSuffixTrie.from_file(path) if path else PublicSuffixTrie(BUILTIN_SUFFIXES)
+            except OSError as e:
+                print(f'Warning: failed to load public suffix list {path}, using the builtin one: {e}')
+                _suffixes[path] = PublicSuffixTrie(BUILTIN_SUFFIXES)
+
+        return _suffixes[path]
+
+def url_host(url):
+    """url的域名 (小写, 不含端口). 没有scheme的url按域名开头处理"""
+    if '://' not in url:
+        url = 'https://' + url
+
+    return (urllib.parse.urlsplit(url).hostname or '').rstrip('.')
+
+def registered_domain(url_or_host):
+    return get_public_suffixes().registered_domain(url_host(url_or_host))
+
+def _strip_params():
+    extra = config.snapshot().url_strip_params
+    names = TRACKING_PARAMS + tuple(p.strip().lower() for p in (extra or '').split(',') if p.strip())
+    exact = frozenset(n for n in names if not n.endswith('*'))
+    prefixes = tuple(n[:-1] for n in names if n.endswith('*'))
+    return exact, prefixes
+
+def canonicalize_url(url, strip_params=None, host_aliases=False):
+    """
+    params:
+        strip_params: 要去掉的参数名 (以'*'结尾的是前缀), None时使用TRACKING_PARAMS和配置URL_STRIP_PARAMS
+        host_aliases: 去掉域名开头的www. / m. / mobile.
+    """
+    if strip_params is None:
+        exact, prefixes = _strip_params()
+    else:
+        exact = frozenset(p.lower() for p in strip_params if not p.endswith('*'))
+        prefixes = tuple(p[:-1].lower() for p in strip_params if p.endswith('*'))
+
+    parts = urllib.parse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    if scheme == 'http':
+        scheme = 'https'
+
+    host = (parts.hostname or '').rstrip('.')
+    if host_aliases:
+        for alias in HOST_ALIASES:
+            # 只去掉一个前缀, 且去掉后不能只剩公共后缀 (例如www.co.uk)
+            if host.startswith(alias) and not get_public_suffixes().is_public_suffix(host[len(alias):]):
+                host = host[len(alias):]
+                break
+
+    netloc = f'[{host}]' if ':' in host else host
+    if parts.port and parts.port not in (80, 443):
+        netloc += f':{parts.port}'
+    if parts.username:
+        netloc = parts.username + (f':{parts.password}' if parts.password else '') + '@' + netloc
+
+    path = parts.path or '/'
+    if len(path) > 1:
+        path = path.rstrip('/') or '/'
+
+    query = []
+    for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True):
+        lname = name.lower()
+        if lname in exact or lname.startswith(prefixes):
+            continue
+        query.append((name, value))
+    query.sort()
+
+    return urllib.parse.urlunsplit((scheme, netloc, path, urllib.parse.urlencode(query), ''))
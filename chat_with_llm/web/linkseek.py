@@ -1,19 +1,139 @@
+"""
+LinkSeek 爬虫服务的客户端.
+
+同步的crawl()使用模块级的requests.Session, 异步的AsyncClient使用httpx的连接池, 请求都复用到LinkSeek的连接.
+连接被重置和5xx错误按LINKSEEK_RETRIES重试, 间隔按LINKSEEK_BACKOFF指数增长. get_stats()返回连接复用的统计.
+
+crawl_batch()一次抓取多个URL: 服务支持批量接口时一个请求发送多个URL, 否则并发发送单个请求, 结果按完成顺序返回.
+"""
+
+import asyncio
+import json
+import queue
+import threading
+
+import httpx
 import requests
+import requests.adapters
+from urllib3 import connectionpool
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
 
 from chat_with_llm import config
 
+__all__ = ['get_base_url', 'crawl', 'async_crawl', 'crawl_batch', 'async_crawl_batch', 'AsyncClient', 'get_session',
+           'get_stats', 'reset_stats']
+
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# 服务不支持批量接口时的响应状态码
+BATCH_UNSUPPORTED_STATUSES = (404, 405, 501)
+
+# base_url -> 是否支持批量接口. 第一次批量请求后记录, 不支持的服务之后直接发送单个请求
+_batch_supported = {}
+
+class _BatchUnsupported(Exception):
+    pass
+
 def get_base_url():
-    return config.get('LINKSEEK_BASE_URL', 'http://localhost:8000')
+    return config.snapshot().linkseek_base_url
 
-def crawl(url, formats=None, use_browser=True, proxy=None, mobile=False, timeout=30):
-    """调用 LinkSeek API 爬取 URL.
+_stats = {'requests': 0, 'connections': 0, 'retries': 0}
+_stats_lock = threading.Lock()
 
-    Returns:
-        (final_url, metadata, raw_content) 或在失败时抛出异常
+def _count(key, n=1):
+    with _stats_lock:
+        _stats[key] += n
+
+def get_stats():
     """
-    if formats is None:
-        formats = ["html"]
+    发往LinkSeek的请求统计 (同步和异步合计):
+        requests: HTTP请求数 (包括重试), connections: 新建的连接数, retries: 重试次数,
+        reused: 复用已有连接的请求数, reuse_rate: reused / requests
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+
+    stats['reused'] = max(0, stats['requests'] - stats['connections'])
+    stats['reuse_rate'] = stats['reused'] / stats['requests'] if stats['requests'] else None
+    return stats
+
+def reset_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+class _CountingPoolMixin:
+    def _new_conn(self):
+        _count('connections')
+        return super()._new_conn()
+
+    def urlopen(self, *args, **kwargs):
+        # urllib3重试时再次调用urlopen, 每次尝试计一次请求
+        _count('requests')
+        return super().urlopen(*args, **kwargs)
 
+class _CountingHTTPConnectionPool(_CountingPoolMixin, connectionpool.HTTPConnectionPool):
+    pass
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, connectionpool.HTTPSConnectionPool):
+    pass
+
+class _Retry(Retry):
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        # 读超时说明LinkSeek在处理但太慢, 重试只会加倍等待时间
+        if isinstance(error, ReadTimeoutError):
+            raise error
+
+        retry = super().increment(method, url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+        _count('retries')
+        return retry
+
+class _Adapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool,
+        }
+
+_session = None
+_session_key = None
+_session_lock = threading.Lock()
+
+def get_session(pool_size=None):
+    """
+    返回复用连接的requests.Session. 连接池大小为pool_size和ONLINE_CONTENT_WORKERS中较大的一个;
+    需要更大的连接池或重试配置变化时重新创建
+    """
+    global _session, _session_key
+
+    settings = config.snapshot()
+    pool_size = max(pool_size or 0, settings.online_content_workers)
+    with _session_lock:
+        if _session is not None and _session_key[0] >= pool_size and _session_key[1:] == (
+                settings.linkseek_retries, settings.linkseek_backoff):
+            return _session
+
+        retries = _Retry(
+            total=settings.linkseek_retries,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['POST']),
+            backoff_factor=settings.linkseek_backoff,
+            raise_on_status=False,
+        )
+        adapter = _Adapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        # 旧的session可能正被其他线程使用, 不主动关闭
+        _session = session
+        _session_key = (pool_size, settings.linkseek_retries, settings.linkseek_backoff)
+
+    return _session
+
+def _build_payload(url, formats, use_browser, proxy, mobile, timeout):
     payload = {
         "url": url,
         "formats": formats,
@@ -27,29 +147,20 @@ def crawl(url, formats=None, use_browser=True, proxy=None, mobile=False, timeout
     if mobile:
         payload["mobile"] = True
 
-    base_url = get_base_url()
-    api_url = f"{base_url}/api/v1/crawl"
+    return payload
 
-    try:
-        response = requests.post(api_url, json=payload, timeout=timeout + 10)
-    except requests.ConnectionError:
+def _parse_response(url, formats, status_code, text, get_json):
+    """检查LinkSeek的响应, 返回(final_url, metadata, raw_content). get_json为解析响应JSON的函数"""
+    if status_code != 200:
         raise RuntimeError(
-            f'LinkSeek service unreachable at {base_url}. '
-            f'Check LINKSEEK_BASE_URL in config.yaml and ensure the service is running.'
-        )
-    except requests.Timeout:
-        raise RuntimeError(f'LinkSeek request timed out for {url} (timeout={timeout}s)')
-
-    if response.status_code != 200:
-        raise RuntimeError(
-            f'LinkSeek returned HTTP {response.status_code} for {url}: {response.text[:500]}'
+            f'LinkSeek returned HTTP {status_code} for {url}: {text[:500]}'
         )
 
     try:
-        data = response.json()
+        data = get_json()
     except ValueError:
         raise RuntimeError(
-            f'LinkSeek returned non-JSON response for {url}: {response.text[:500]}'
+            f'LinkSeek returned non-JSON response for {url}: {text[:500]}'
         )
 
     if not data.get("success"):
@@ -73,3 +184,249 @@ def crawl(url, formats=None, use_browser=True, proxy=None, mobile=False, timeout
         metadata["title"] = result["metadata"]["title"]
 
     return final_url, metadata, raw
+
+def crawl(url, formats=None, use_browser=True, proxy=None, mobile=False, timeout=30):
+    """调用 LinkSeek API 爬取 URL.
+
+    Returns:
+        (final_url, metadata, raw_content) 或在失败时抛出异常
+    """
+    if formats is None:
+        formats = ["html"]
+
+    payload = _build_payload(url, formats, use_browser, proxy, mobile, timeout)
+
+    base_url = get_base_url()
+    api_url = f"{base_url}/api/v1/crawl"
+
+    try:
+        response = get_session().post(api_url, json=payload, timeout=timeout + 10)
+    except requests.ConnectionError:
+        raise RuntimeError(
+            f'LinkSeek service unreachable at {base_url}. '
+            f'Check LINKSEEK_BASE_URL in config.yaml and ensure the service is running.'
+        )
+    except requests.Timeout:
+        raise RuntimeError(f'LinkSeek request timed out for {url} (timeout={timeout}s)')
+
+    return _parse_response(url, formats, response.status_code, response.text, response.json)
+
+class AsyncClient:
+    """
+    异步的 LinkSeek 客户端, 请求复用同一个连接池. 必须在事件循环中使用, 不能跨事件循环共享:
+
+        async with linkseek.AsyncClient(max_connections=4) as client:
+            final_url, metadata, raw = await client.crawl(url, formats=['markdown'])
+
+    params:
+        max_connections: 连接池大小, 也是同时发往 LinkSeek 的最大请求数
+        base_url: LinkSeek 服务地址, 默认使用配置中的 LINKSEEK_BASE_URL
+    """
+    def __init__(self, max_connections=4, base_url=None):
+        self.base_url = base_url or get_base_url()
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def crawl(self, url, formats=None, use_browser=True, proxy=None, mobile=False, timeout=30):
+        """
+        参数和返回值同 crawl(). 每次尝试 (包括等待连接池) 最多 timeout + 10 秒.
+        连接错误和5xx按LINKSEEK_RETRIES重试, 超时不重试
+        """
+        if formats is None:
+            formats = ["html"]
+
+        payload = _build_payload(url, formats, use_browser, proxy, mobile, timeout)
+        settings = config.snapshot()
+
+        for attempt in range(settings.linkseek_retries + 1):
+            if attempt > 0:
+                # 与urllib3的退避规则一致: 第一次重试不等待, 之后等待backoff * 2^(attempt - 1)秒
+                _count('retries')
+                if attempt > 1:
+                    await asyncio.sleep(settings.linkseek_backoff * 2 ** (attempt - 1))
+
+            _count('requests')
+            try:
+                response = await asyncio.wait_for(
+                    self._client.post("/api/v1/crawl", json=payload, timeout=timeout + 10,
+                                      extensions={"trace": _trace_connections}),
+                    timeout + 10)
+            except (httpx.TimeoutException, asyncio.TimeoutError):
+                raise RuntimeError(f'LinkSeek request timed out for {url} (timeout={timeout}s)')
+            except httpx.TransportError as ex:
+                if attempt < settings.linkseek_retries:
+                    continue
+                raise RuntimeError(
+                    f'LinkSeek service unreachable at {self.base_url} ({type(ex).__name__}). '
+                    f'Check LINKSEEK_BASE_URL in config.yaml and ensure the service is running.'
+                )
+
+            if response.status_code in RETRY_STATUSES and attempt < settings.linkseek_retries:
+                continue
+
+            return _parse_response(url, formats, response.status_code, response.text, response.json)
+
+    async def crawl_batch(self, urls, concurrency=4, max_batch=50, params=None, **kwargs):
+        """
+        抓取多个URL, 按完成顺序产生 (index, (final_url, metadata, raw_content), None) 或失败时的 (index, None, 异常).
+        params: 可选的函数url -> crawl()的参数dict, 用于每个URL参数不同的情况; 否则所有URL使用kwargs
+        concurrency: 服务端同时抓取的URL数
+
+        服务支持 POST /api/v1/crawl/batch 时, 每max_batch个URL发送一个请求, 服务端每完成一个URL返回一行JSON;
+        不支持时 (404/405/501) 通过连接池并发发送单个请求, 同时最多concurrency个. 批量请求中途失败时,
+        没有返回结果的URL改为单个请求.
+        """
+        requests_ = [(url, params(url) if params is not None else kwargs) for url in urls]
+        pending = dict(enumerate(requests_))
+
+        if _batch_supported.get(self.base_url, True) and len(requests_) > 1:
+            indexed = list(enumerate(requests_))
+            for start in range(0, len(indexed), max_batch):
+                chunk = indexed[start:start + max_batch]
+                try:
+                    async for index, result, error in self._batch_request(chunk, concurrency):
+                        if pending.pop(index, None) is not None:
+                            yield index, result, error
+                except _BatchUnsupported:
+                    _batch_supported[self.base_url] = False
+                    break
+                except (httpx.HTTPError, RuntimeError, ValueError) as ex:
+                    print(f'Warning: LinkSeek batch request failed, crawling the rest one by one: {ex}')
+                else:
+                    _batch_supported[self.base_url] = True
+
+        async for item in self._crawl_each(pending, concurrency):
+            yield item
+
+    async def _batch_request(self, chunk, concurrency):
+        payloads = []
+        for index, (url, kwargs) in chunk:
+            kwargs = dict(kwargs)
+            kwargs.setdefault('formats', ["html"])
+            payloads.append(_build_payload(url, kwargs['formats'], kwargs.get('use_browser', True),
+                                           kwargs.get('proxy'), kwargs.get('mobile', False), kwargs.get('timeout', 30)))
+
+        # 逐行读取结果, 两行之间最多等待单个URL的超时时间
+        read_timeout = max(p['timeout'] for p in payloads) + 10
+        body = {'requests': payloads, 'concurrency': concurrency}
+
+        _count('requests')
+        async with self._client.stream("POST", "/api/v1/crawl/batch", json=body,
+                                       timeout=httpx.Timeout(read_timeout, connect=10),
+                                       extensions={"trace": _trace_connections}) as response:
+            if response.status_code in BATCH_UNSUPPORTED_STATUSES:
+                raise _BatchUnsupported()
+            if response.status_code != 200:
+                text = (await response.aread()).decode('utf-8', errors='replace')
+                raise RuntimeError(f'LinkSeek batch returned HTTP {response.status_code}: {text[:500]}')
+
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+
+                data = json.loads(line)
+                pos = data.get('index')
+                if not isinstance(pos, int) or not 0 <= pos < len(chunk):
+                    raise ValueError(f'LinkSeek batch returned an invalid index: {line[:300]}')
+
+                index, (url, _) = chunk[pos]
+                try:
+                    yield index, _parse_response(url, payloads[pos]['formats'], 200, line, lambda: data), None
+                except RuntimeError as ex:
+                    yield index, None, ex
+
+    async def _crawl_each(self, pending, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def crawl_one(index, url, kwargs):
+            async with semaphore:
+                try:
+                    return index, await self.crawl(url, **kwargs), None
+                except Exception as ex:
+                    return index, None, ex
+
+        for coro in asyncio.as_completed([crawl_one(i, url, kwargs) for i, (url, kwargs) in pending.items()]):
+            yield await coro
+
+async def _trace_connections(event, info):
+    if event == 'connection.connect_tcp.complete':
+        _count('connections')
+
+async def async_crawl(url, client=None, **kwargs):
+    """crawl()的异步版本. 没有传入client时使用只发一个请求的临时AsyncClient"""
+    if client is not None:
+        return await client.crawl(url, **kwargs)
+
+    async with AsyncClient(max_connections=1) as client:
+        return await client.crawl(url, **kwargs)
+
+async def async_crawl_batch(urls, client=None, concurrency=4, max_batch=50, params=None, **kwargs):
+    """AsyncClient.crawl_batch()的模块级版本. 没有传入client时使用大小为concurrency的临时连接池"""
+    if client is not None:
+        async for item in client.crawl_batch(urls, concurrency=concurrency, max_batch=max_batch, params=params,
+                                             **kwargs):
+            yield item
+        return
+
+    async with AsyncClient(max_connections=concurrency) as client:
+        async for item in client.crawl_batch(urls, concurrency=concurrency, max_batch=max_batch, params=params,
+                                             **kwargs):
+            yield item
+
+def crawl_batch(urls, concurrency=4, max_batch=50, params=None, **kwargs):
+    """
+    同步版本的批量抓取, 是一个生成器, 按完成顺序产生 (index, result, error), 参数见AsyncClient.crawl_batch.
+    请求在后台线程的事件循环中进行, 不能在事件循环中调用 (使用async_crawl_batch)
+    """
+    # 有界队列: 调用方处理得慢时暂停读取结果, 不会在内存中堆积整批页面
+    results = queue.Queue(maxsize=concurrency)
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        # 调用方提前结束迭代 (break或异常) 后不再放入, 后台线程随之退出
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    async def run():
+        async for item in async_crawl_batch(urls, concurrency=concurrency, max_batch=max_batch, params=params,
+                                            **kwargs):
+            # 在线程中等待队列的空位, 不阻塞事件循环中正在进行的请求
+            if not await asyncio.to_thread(put, item):
+                return
+
+    def target():
+        try:
+            asyncio.run(run())
+        except BaseException as ex:
+            put(ex)
+        finally:
+            put(done)
+
+    threading.Thread(target=target, daemon=True).start()
+    try:
+        while True:
+            item = results.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,246 @@
+"""
+本地的LinkSeek服务, 用于离线测试抓取的并发控制和错误处理.
+
+实现 POST /api/v1/crawl. 每个请求等待latency秒后返回 (latency可以是openai_stub.parse_distribution支持的分布),
+内容由responder生成, 默认为 '# {url}' 的markdown或对应的html. 可以按概率或对前N个请求返回HTTP错误.
+
+batch=True时还实现批量接口 POST /api/v1/crawl/batch: 请求为 {"requests": [crawl请求], "concurrency": n},
+同时处理n个URL, 每完成一个返回一行JSON (chunked编码): crawl的响应加上请求中的序号 "index".
+
+    with linkseek_stub.StubServer(latency=0.1) as server:
+        os.environ['LINKSEEK_BASE_URL'] = server.base_url
+        config.reload()
+        ...
+        print(server.counts, server.max_in_flight)
+
+也可以独立运行: python -m chat_with_llm.web.linkseek_stub --port 8401 --latency uniform:0.5,2
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from chat_with_llm.openai_stub import parse_distribution
+
+__all__ = ['StubServer']
+
+DEFAULT_OPTIONS = {
+    'latency': 0.1,         # 每个请求的处理秒数
+    'errors': {},           # {HTTP状态码: 概率}
+    'fail_first': 0,        # 前N个请求固定返回fail_status
+    'fail_status': 500,
+    'batch': True,          # 是否支持批量接口, False时返回404
+}
+
+def default_responder(url, formats):
+    if formats[0] == 'html':
+        return f'<html><head><title>{url}</title></head><body><a href="{url}">{url}</a></body></html>'
+
+    return f'# {url}\n\ncontent of {url}\n'
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.stub._record_connection()
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json(400, {'success': False, 'error': {'code': 'BAD_REQUEST', 'message': 'invalid json'}})
+            return
+
+        stub = self.server.stub
+        if self.path == '/api/v1/crawl':
+            status, body = stub._handle_crawl(request)
+            self._send_json(status, body)
+        elif self.path == '/api/v1/crawl/batch' and stub.options['batch']:
+            self._handle_batch(request)
+        else:
+            self._send_json(404, {'success': False, 'error': {'code': 'NOT_FOUND', 'message': self.path}})
+
+    def _write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def _handle_batch(self, request):
+        stub = self.server.stub
+        items = request.get('requests') or []
+        with stub.lock:
+            stub.counts['batches'] = stub.counts.get('batches', 0) + 1
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        with ThreadPoolExecutor(max_workers=max(1, int(request.get('concurrency', 4)))) as executor:
+            futures = {executor.submit(stub._handle_crawl, item): index for index, item in enumerate(items)}
+            for future in as_completed(futures):
+                _, body = future.result()
+                self._write_chunk(json.dumps(dict(body, index=futures[future])).encode('utf-8') + b'\n')
+
+        self._write_chunk(b'')
+
+class StubServer:
+    """
+    params:
+        responder: 可选的函数(url, formats) -> str, 生成页面内容
+        seed: 随机数种子
+        其他参数见DEFAULT_OPTIONS
+
+    运行时统计:
+        requests: 收到的所有crawl请求 (json)
+        counts: {'requests': n, 'ok': n, 'batches': n, 状态码: n}. 批量请求中的每个URL计为一个请求
+        connections: 建立的TCP连接数
+        in_flight/max_in_flight: 正在处理的请求数和最大值
+        timeline: 每个请求的(url, 开始时间, 结束时间), 时间为time.monotonic()
+    """
+    def __init__(self, host='127.0.0.1', port=0, responder=None, seed=None, **options):
+        unknown = set(options) - set(DEFAULT_OPTIONS)
+        if unknown:
+            raise ValueError(f'Unknown options {sorted(unknown)}')
+
+        self.host = host
+        self.port = port
+        self.responder = responder or default_responder
+        self.options = dict(DEFAULT_OPTIONS, **options)
+        self._latency = parse_distribution(self.options['latency'])
+
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.counts = {'requests': 0, 'ok': 0}
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.timeline = []
+
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def start(self):
+        self.httpd = _Server((self.host, self.port), _Handler)
+        self.httpd.stub = self
+        self.port = self.httpd.server_address[1]
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _record_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def _handle_crawl(self, request):
+        with self.lock:
+            self.requests.append(request)
+            self.counts['requests'] += 1
+            seq = self.counts['requests']
+            latency = self._latency(self.rng)
+            status = None
+            if seq <= self.options['fail_first']:
+                status = self.options['fail_status']
+            else:
+                for code, prob in self.options['errors'].items():
+                    if self.rng.random() < prob:
+                        status = int(code)
+                        break
+
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        url = request.get('url', '')
+        start = time.monotonic()
+        try:
+            time.sleep(latency)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.timeline.append((url, start, time.monotonic()))
+
+        if status is not None:
+            with self.lock:
+                self.counts[status] = self.counts.get(status, 0) + 1
+            return status, {'success': False, 'debug_id': f'stub-{seq}',
+                            'error': {'code': 'STUB_ERROR', 'message': f'injected {status}'}}
+
+        formats = request.get('formats') or ['html']
+        content = self.responder(url, formats)
+        with self.lock:
+            self.counts['ok'] += 1
+
+        return 200, {
+            'success': True,
+            'data': {
+                'url': url,
+                'formats': {f: content for f in formats},
+                'metadata': {'title': url},
+            },
+        }
+
+def _parse_error(value):
+    code, _, prob = value.partition('=')
+    return int(code), float(prob)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local LinkSeek stub server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8401)
+    parser.add_argument('--latency', default='0.1', help='Seconds per request, e.g. 0.1 or uniform:0.5,2')
+    parser.add_argument('--error', type=_parse_error, nargs='*', default=[],
+                        help='Injected errors as status=probability, e.g. 500=0.1')
+    parser.add_argument('--fail_first', type=int, default=0)
+    parser.add_argument('--no_batch', action='store_true', help='Disable the batch endpoint')
+    parser.add_argument('--seed', type=int, default=None)
+
+    args = parser.parse_args()
+
+    server = StubServer(host=args.host, port=args.port, seed=args.seed, latency=args.latency,
+                        errors=dict(args.error), fail_first=args.fail_first, batch=not args.no_batch)
+    server.start()
+    print(f'LinkSeek stub listening on {server.base_url}')
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+        print(server.counts)
@@ -1,11 +1,10 @@
 import datetime as dt
 
 from chat_with_llm.web import online_content
-from chat_with_llm.web import linkseek
 
 # 每日新闻联播
 # 网址: https://cn.govopendata.com/xinwenlianbo/20180331/
-class MRXWLB(online_content.OnlineContent):
+class MRXWLB(online_content.AsyncOnlineContent):
     NAME = 'mrxwlb'
     DESCRIPTION = '每日新闻联播'
     BASE_URL = 'https://cn.govopendata.com/xinwenlianbo/'
@@ -47,9 +46,8 @@ class MRXWLB(online_content.OnlineContent):
 
         return urls
 
-    def fetch(self, url):
-        return linkseek.crawl(
-            url=url,
+    def crawl_params(self, url):
+        return dict(
             formats=["markdown"],
             use_browser=True,
         )
@@ -1,13 +1,33 @@
 import asyncio
+import hashlib
 import os
 import json
+import queue
+import sqlite3
+import threading
+import weakref
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from chat_with_llm import storage
 from chat_with_llm import config
+from chat_with_llm.web import boilerplate
+from chat_with_llm.web import linkseek
+from chat_with_llm.web import scheduler
 
 __all__ = ['OnlineContent', 'add_online_retriever', 'get_online_retriever', 'list_online_retrievers']
 
+def _content_hash(raw):
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8')
+    return hashlib.sha1(raw).hexdigest()
+
+def _parse_in_process(retriever_class, parser_config, items):
+    """在子进程中解析一组(url, raw). 实例不经过__init__, 只设置parser_config中的属性"""
+    retriever = retriever_class.__new__(retriever_class)
+    retriever.__dict__.update(parser_config)
+    return [retriever.safe_parse(url, raw) for url, raw in items]
+
 class OnlineContent(ABC):
     def __init__(self, **params):
         assert 'name' in params, 'name is required'
@@ -20,14 +40,51 @@ class OnlineContent(ABC):
         self.force_fetch = params.get('force_fetch', False)
         self.force_parse = params.get('force_parse', False)
         self.update_cache = params.get('update_cache', True)
-        self.num_workers = params.get('num_workers', int(config.get('ONLINE_CONTENT_WORKERS', 2)))
+        self.num_workers = params.get('num_workers', config.snapshot().online_content_workers)
+
+        # 同一网站的请求间隔和并发数. 设置了mean_delay时默认同一网站同时只有一个请求
+        mean_delay = float(params.get('mean_delay', 0))
+        max_per_site = params.get('max_per_site', 1 if mean_delay > 0 else None)
+        self.scheduler = scheduler.DomainScheduler(mean_delay=mean_delay, max_in_flight=max_per_site,
+                                                   jitter=params.get('delay_jitter', 0.5))
+
+        # 多进程解析. parse_processes为0时在当前线程中解析
+        self.parse_processes = int(params.get('parse_processes', 0))
+        self.parse_chunksize = max(1, int(params.get('parse_chunksize', 4)))
+        self.parse_min_batch = int(params.get('parse_min_batch', 16))
+        self._parse_pool = None
 
-    def retrieve(self, url_or_id):
-        return self.retrieve_many([url_or_id])[0]
+        # 缓存新页面时更新网站的行频率统计, 用于boilerplate.get_line_model().strip()
+        self.learn_boilerplate = str(params.get('learn_boilerplate', False)).lower() in ['true', '1', 'yes']
+
+    def retrieve(self, url_or_id, return_changed=False):
+        return self.retrieve_many([url_or_id], return_changed=return_changed)[0]
             
-    def retrieve_many(self, urls_or_ids):
+    def retrieve_many(self, urls_or_ids, return_changed=False):
+        """
+        returns: 每个url的解析结果, 失败为None.
+            return_changed=True时每项为(parsed, changed). changed表示内容是这次新抓取的, 且与缓存中的不同(或没有缓存);
+            使用缓存, 或重新抓取的内容与缓存完全相同时为False, 调用方可以跳过后续处理
+        """
+        rets = [None] * len(urls_or_ids)
+        for ind, _, ret in self.iter_retrieve(urls_or_ids, return_changed=return_changed):
+            rets[ind] = ret
+
+        return rets
+
+    def iter_retrieve(self, urls_or_ids, return_changed=False):
+        """
+        按完成顺序产生 (序号, url, parsed). 有缓存的先产生, 需要抓取的每完成一个就解析并保存,
+        中途中断时已完成的页面都已经保存. return_changed=True时parsed为(parsed, changed), 见retrieve_many
+        """
+        def result(parsed, changed):
+            return (parsed, changed) if return_changed else parsed
+
         to_be_fetched = []
-        rets = []
+        to_be_parsed = []
+        # 规范化后指向同一site_id的URL只抓取和解析一次, {第一个的序号: [(其他序号, url)]}
+        first_of = {}
+        duplicates = {}
         for ind, url_or_id in enumerate(urls_or_ids):
             url, site_id = self.parse_url_id(url_or_id)
             key_raw = site_id + '.raw'
@@ -41,57 +98,246 @@ class OnlineContent(ABC):
                     raise RuntimeError(f'Cannot decide url from {url_or_id} and no cache found.')
 
             if self.force_fetch or not self.storage.has(key_raw):
-                to_be_fetched.append((ind, url, site_id))
-                rets.append(None) # placeholder
+                pending = to_be_fetched
+            elif self.force_parse or not self.storage.has(key_parsed):
+                pending = to_be_parsed
             else:
-                if self.force_parse or not self.storage.has(key_parsed):
-                    metadata, raw = self.load_raw(site_id)
-                    redirect_url = metadata.get('redirect_url', url)
-                    parsed = self.parse(redirect_url, raw)
-                    if self.update_cache:
+                yield ind, url, result(self.load_parsed(site_id), False)
+                continue
+
+            if site_id in first_of:
+                duplicates.setdefault(first_of[site_id], []).append((ind, url))
+            else:
+                first_of[site_id] = ind
+                pending.append((ind, url, site_id))
+
+        for ind, url, parsed, changed in self._iter_uncached(to_be_parsed, to_be_fetched):
+            yield ind, url, result(parsed, changed)
+            for dup_ind, dup_url in duplicates.get(ind, []):
+                # 只有第一个URL的内容是新的
+                yield dup_ind, dup_url, result(parsed, False)
+
+    def _iter_uncached(self, to_be_parsed, to_be_fetched):
+        """按完成顺序产生 (序号, url, parsed, changed): 用缓存的raw重新解析to_be_parsed, 抓取并解析to_be_fetched"""
+        if self.use_parse_pool(len(to_be_parsed) + len(to_be_fetched)):
+            yield from self._iter_parse_in_pool(to_be_parsed, to_be_fetched)
+            return
+
+        for ind, url, site_id in to_be_parsed:
+            metadata, raw = self.load_raw(site_id)
+            parsed = self.parse(metadata.get('redirect_url', url), raw)
+            if self.update_cache:
+                self.save(site_id=site_id, parsed=parsed)
+            yield ind, url, parsed, False
+
+        if to_be_fetched:
+            for pos, r in self.iter_fetch([url for _, url, _ in to_be_fetched]):
+                ind, url, site_id = to_be_fetched[pos]
+                yield (ind, url) + self.process_fetched(url, site_id, r)
+
+    def parser_config(self):
+        """
+        多进程解析时传给子进程的配置: parse()用到的实例属性的dict, 必须可以pickle.
+        子进程中创建不经过__init__的实例, 设置这些属性后调用parse. 返回None表示parse不能在子进程中运行
+        """
+        return None
+
+    def use_parse_pool(self, n):
+        # 进程间传递raw和parsed有开销, 少量页面在当前线程中解析更快
+        return self.parse_processes > 0 and n >= max(1, self.parse_min_batch) and self.parser_config() is not None
+
+    def _get_parse_pool(self):
+        if self._parse_pool is None:
+            import multiprocessing
+
+            # iter_fetch可能有后台线程在运行, fork不安全, 使用spawn
+            self._parse_pool = ProcessPoolExecutor(max_workers=self.parse_processes,
+                                                   mp_context=multiprocessing.get_context('spawn'))
+            weakref.finalize(self, self._parse_pool.shutdown, wait=False, cancel_futures=True)
+
+        return self._parse_pool
+
+    def _iter_parse_in_pool(self, to_be_parsed, to_be_fetched):
+        """
+        iter_retrieve的多进程版本, 按完成顺序产生 (序号, url, parsed, changed).
+        抓取和检查缓存在当前进程中进行, 需要解析的页面每parse_chunksize个提交给进程池, 解析完成后在当前进程中保存
+        """
+        pool = self._get_parse_pool()
+        parser_config = self.parser_config()
+        futures = {}
+        chunk = []
+        metadata_of = {}
+
+        def submit():
+            items = [(redirect_url, raw) for _, _, _, redirect_url, raw, _ in chunk]
+            futures[pool.submit(_parse_in_process, type(self), parser_config, items)] = list(chunk)
+            chunk.clear()
+
+        def add(job):
+            chunk.append(job)
+            if len(chunk) >= self.parse_chunksize:
+                submit()
+
+        def collect(future):
+            jobs = futures.pop(future)
+            try:
+                results = future.result()
+            except Exception as e:
+                print(e)
+                results = [None] * len(jobs)
+
+            for (ind, url, site_id, redirect_url, raw, raw_hash), parsed in zip(jobs, results):
+                if raw_hash is None:
+                    # 缓存的raw重新解析, 与当前线程中解析时相同, 失败时不写入缓存
+                    if parsed is not None and self.update_cache:
                         self.save(site_id=site_id, parsed=parsed)
-                    rets.append(parsed)
+                    yield ind, url, parsed, False
                 else:
-                    rets.append(self.load_parsed(site_id))
+                    yield (ind, url) + self.save_fetched(url, site_id, (redirect_url, metadata_of[ind], raw),
+                                                         raw_hash, parsed)
+
+        def collect_done():
+            for future in [f for f in futures if f.done()]:
+                yield from collect(future)
+
+        for ind, url, site_id in to_be_parsed:
+            metadata, raw = self.load_raw(site_id)
+            add((ind, url, site_id, metadata.get('redirect_url', url), raw, None))
+            yield from collect_done()
 
         if to_be_fetched:
-            fetch_results = self.fetch_many([url for _, url, _ in to_be_fetched])
-            for (ind, url, site_id), r in zip(to_be_fetched, fetch_results):
+            for pos, r in self.iter_fetch([url for _, url, _ in to_be_fetched]):
+                ind, url, site_id = to_be_fetched[pos]
                 if r is None:
-                    rets[ind] = None
+                    yield ind, url, None, False
                     continue
-                
-                redirect_url, metadata, raw = r
-                parsed = self.safe_parse(redirect_url, raw)
 
-                if not parsed:
-                    rets[ind] = None
+                redirect_url, metadata, raw = r
+                raw_hash = _content_hash(raw)
+                parsed = None if self.force_parse else self.load_unchanged(site_id, raw_hash)
+                if parsed is not None:
+                    yield ind, url, parsed, False
                     continue
 
-                metadata = metadata or {}
-                if 'url' not in metadata:
-                    metadata['url'] = url
+                metadata_of[ind] = metadata
+                add((ind, url, site_id, redirect_url, raw, raw_hash))
+                yield from collect_done()
 
-                if url != redirect_url and 'redirect_url' not in metadata:
-                    metadata['redirect_url'] = redirect_url
+        if chunk:
+            submit()
 
-                if self.update_cache:
-                    self.save(site_id=site_id, metadata=metadata, raw=raw, parsed=parsed)
+        while futures:
+            done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from collect(future)
 
-                rets[ind] = parsed
-        
-        return rets
+    def process_fetched(self, url, site_id, r):
+        """
+        解析并保存fetch的结果r, 返回(parsed, changed).
+        raw与缓存中的完全相同时 (按.meta中的content_hash比较) 不重新解析, 也不写入缓存
+        """
+        if r is None:
+            return None, False
+
+        redirect_url, metadata, raw = r
+        raw_hash = _content_hash(raw)
+        if not self.force_parse:
+            parsed = self.load_unchanged(site_id, raw_hash)
+            if parsed is not None:
+                return parsed, False
+
+        parsed = self.safe_parse(redirect_url, raw)
+        return self.save_fetched(url, site_id, r, raw_hash, parsed)
+
+    def save_fetched(self, url, site_id, r, raw_hash, parsed):
+        """补充metadata并保存新抓取的r和解析结果parsed, 返回(parsed, changed)"""
+        if not parsed:
+            return None, False
+
+        redirect_url, metadata, raw = r
+        metadata = metadata or {}
+        if 'url' not in metadata:
+            metadata['url'] = url
+
+        if url != redirect_url and 'redirect_url' not in metadata:
+            metadata['redirect_url'] = redirect_url
+
+        metadata['content_hash'] = raw_hash
+
+        if self.update_cache:
+            self.save(site_id=site_id, metadata=metadata, raw=raw, parsed=parsed)
+            if self.learn_boilerplate:
+                self.learn_lines(url, parsed)
+
+        return parsed, True
+
+    def learn_lines(self, url, parsed):
+        """把新缓存的页面加入所在网站的行频率统计 (web.boilerplate), 失败时只打印警告"""
+        try:
+            boilerplate.get_line_model().add_page(url, parsed)
+        except (sqlite3.Error, OSError) as e:
+            print(f'Warning: failed to update boilerplate line model for {url}: {e}')
+
+    def load_unchanged(self, site_id, raw_hash):
+        """缓存的raw的hash为raw_hash时返回缓存的parsed, 否则返回None"""
+        if not self.storage.has(site_id + '.parsed') or not self.storage.has(site_id + '.raw'):
+            return None
+
+        try:
+            metadata = json.loads(self.storage.load(site_id + '.meta'))
+            # 旧的缓存没有content_hash, 按缓存的raw计算
+            cached_hash = metadata.get('content_hash') or _content_hash(self.storage.load(site_id + '.raw'))
+        except (OSError, TypeError, ValueError):
+            return None
+
+        if cached_hash != raw_hash:
+            return None
+
+        return self.load_parsed(site_id)
 
     def fetch_many(self, urls_or_ids):
+        results = [None] * len(urls_or_ids)
+        for ind, r in self.iter_fetch(urls_or_ids):
+            results[ind] = r
+
+        return results
+
+    def iter_fetch(self, urls_or_ids):
+        """
+        按完成顺序产生 (序号, fetch的结果), 失败的结果为None. 使用num_workers个线程.
+        最多提交num_workers * 2个还没有被取走的请求, 调用方处理得慢时暂停提交, 不会在内存中堆积所有结果
+        """
         from concurrent.futures import ThreadPoolExecutor
-        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
-            results = executor.map(self.safe_fetch, urls_or_ids)
 
-        return list(results)
+        # 同步的linkseek.crawl共享一个session, 连接池至少要容纳所有线程
+        linkseek.get_session(self.num_workers)
+        window = self.num_workers * 2
+        pending = iter(enumerate(urls_or_ids))
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            def submit():
+                while len(futures) < window:
+                    item = next(pending, None)
+                    if item is None:
+                        return
+                    futures[executor.submit(self.safe_fetch, item[1])] = item[0]
+
+            try:
+                submit()
+                while futures:
+                    done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield futures.pop(future), future.result()
+                    submit()
+            finally:
+                # 提前停止迭代时取消还没有开始的请求
+                for future in futures:
+                    future.cancel()
     
     def safe_fetch(self, url_or_id):
         try:
-            return self.fetch(url_or_id)
+            with self.scheduler.slot(url_or_id):
+                return self.fetch(url_or_id)
         except Exception as e:
             print(e)
             return None
@@ -155,35 +401,118 @@ class OnlineContent(ABC):
             self.storage.save(site_id + '.parsed', parsed)
 
 class AsyncOnlineContent(OnlineContent):
+    """
+    异步抓取的基类. fetch_many通过一个共享连接池的linkseek.AsyncClient并发抓取, 同时最多num_workers个请求.
+    默认的async_fetch按crawl_params(url)调用LinkSeek, 子类通常只需实现crawl_params.
+
+    params:
+        fetch_timeout: 单个URL的超时秒数 (包括等待并发名额之后的整个请求, 默认60)
+        batch_crawl: 没有按网站限速时, 使用LinkSeek的批量接口一次发送多个URL (默认True, 服务不支持时自动改为单个请求)
+    """
     def __init__(self, **params):
         super().__init__(**params)
         self.loop = params.get('loop', None)
+        self.fetch_timeout = float(params.get('fetch_timeout', 60))
+        self.batch_crawl = str(params.get('batch_crawl', True)).lower() in ['true', '1', 'yes']
+
+    def iter_fetch(self, urls):
+        """
+        在后台线程的事件循环中运行async_iter_fetch, 按完成顺序产生 (序号, fetch的结果).
+        最多缓存num_workers个还没有被取走的结果, 调用方处理得慢时暂停产生新的结果
+        """
+        results = queue.Queue(maxsize=max(1, self.num_workers))
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        async def run():
+            async for item in self.async_iter_fetch(urls):
+                if not await asyncio.to_thread(put, item):
+                    break
+
+        def target():
+            try:
+                asyncio.run(run())
+            except BaseException as ex:
+                put(ex)
+            finally:
+                put(done)
+
+        threading.Thread(target=target, daemon=True).start()
+        try:
+            while True:
+                item = results.get()
+                if item is done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # 调用方提前停止迭代时, 让后台线程退出
+            stop.set()
 
-    def fetch_many(self, urls):
-        return asyncio.run(self.async_fetch_many(urls))
-
-    # by default, use async io.Semaphore to limit the number of concurrent requests
-    # subclass can override this to use other methods
     async def async_fetch_many(self, urls_or_ids):
-        asyncio.Semaphore(self.num_workers)
-        tasks = [self.async_fetch(url) for url in urls_or_ids]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        ret = []
-        for r in results:
-            if not isinstance(r, Exception):
-                ret.append(r)
-            else:
-                print(r)
-                ret.append(None)
+        ret = [None] * len(urls_or_ids)
+        async for ind, r in self.async_iter_fetch(urls_or_ids):
+            ret[ind] = r
 
         return ret
+
+    def use_batch_crawl(self, urls):
+        # 批量请求由服务端安排抓取, 无法按网站限速; 覆盖了async_fetch的子类不经过LinkSeek
+        return (self.batch_crawl and len(urls) > 1 and not self.scheduler.limited
+                and type(self).async_fetch is AsyncOnlineContent.async_fetch)
+
+    # by default, use asyncio.Semaphore to limit the number of concurrent requests
+    # subclass can override this to use other methods
+    async def async_iter_fetch(self, urls):
+        """按完成顺序产生 (序号, fetch的结果), 失败的URL结果为None"""
+        semaphore = asyncio.Semaphore(self.num_workers)
+
+        async def bounded_fetch(ind, url, client):
+            # 先等待网站的间隔, 再占用全局的并发名额, 等待中的请求不会阻塞其他网站
+            async with self.scheduler.async_slot(url), semaphore:
+                try:
+                    return ind, await asyncio.wait_for(self.async_fetch(url, client=client), self.fetch_timeout)
+                except asyncio.TimeoutError:
+                    print(f'Fetching {url} timed out after {self.fetch_timeout}s')
+                except Exception as e:
+                    print(e)
+
+                return ind, None
+
+        async with linkseek.AsyncClient(max_connections=self.num_workers) as client:
+            if self.use_batch_crawl(urls):
+                async for ind, r, error in client.crawl_batch(urls, concurrency=self.num_workers,
+                                                              params=self.crawl_params):
+                    if error is not None:
+                        print(error)
+                    yield ind, r
+                return
+
+            tasks = [bounded_fetch(ind, url, client) for ind, url in enumerate(urls)]
+            for coro in asyncio.as_completed(tasks):
+                yield await coro
     
     def fetch(self, url):
         raise RuntimeError('fetch() is not supported in async mode. Use async_fetch() instead.')
-    
-    @abstractmethod
-    async def async_fetch(self, url):
-        pass
+
+    def crawl_params(self, url):
+        """默认的async_fetch传给linkseek的参数 (formats, use_browser, proxy, mobile, timeout)"""
+        return {}
+
+    async def async_fetch(self, url, client=None):
+        # returns redirect_url, metadata, raw
+        # client: async_fetch_many共享的linkseek.AsyncClient, 为None时使用临时的client
+        return await linkseek.async_crawl(url, client=client, **self.crawl_params(url))
     
 all_online_retrievers = {}
 def add_online_retriever(name, retriever_class):
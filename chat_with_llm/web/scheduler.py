@@ -0,0 +1,111 @@
+"""
+按网站限制抓取频率 (politeness).
+
+同一网站 (web.utils.url_to_site, 例如www.reddit.com和old.reddit.com是同一网站) 的请求:
+    - 相邻两次请求开始的间隔为mean_delay秒, 加上 ±jitter 比例的随机抖动, 平均间隔仍为mean_delay
+    - 同时进行的请求最多max_in_flight个
+不同网站的请求互不影响.
+
+    scheduler = DomainScheduler(mean_delay=3, max_in_flight=1)
+    with scheduler.slot(url):               # 线程中
+        fetch(url)
+    async with scheduler.async_slot(url):   # 事件循环中
+        await async_fetch(url)
+"""
+
+import asyncio
+import contextlib
+import random
+import threading
+import time
+import weakref
+
+from chat_with_llm.web import utils as web_utils
+
+__all__ = ['DomainScheduler']
+
+class DomainScheduler:
+    """
+    params:
+        mean_delay: 同一网站相邻请求的平均间隔(秒), 0表示不限制
+        max_in_flight: 同一网站同时进行的最大请求数, None表示不限制
+        jitter: 间隔的随机抖动比例, 实际间隔在 mean_delay * [1 - jitter, 1 + jitter] 内均匀分布
+        key: url -> 网站的函数, 默认web.utils.url_to_site
+    """
+    def __init__(self, mean_delay=0, max_in_flight=None, jitter=0.5, key=web_utils.url_to_site):
+        self.mean_delay = float(mean_delay or 0)
+        self.max_in_flight = int(max_in_flight) if max_in_flight else None
+        self.jitter = min(max(float(jitter), 0.0), 1.0)
+        self.key = key
+
+        self._lock = threading.Lock()
+        self._next_start = {}
+        self._semaphores = {}
+        # asyncio.Semaphore只能在一个事件循环中使用, 每个事件循环单独创建
+        self._async_semaphores = weakref.WeakKeyDictionary()
+
+    @property
+    def limited(self):
+        """是否有任何限制. 没有限制时调用方可以不经过slot()"""
+        return self.mean_delay > 0 or self.max_in_flight is not None
+
+    def _delay(self):
+        if self.mean_delay <= 0:
+            return 0.0
+        return self.mean_delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def reserve(self, url):
+        """预约url所在网站的下一个请求时间, 返回需要等待的秒数"""
+        site = self.key(url)
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start.get(site, now))
+            self._next_start[site] = start + self._delay()
+
+        return start - now
+
+    def _semaphore(self, site):
+        with self._lock:
+            if site not in self._semaphores:
+                self._semaphores[site] = threading.Semaphore(self.max_in_flight)
+            return self._semaphores[site]
+
+    def _async_semaphore(self, site):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphores = self._async_semaphores.setdefault(loop, {})
+            if site not in semaphores:
+                semaphores[site] = asyncio.Semaphore(self.max_in_flight)
+            return semaphores[site]
+
+    @contextlib.contextmanager
+    def slot(self, url):
+        """等待url所在网站的并发名额和请求间隔"""
+        semaphore = self._semaphore(self.key(url)) if self.max_in_flight else None
+        if semaphore is not None:
+            semaphore.acquire()
+
+        try:
+            wait = self.reserve(url)
+            if wait > 0:
+                time.sleep(wait)
+            yield
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    @contextlib.asynccontextmanager
+    async def async_slot(self, url):
+        """slot()的异步版本, 等待时不阻塞其他网站的请求"""
+        semaphore = self._async_semaphore(self.key(url)) if self.max_in_flight else None
+        if semaphore is not None:
+            await semaphore.acquire()
+
+        try:
+            wait = self.reserve(url)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            yield
+        finally:
+            if semaphore is not None:
+                semaphore.release()
@@ -1,30 +1,107 @@
 import collections
+import re
+
+from chat_with_llm.web import canonical
 
 __all__ = ['url_to_site', 'remove_duplicated_lines', 'strip_boilerplate', 'extract_links_from_markdown']
 
 def url_to_site(url):
-    # 解析url, 返回网站的初级域名. 例如www.reddit.com和login.reddit.com都返回reddit.com
-    url = url.replace('https://', '').replace('http://', '')
-    parts = url.split('/')
-    domain = parts[0]
-    domain_parts = domain.split('.')
-    
-    top_level_domains = {'com', 'org', 'net', 'edu', 'gov', 'mil', 'int', 'vip', 'app', 'me', 'tv', 'co', 'io', 'ai', 'cc', 'info', 'biz', 'name', 'pro', 'top', 'xyz', 'site', 'online', 'store',
-                         'cn', 'us', 'jp', 'uk', 'au', 'de', 'fr', 'ru', 'it', 'es', 'br', 'in', 'ca', 'kr', 'mx', 'nl', 'se', 'no', 'fi', 'dk', 'pl', 'tr', 'hu', 'cz', 'ro', 'gr', 'pt', 'il', 'ae',
-                         'sa', 'hk', 'tw', 'sg', 'my', 'th', 'ph', 'vn', 'id', 'pk', 'bd', 'lk', 'np', 'np', 'kh', 'la', 'mm', 'mn', 'kh', 'kh'}
-                         
-    site_parts = []
-
-    for i, part in enumerate(reversed(domain_parts)):
-        if part in top_level_domains and i < 2:
-            site_parts.append(part)
+    # 解析url, 返回网站的可注册域名. 例如www.reddit.com和login.reddit.com都返回reddit.com, www.bbc.co.uk返回bbc.co.uk
+    # 公共后缀见web.canonical (内置的常见后缀, 或配置PUBLIC_SUFFIX_LIST指定的完整列表)
+    return canonical.registered_domain(url)
+
+# 只有方括号和圆括号 (逐行扫描时还有换行) 会改变扫描的状态, 用正则跳过其他字符.
+# 最常见的 [text](url) (text中没有方括号, url中没有方括号和右括号) 作为一个token整体匹配
+_LINK_TOKENS = re.compile(r'\[([^\[\]]*)\]\([^\[\])]*\)|[\[\]()]')
+_LINK_TOKENS_LINES = re.compile(r'\[([^\[\]\n]*)\]\([^\[\])\n]*\)|[\[\]()\n]')
+
+def _scan_links(s, split_lines=False):
+    """
+    extract_links_from_markdown的状态机, 但只访问方括号和圆括号, 时间与字符串长度成线性.
+    split_lines=True时每行单独扫描 (与逐行调用的结果相同), 产生 (行首, 行尾, 行中的链接), 位置都是在s中的位置;
+    否则只产生一项 (0, len(s), 链接)
+    """
+    sb_lvl = 0 # square bracket level
+    rb_lvl = 0 # round bracket level
+    links = []
+    line_start = 0
+
+    link_start = None
+    link_text = None
+    for m in (_LINK_TOKENS_LINES if split_lines else _LINK_TOKENS).finditer(s):
+        p = m.start()
+        c = s[p]
+        if m.lastindex:
+            # 完整的 [text](url). 在方括号内时 (sb_lvl > 0) 逐字符扫描的结果是没有任何变化;
+            # 否则无论之前的状态如何, 都产生这个链接并回到初始状态
+            if sb_lvl == 0:
+                links.append((p, m.end(), m.group(1)))
+                link_start = None
+                link_text = None
+                rb_lvl = 0
+        elif c == '[':
+            sb_lvl += 1
+            if sb_lvl == 1:
+                link_start = p
+        elif c == ']':
+            sb_lvl = max(0, sb_lvl - 1)
+            if sb_lvl == 0 and link_start is not None:
+                link_text = s[link_start+1:p]
+        elif c == '(':
+            if sb_lvl == 0 and rb_lvl == 0 and link_start is not None:
+                rb_lvl += 1
+        elif c == ')':
+            if sb_lvl == 0 and rb_lvl == 1:
+                links.append((link_start, p + 1, link_text))
+                link_start = None
+                link_text = None
+                rb_lvl = 0
         else:
-            site_parts.append(part)
-            break
+            yield line_start, p, links
+            sb_lvl = rb_lvl = 0
+            links = []
+            line_start = p + 1
+            link_start = None
+            link_text = None
 
-    return '.'.join(reversed(site_parts))
+    yield line_start, len(s), links
 
 def extract_links_from_markdown(s):
+    """返回s中 [text](url) 形式的链接 [(起始位置, 结束位置, text)]"""
+    if '[' not in s:
+        return []
+
+    for _, _, links in _scan_links(s):
+        return links
+
+def strip_boilerplate(contents):
+    # 网页中包含大量的链接. 在这里我们尝试去掉这些链接
+    # 整个文档只扫描一次, 每行用切片拼接, 结果与逐行处理 (_strip_boilerplate_by_line) 相同
+
+    outputs = []
+    for start, end, links in _scan_links(contents, split_lines=True):
+        if not links:
+            outputs.append(contents[start:end])
+            continue
+
+        link_length = sum([e-s for s, e, _ in links])
+        if link_length > 0.9 * (end - start):
+            continue
+
+        parts = []
+        p = start
+        for s, e, t in links:
+            parts.append(contents[p:s])
+            parts.append(t)
+            p = e
+
+        parts.append(contents[p:end])
+        outputs.append(''.join(parts))
+
+    return '\n'.join(outputs)
+
+# 原来逐字符扫描的实现, 保留用于测试和benchmark (scripts/bench_web_utils.py) 的对照
+def _extract_links_from_markdown_charwise(s):
     sb_lvl = 0 # square bracket level
     rb_lvl = 0 # round bracket level
     links = []
@@ -53,13 +130,11 @@ def extract_links_from_markdown(s):
 
     return links
 
-def strip_boilerplate(contents):
-    # 网页中包含大量的链接. 在这里我们尝试去掉这些链接
-
+def _strip_boilerplate_by_line(contents):
     outputs = []
     lines = contents.split('\n')
     for l in lines:
-        links = extract_links_from_markdown(l)
+        links = _extract_links_from_markdown_charwise(l)
         link_length = sum([e-s for s, e, _ in links])
         if link_length > 0.9 * len(l):
             continue
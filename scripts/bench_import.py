@@ -0,0 +1,66 @@
+import argparse
+import statistics
+import subprocess
+import sys
+
+# 每个场景在新进程中执行, 测量导入和第一次使用的耗时
+SCENARIOS = {
+    'package': 'import chat_with_llm',
+    'storage': 'from chat_with_llm import storage',
+    'storage_get': "from chat_with_llm import storage; storage.get_storage('chat_history', 'default')",
+    'llm': 'from chat_with_llm import llm',
+    'llm_models': 'from chat_with_llm import llm; llm.list_models()',
+    'web': 'from chat_with_llm.web import online_content',
+}
+
+def measure(code, rounds):
+    script = ('import time; t0 = time.perf_counter()\n'
+              f'{code}\n'
+              'print(time.perf_counter() - t0)')
+    times = []
+    for _ in range(rounds):
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+        times.append(float(output.strip().split('\n')[-1]))
+
+    return times
+
+def import_times(code):
+    """-X importtime的结果: [(累计耗时us, 模块名)]"""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True).stderr
+    rows = []
+    for line in stderr.split('\n'):
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative_us), name.strip()))
+
+    return rows
+
+def top_imports(code, n):
+    """累计耗时最多的n个模块, 不包括解释器启动时(site等)导入的模块"""
+    startup = {name for _, name in import_times('pass')}
+    rows = [r for r in import_times(code) if r[1] not in startup]
+    return sorted(rows, reverse=True)[:n]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark import time of chat_with_llm modules')
+
+    parser.add_argument('scenarios', nargs='*', help=f'Scenarios to run, default all: {", ".join(SCENARIOS)}')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--top', type=int, default=0, help='Show the n slowest imports of each scenario')
+
+    args = parser.parse_args()
+
+    scenarios = args.scenarios or list(SCENARIOS.keys())
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'Unknown scenario {name}')
+
+    print(f'{"Scenario":<14} {"Median (ms)":<12} {"Min (ms)":<10} {"Max (ms)":<10}')
+    print('-' * 48)
+    for name in scenarios:
+        times = measure(SCENARIOS[name], args.rounds)
+        print(f'{name:<14} {statistics.median(times) * 1000:<12.1f} {min(times) * 1000:<10.1f} {max(times) * 1000:<10.1f}')
+
+        for cumulative_us, module in top_imports(SCENARIOS[name], args.top):
+            print(f'    {cumulative_us / 1000:>8.1f} ms  {module}')
@@ -0,0 +1,194 @@
+"""
+LLM接口的延迟和吞吐测试.
+
+对每个 (模型, prompt长度, 输出长度, 并发数) 组合发送 --requests 个流式请求, 输出JSON格式的统计:
+延迟和TTFT的p50/p95/p99, 单请求的tokens/s, 总吞吐和错误率.
+
+    # 离线运行, 使用本地的OpenAI兼容服务
+    python scripts/bench_llm.py --stub -c 1 4 16 -p 100 2000 -o 64
+    # 测试配置中的模型
+    python scripts/bench_llm.py -m ds-pro gpt4.1 -c 1 4 --output bench.json
+"""
+
+import argparse
+import json
+import math
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+# 生成prompt时按4个字符一个token估计
+CHARS_PER_TOKEN = 4
+FILLER_WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet']
+
+def percentile(values, p):
+    """nearest-rank百分位数"""
+    if not values:
+        return None
+    values = sorted(values)
+    ind = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[ind]
+
+def summarize_values(values):
+    return {
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'mean': sum(values) / len(values) if values else None,
+    }
+
+def make_prompt(prompt_tokens, bust_cache=True):
+    """生成约prompt_tokens个token的输入. bust_cache时以随机数开头, 避免命中上游的前缀缓存"""
+    rnd = random.Random()
+    words = [f'{rnd.getrandbits(32):08x}'] if bust_cache else []
+    length = len(words[0]) if words else 0
+    while length < prompt_tokens * CHARS_PER_TOKEN:
+        word = rnd.choice(FILLER_WORDS)
+        words.append(word)
+        length += len(word) + 1
+
+    return ' '.join(words)
+
+def run_request(client, model, prompt_tokens, max_tokens, bust_cache):
+    messages = [
+        {'role': 'system', 'content': 'Repeat the following words until you run out of output tokens.'},
+        {'role': 'user', 'content': make_prompt(prompt_tokens, bust_cache)},
+    ]
+
+    result = {'error': None, 'latency': None, 'ttft': None, 'completion_tokens': 0, 'tokens_per_sec': None}
+    t0 = time.time()
+    try:
+        stream = client.chat.completions.create(model=model, messages=messages, max_tokens=max_tokens,
+                                                stream=True, stream_options={'include_usage': True})
+        n_chunks = 0
+        usage = None
+        for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+
+            delta = chunk.choices[0].delta
+            if getattr(delta, 'content', None) or getattr(delta, 'reasoning_content', None):
+                if result['ttft'] is None:
+                    result['ttft'] = time.time() - t0
+                n_chunks += 1
+
+        result['latency'] = time.time() - t0
+        # 上游不返回usage时, 按收到的块数估计
+        result['completion_tokens'] = usage.completion_tokens if usage else n_chunks
+        if result['ttft'] is not None and result['latency'] > result['ttft']:
+            result['tokens_per_sec'] = result['completion_tokens'] / (result['latency'] - result['ttft'])
+    except openai.OpenAIError as ex:
+        result['latency'] = time.time() - t0
+        result['error'] = type(ex).__name__
+
+    return result
+
+def run_case(client, model, prompt_tokens, max_tokens, concurrency, n_requests, bust_cache):
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: run_request(client, model, prompt_tokens, max_tokens, bust_cache),
+                                    range(n_requests)))
+    wall_time = time.time() - t0
+
+    ok = [r for r in results if r['error'] is None]
+    errors = {}
+    for r in results:
+        if r['error']:
+            errors[r['error']] = errors.get(r['error'], 0) + 1
+
+    return {
+        'model': model,
+        'prompt_tokens': prompt_tokens,
+        'max_tokens': max_tokens,
+        'concurrency': concurrency,
+        'requests': n_requests,
+        'wall_time': wall_time,
+        'error_rate': (n_requests - len(ok)) / n_requests,
+        'errors': errors,
+        'latency': summarize_values([r['latency'] for r in ok]),
+        'ttft': summarize_values([r['ttft'] for r in ok if r['ttft'] is not None]),
+        'tokens_per_sec': summarize_values([r['tokens_per_sec'] for r in ok if r['tokens_per_sec'] is not None]),
+        'throughput': sum(r['completion_tokens'] for r in ok) / wall_time,
+        'requests_per_sec': len(ok) / wall_time,
+    }
+
+def list_upstream_models(client):
+    try:
+        return {m.id for m in client.models.list().data}
+    except openai.OpenAIError as ex:
+        print(f'Failed to list upstream models: {ex}', file=sys.stderr)
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark LLM latency and throughput')
+
+    parser.add_argument('-m', '--models', nargs='+', default=None,
+                        help='Model ids or aliases. Defaults to all enabled models (stub-model with --stub)')
+    parser.add_argument('-p', '--prompt_tokens', type=int, nargs='+', default=[100])
+    parser.add_argument('-o', '--max_tokens', type=int, nargs='+', default=[64])
+    parser.add_argument('-c', '--concurrency', type=int, nargs='+', default=[1])
+    parser.add_argument('-n', '--requests', type=int, default=None, help='Requests per case. Default: 4 * concurrency')
+    parser.add_argument('--keep_cache', action='store_true', help='Do not randomize prompt prefix')
+    parser.add_argument('--base_url', default=None, help='Override OPENAI_API_BASE')
+    parser.add_argument('--api_key', default=None, help='Override OPENAI_API_KEY')
+    parser.add_argument('--stub', action='store_true', help='Start a local OpenAI compatible stub and benchmark it')
+    parser.add_argument('--stub_latency', default='0.1', help='Stub latency distribution, e.g. lognormal:0.3,0.5')
+    parser.add_argument('--stub_token_rate', default='100', help='Stub output tokens per second')
+    parser.add_argument('--stub_error', nargs='*', default=[], help='Stub injected errors, e.g. 429=0.1 timeout=0.01')
+    parser.add_argument('--timeout', type=float, default=600, help='Request timeout in seconds')
+    parser.add_argument('--output', default=None, help='Write the JSON report to this file instead of stdout')
+
+    args = parser.parse_args()
+
+    server = None
+    if args.stub:
+        from chat_with_llm import openai_stub
+        errors = dict(openai_stub._parse_error(e) for e in args.stub_error)
+        models = args.models or ['stub-model']
+        server = openai_stub.StubServer(latency=args.stub_latency, token_rate=args.stub_token_rate,
+                                        errors=errors, models=models).start()
+        base_url, api_key = server.base_url, 'stub'
+    elif args.base_url:
+        base_url, api_key = args.base_url, args.api_key or 'none'
+        models = args.models
+        if not models:
+            parser.error('--models is required with --base_url')
+    else:
+        # 只有使用配置中的模型时才加载配置
+        from chat_with_llm import config, llm
+        base_url = config.get('OPENAI_API_BASE')
+        api_key = args.api_key or config.get('OPENAI_API_KEY')
+        models = [llm.get_model(m) for m in args.models] if args.models else llm.list_models()
+
+    client = openai.OpenAI(api_key=api_key, base_url=base_url, max_retries=0, timeout=args.timeout)
+    upstream_models = list_upstream_models(client)
+
+    report = {'base_url': base_url, 'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'cases': []}
+    for model in models:
+        if upstream_models is not None and model not in upstream_models:
+            print(f'model {model} not found in upstream models', file=sys.stderr)
+            continue
+
+        for prompt_tokens in args.prompt_tokens:
+            for max_tokens in args.max_tokens:
+                for concurrency in args.concurrency:
+                    n_requests = args.requests or concurrency * 4
+                    case = run_case(client, model, prompt_tokens, max_tokens, concurrency, n_requests,
+                                    not args.keep_cache)
+                    report['cases'].append(case)
+                    print(f'{model} prompt={prompt_tokens} output={max_tokens} c={concurrency}: '
+                          f'p50 {case["latency"]["p50"] or 0:.3f}s, errors {case["error_rate"]:.0%}', file=sys.stderr)
+
+    if server:
+        server.stop()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        open(args.output, 'w').write(output)
+    else:
+        print(output)
@@ -0,0 +1,171 @@
+"""
+Langfuse追踪的开销测试.
+
+使用本地的openai_stub作为LLM, 以及一个本地的OTLP服务代替Langfuse (每次上传等待--export_delay秒, 模拟慢速的Langfuse),
+依次在关闭追踪和不同采样率下调用llm.chat_impl, 输出每次调用的平均耗时和相对关闭追踪时的额外开销, JSON格式.
+
+    python scripts/bench_tracing.py -n 500 -s 1.0 0.1 --export_delay 0.5
+    # 队列很小时, 上传跟不上的span被丢弃, 调用耗时不受影响
+    python scripts/bench_tracing.py -n 2000 --queue_size 100
+
+需要 ~/.chat_with_llm 下的配置文件; OPENAI_API_BASE, LANGFUSE_*等配置项由脚本通过环境变量覆盖.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from chat_with_llm import config
+from chat_with_llm import llm
+from chat_with_llm import openai_stub
+from chat_with_llm import tracing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_llm import summarize_values
+
+class FakeLangfuse:
+    """接收OTLP上传的本地服务, 统计收到的span数"""
+    def __init__(self, export_delay=0.0):
+        self.spans = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        outer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+
+                time.sleep(export_delay)
+                outer._record(body)
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-protobuf')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self._server.server_address[1]}'
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def _record(self, body):
+        from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import ExportTraceServiceRequest
+        request = ExportTraceServiceRequest()
+        request.ParseFromString(body)
+        spans = sum(len(s.spans) for r in request.resource_spans for s in r.scope_spans)
+        with self._lock:
+            self.requests += 1
+            self.spans += spans
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+def configure(langfuse_server, sample_rate, args, seq):
+    """
+    sample_rate为None时关闭追踪 (采样率0, 不创建span; config.yaml中的LANGFUSE_PUBLIC_KEY无法通过环境变量去掉).
+    langfuse的client按public key缓存, 每轮使用不同的key
+    """
+    tracing.shutdown()
+    os.environ['LANGFUSE_PUBLIC_KEY'] = f'pk-bench-{seq}'
+    os.environ['LANGFUSE_SECRET_KEY'] = 'sk-bench'
+    # 覆盖config.yaml中的地址, 不上传到真实的Langfuse
+    os.environ['LANGFUSE_BASE_URL'] = langfuse_server.base_url
+    os.environ['LANGFUSE_HOST'] = langfuse_server.base_url
+    os.environ['TRACING_SAMPLE_RATE'] = str(sample_rate or 0)
+    os.environ['TRACING_USE_CASES'] = 'bench'
+    os.environ['TRACING_QUEUE_SIZE'] = str(args.queue_size)
+    os.environ['OTEL_BSP_MAX_QUEUE_SIZE'] = str(args.queue_size)
+    os.environ['TRACING_BATCH_SIZE'] = str(args.batch_size)
+    config.reload()
+
+def run_mode(langfuse_server, sample_rate, args, seq):
+    configure(langfuse_server, sample_rate, args, seq)
+    spans_before = langfuse_server.spans
+
+    # 第一次调用包含导入langfuse和创建client的耗时, 不计入结果
+    llm.chat_impl('prompt', 'warmup', 'stub-bench', use_case='bench', save=False, stream=args.stream)
+
+    times = []
+    t0 = time.perf_counter()
+    for i in range(args.requests):
+        t = time.perf_counter()
+        llm.chat_impl('prompt', f'contents {i}', 'stub-bench', use_case='bench', save=False, stream=args.stream)
+        times.append(time.perf_counter() - t)
+    wall_time = time.perf_counter() - t0
+
+    # 等待队列中的span上传完, 统计实际上传的数量 (队列满时丢弃的不会上传)
+    t = time.perf_counter()
+    tracing.shutdown()
+    flush_time = time.perf_counter() - t
+
+    return {
+        'sample_rate': sample_rate,
+        'requests': args.requests,
+        'wall_time': wall_time,
+        'latency': summarize_values(times),
+        'spans_exported': langfuse_server.spans - spans_before,
+        'flush_time': flush_time,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Langfuse tracing overhead')
+
+    parser.add_argument('-n', '--requests', type=int, default=200, help='Calls per mode')
+    parser.add_argument('-s', '--sample_rates', type=float, nargs='+', default=[1.0, 0.1],
+                        help='Sample rates to test with tracing on. Tracing off is always tested')
+    parser.add_argument('--stream', action='store_true', help='Use streaming calls')
+    parser.add_argument('--export_delay', type=float, default=0.2, help='Seconds the fake Langfuse takes per upload')
+    parser.add_argument('--queue_size', type=int, default=1000)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--output', default=None, help='Write the JSON report to this file instead of stdout')
+
+    args = parser.parse_args()
+
+    # 聊天记录和用量统计写到临时目录
+    os.environ['STORAGE_BASE_DIR'] = tempfile.mkdtemp()
+    os.environ['OPENAI_API_KEY'] = 'stub'
+    langfuse_server = FakeLangfuse(args.export_delay)
+
+    with openai_stub.StubServer(latency=0, token_rate=0, output_tokens=16) as server:
+        os.environ['OPENAI_API_BASE'] = server.base_url
+
+        modes = []
+        for seq, sample_rate in enumerate([None] + args.sample_rates):
+            mode = run_mode(langfuse_server, sample_rate, args, seq)
+            modes.append(mode)
+            print(f'sample_rate={sample_rate}: mean {mode["latency"]["mean"] * 1000:.2f}ms, '
+                  f'spans {mode["spans_exported"]}', file=sys.stderr)
+
+    langfuse_server.stop()
+
+    baseline = modes[0]['latency']['mean']
+    for mode in modes:
+        mode['overhead_per_call'] = mode['latency']['mean'] - baseline
+
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'stream': args.stream,
+        'export_delay': args.export_delay,
+        'queue_size': args.queue_size,
+        'batch_size': args.batch_size,
+        'modes': modes,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        open(args.output, 'w').write(output)
+    else:
+        print(output)
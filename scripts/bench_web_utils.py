@@ -0,0 +1,102 @@
+import argparse
+import os
+import random
+import time
+
+from chat_with_llm import config
+from chat_with_llm.web import utils as web_utils
+
+
+def load_cached_pages(identifier, limit):
+    # web_cache下缓存的原始页面 (.raw), identifier为空时读取所有retriever的缓存
+    base = os.path.join(config.snapshot().storage_base_dir, 'web_cache', identifier or '')
+    pages = []
+    for root, _, files in os.walk(base):
+        for name in sorted(files):
+            if name.endswith('.raw'):
+                with open(os.path.join(root, name), encoding='utf-8', errors='replace') as f:
+                    pages.append(f.read())
+                if len(pages) >= limit:
+                    return pages
+
+    return pages
+
+
+def synthetic_pages(n, lines, seed=0):
+    # 模拟LinkSeek返回的markdown: 导航栏, 正文中夹杂链接, 链接列表
+    rng = random.Random(seed)
+    words = ['the', 'market', 'model', 'data', 'open', 'source', 'release', 'price', 'report', '市场', '发布']
+
+    def sentence(k):
+        return ' '.join(rng.choice(words) for _ in range(k))
+
+    def link():
+        return f'[{sentence(rng.randint(1, 4))}](https://example.com/{rng.randint(0, 10**6)}?ref=nav)'
+
+    pages = []
+    for _ in range(n):
+        out = []
+        for _ in range(lines):
+            r = rng.random()
+            if r < 0.3:
+                out.append(' | '.join(link() for _ in range(rng.randint(2, 8))))
+            elif r < 0.7:
+                out.append(f'{sentence(20)} {link()} {sentence(15)} ({sentence(3)})')
+            elif r < 0.9:
+                out.append(sentence(40))
+            else:
+                out.append('')
+        pages.append('\n'.join(out))
+
+    return pages
+
+
+def bench(func, pages, rounds):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for page in pages:
+            func(page)
+    return time.perf_counter() - t0
+
+
+def extract_per_line(extract):
+    # strip_boilerplate原来的用法: 每行调用一次
+    return lambda page: [extract(line) for line in page.split('\n')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark markdown link scanning in web.utils')
+
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--identifier', default='', help='web_cache identifier, e.g. crawl4ai. Empty for all')
+    parser.add_argument('--limit', type=int, default=500, help='Max number of cached pages')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='Use n synthetic pages instead of the cache (also used when the cache is empty)')
+    parser.add_argument('--lines', type=int, default=400, help='Lines per synthetic page')
+
+    args = parser.parse_args()
+
+    pages = [] if args.synthetic else load_cached_pages(args.identifier, args.limit)
+    source = 'cache'
+    if not pages:
+        pages = synthetic_pages(args.synthetic or 100, args.lines)
+        source = 'synthetic'
+
+    # 先确认结果相同
+    mismatches = sum(web_utils.strip_boilerplate(p) != web_utils._strip_boilerplate_by_line(p) for p in pages)
+
+    total_mb = sum(len(p) for p in pages) / 1e6
+    print(f'{len(pages)} pages from {source}, {total_mb:.2f}M chars, {args.rounds} rounds, mismatches: {mismatches}')
+    print()
+    print(f'{"Function":<24} {"Old (s)":<10} {"New (s)":<10} {"Speedup":<8} {"New MB/s":<8}')
+    print('-' * 64)
+
+    for name, old, new in [
+        ('extract_links (lines)', extract_per_line(web_utils._extract_links_from_markdown_charwise),
+         extract_per_line(web_utils.extract_links_from_markdown)),
+        ('strip_boilerplate', web_utils._strip_boilerplate_by_line, web_utils.strip_boilerplate),
+    ]:
+        old_time = bench(old, pages, args.rounds)
+        new_time = bench(new, pages, args.rounds)
+        print(f'{name:<24} {old_time:<10.3f} {new_time:<10.3f} {old_time / new_time:<8.1f} '
+              f'{total_mb * args.rounds / new_time:<8.1f}')
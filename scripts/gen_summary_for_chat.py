@@ -17,6 +17,8 @@ if __name__ == '__main__':
     parser.add_argument('-m2', '--model2', type=str, default='gemini-2.5-pro', help='The model to use for generating summary')
     parser.add_argument('-p', '--prompt', type=str, default='v2')
     parser.add_argument('-u', '--use_cases', type=lambda s: s.split(','), default=[])
+    parser.add_argument('--batch', action='store_true', default=False, help='Submit all requests as one batch (cheaper, slower)')
+    parser.add_argument('--poll_interval', type=float, default=60, help='Seconds between batch status checks')
 
     args = parser.parse_args()
 
@@ -45,30 +47,34 @@ if __name__ == '__main__':
         model_id = llm.get_model(args.model)
         model_id2 = llm.get_model(args.model2) if args.model2 else None
 
-        for key in to_be_summarized:
-            print(f'正在处理 {key}...')
-            contents = storage_obj.load(key + '.txt')
-
-            answer = llm.chat(
+        def summarize(contents):
+            # 主模型失败时自动切换到备用模型
+            return llm.chat(
                 prompt=prompt,
                 contents=contents,
                 model_id=model_id,
                 use_case='gen_conversation_summary',
                 save=False,
                 retries=1,
-                throw_ex=False
+                throw_ex=False,
+                fallback=[model_id2] if model_id2 else None,
             )
 
-            if answer is None and model_id2:
-                print(f'使用备用模型 {model_id2} 处理 {key}...')
-                answer = llm.chat(
-                    prompt=prompt,
-                    contents=contents,
-                    model_id=model_id2,
-                    use_case='gen_conversation_summary',
-                    save=False,
-                    retries=1,
-                    throw_ex=False
-                )
+        keys = sorted(to_be_summarized)
+        if args.batch and keys:
+            # 所有请求作为一个batch提交, batch中失败的再逐个同步调用
+            contents_list = [storage_obj.load(key + '.txt') for key in keys]
+            results = llm.chat_batch(prompt, contents_list, model_id, use_case='gen_conversation_summary',
+                                     save=False, poll_interval=args.poll_interval)
+            for key, contents, result in zip(keys, contents_list, results):
+                answer = result[0] if result else summarize(contents)
+                if answer:
+                    storage_obj.save(key + '.summary.txt', answer.strip() + '\n')
+            continue
+
+        for key in keys:
+            print(f'正在处理 {key}...')
+            contents = storage_obj.load(key + '.txt')
 
+            answer = summarize(contents)
             storage_obj.save(key + '.summary.txt', answer.strip() + '\n')
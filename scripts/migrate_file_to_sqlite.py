@@ -5,7 +5,7 @@ import fnmatch
 
 from chat_with_llm import storage
 
-VALID_STORAGE_TYPES = ['chat_history', 'web_cache', 'subtitle_cache', 'video_summary', 'browser_state']
+VALID_STORAGE_TYPES = ['chat_history', 'web_cache', 'subtitle_cache', 'video_summary', 'browser_state', 'llm_cache']
 
 def migrate(storage_type, identifier, pattern, mode, dry_run=False, src=None, dst=None):
     if src is None:
@@ -0,0 +1,91 @@
+import argparse
+import json
+
+from chat_with_llm.web import c4ai
+from chat_with_llm.web import online_content as oc
+
+SUFFIXES = ['.meta', '.raw', '.parsed']
+
+def rekey(retriever, dry_run=False):
+    """
+    按当前的url_key (规范化的URL) 重新生成缓存的site_id, 保留原来的时间标签.
+    新的site_id已经存在时 (同一页面的不同写法在同一缓存周期内都抓取过), 保留已有的, 删除旧的.
+    returns: (moved, merged, unchanged, skipped)
+    """
+    store = retriever.storage
+    site_ids = sorted({k[:-len('.meta')] for k in store.list() if k.endswith('.meta')})
+
+    moved = 0
+    merged = 0
+    unchanged = 0
+    skipped = 0
+    # dry-run时没有实际写入, 记录已经移动到的新site_id
+    targets = set()
+
+    for site_id in site_ids:
+        try:
+            url = json.loads(store.load(site_id + '.meta')).get('url')
+        except (TypeError, ValueError):
+            url = None
+
+        parts = site_id.rsplit('_', 1)
+        if not url or len(parts) != 2 or not parts[1].isdigit():
+            print(f'  [skip] {site_id}: no url in meta or no time tag')
+            skipped += 1
+            continue
+
+        new_id = retriever.url_key(url) + '_' + parts[1]
+        if new_id == site_id:
+            unchanged += 1
+            continue
+
+        exists = new_id in targets or store.has(new_id + '.meta')
+        targets.add(new_id)
+        action = 'merge' if exists else 'move'
+        if dry_run:
+            print(f'  [{action}] {site_id} -> {new_id} ({url})')
+        else:
+            for suffix in SUFFIXES:
+                if not store.has(site_id + suffix):
+                    continue
+                if not exists:
+                    store.save(new_id + suffix, store.load(site_id + suffix))
+                store.delete(site_id + suffix)
+
+        if exists:
+            merged += 1
+        else:
+            moved += 1
+
+    return moved, merged, unchanged, skipped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='按规范化的 URL 重新生成 web_cache 中 crawl4ai 缓存的 key (保留时间标签)'
+    )
+    parser.add_argument(
+        'retrievers',
+        nargs='*',
+        default=['crawl4ai'],
+        help='使用 Crawl4AI 的 url2id 的 retriever 名称, 默认 crawl4ai'
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='预览模式, 不实际执行'
+    )
+
+    args = parser.parse_args()
+
+    for name in args.retrievers:
+        retriever = oc.get_online_retriever(name)
+        if not isinstance(retriever, c4ai.Crawl4AI) or type(retriever).url2id is not c4ai.Crawl4AI.url2id:
+            print(f'[{name}] 不使用 Crawl4AI 的 url2id, 跳过')
+            continue
+
+        prefix = f'[web_cache/{retriever.name}]'
+        print(f'{prefix} (dry-run)' if args.dry_run else prefix)
+
+        moved, merged, unchanged, skipped = rekey(retriever, args.dry_run)
+        print(f'{prefix} moved={moved}, merged={merged}, unchanged={unchanged}, skipped={skipped}')
@@ -0,0 +1,67 @@
+import argparse
+import datetime
+import json
+
+from chat_with_llm import accounting
+from chat_with_llm import llm
+
+# (字段, 标题, 宽度, 格式)
+COLUMNS = [
+    ('calls', 'Calls', 7, 'd'),
+    ('cache_hits', 'Hits', 6, 'd'),
+    ('prompt_tokens', 'Prompt', 13, ',d'),
+    ('cached_tokens', 'Cached', 13, ',d'),
+    ('completion_tokens', 'Completion', 13, ',d'),
+    ('reasoning_tokens', 'Reasoning', 13, ',d'),
+    ('avg_latency', 'Latency(s)', 10, '.1f'),
+    ('cost', 'Cost', 10, '.4f'),
+]
+
+def format_row(labels, widths, values):
+    line = ' '.join(f'{label:<{w}}' for label, w in zip(labels, widths))
+    for key, _, width, fmt in COLUMNS:
+        value = values.get(key)
+        line += ' ' + (f'{value:>{width}{fmt}}' if value is not None else f'{"-":>{width}}')
+    return line
+
+def print_table(rows, group_by):
+    widths = [max([len(k)] + [len(str(r[k])) for r in rows]) for k in group_by]
+    header = ' '.join(f'{k:<{w}}' for k, w in zip(group_by, widths))
+    header += ' ' + ' '.join(f'{title:>{width}}' for _, title, width, _ in COLUMNS)
+    print(header)
+    print('-' * len(header))
+
+    for r in rows:
+        print(format_row([str(r[k]) for k in group_by], widths, r))
+
+    totals = {key: sum(r[key] or 0 for r in rows) for key, _, _, _ in COLUMNS if key != 'avg_latency'}
+    if all(r.get('cost') is None for r in rows):
+        totals['cost'] = None
+    print('-' * len(header))
+    print(format_row(['total'] + [''] * (len(group_by) - 1), widths, totals))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report LLM token usage and cost')
+
+    parser.add_argument('-b', '--by', nargs='+', default=['use_case', 'model'], choices=accounting.GROUP_BY_FIELDS,
+                        help='Fields to group by')
+    parser.add_argument('-d', '--days', type=int, default=30, help='Only include the last n days')
+    parser.add_argument('-u', '--use_case', default=None)
+    parser.add_argument('-m', '--model', default=None, help='Model id or alias')
+    parser.add_argument('--sort', default=None, help='Sort by a column, e.g. cost or prompt_tokens (descending)')
+    parser.add_argument('--json', action='store_true', help='Output as JSON')
+
+    args = parser.parse_args()
+
+    since = (datetime.date.today() - datetime.timedelta(days=args.days - 1)).strftime('%Y%m%d')
+    model = llm.get_model(args.model, fail_on_unknown=False) if args.model else None
+
+    rows = accounting.get_usage_log().summarize(group_by=args.by, since=since, use_case=args.use_case, model=model,
+                                                get_price=llm.get_model_price)
+    if args.sort:
+        rows.sort(key=lambda r: r.get(args.sort) or 0, reverse=True)
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(rows, args.by)
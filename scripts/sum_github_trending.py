@@ -5,7 +5,7 @@ import time
 from typing import List, Dict, Any
 from urllib.parse import urljoin
 
-from chat_with_llm import llm, logutils
+from chat_with_llm import llm, logutils, tokens
 from chat_with_llm.web import online_content as oc
 
 SEPARATOR = '-' * 80
@@ -203,6 +203,7 @@ if __name__ == "__main__":
     parser.add_argument('-s', '--since', type=str, default='daily', choices=['daily', 'weekly', 'monthly'], help='Time range for trending')
     parser.add_argument('--top_n', type=int, default=10, help='Number of top projects to process')
     parser.add_argument('--min_stars', type=int, default=100, help='Minimum number of stars to consider')
+    parser.add_argument('--readme_tokens', type=int, default=1000, help='Max tokens of README preview for each project')
     parser.add_argument('-d', '--dedup_n', type=int, default=30, help='Remove duplicate projects from the last n runs.')
     parser.add_argument('--llm_use_case', type=str, default='sum_github_trending', help='The use case for the llm model')
     parser.add_argument('--use_proxy', action='store_true', default=True, help='Use proxy for GitHub access')
@@ -338,8 +339,8 @@ if __name__ == "__main__":
         contents += f'编程语言: {project["language"]}\n'
         contents += f'星标总数: {project["stars"]} (今日新增: {project["stars_today"]})\n'
 
-        # README内容（截断以避免过长）
-        readme_preview = project['readme_content'][:3000] if project['readme_content'] else '（无README内容）'
+        # README内容（按token数截断以避免过长）
+        readme_preview = tokens.truncate_to_tokens(project['readme_content'], args.readme_tokens, model_id) if project['readme_content'] else '（无README内容）'
         contents += f'README预览:\n{readme_preview}\n'
 
     logger.info('Starting analysis with model %s...', model_id)
@@ -355,6 +356,7 @@ if __name__ == "__main__":
                        contents=contents,
                        model_id=model_id,
                        use_case=args.llm_use_case,
-                       save=True)
+                       save=True,
+                       on_overflow='trim')
 
     logger.result(message)
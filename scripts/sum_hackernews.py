@@ -206,6 +206,7 @@ if __name__ == "__main__":
 
     logger.info('开始使用模型%s进行分析...', model_id)
 
+    # 文章已按评论数降序排列, 超出上下文窗口时截掉尾部评论较少的文章
     message = llm.chat(prompt=prompt, contents=contents, model_id=model_id,
-                       use_case=args.llm_use_case, save=True)
+                       use_case=args.llm_use_case, save=True, on_overflow='trim')
     logger.result(message)
@@ -4,9 +4,16 @@ import time
 
 from tqdm import tqdm
 
-from chat_with_llm import llm, logutils
+from chat_with_llm import llm, logutils, mapreduce
 from chat_with_llm.web import online_content as oc
 
+CONTENTS_SEP = '=' * 80 + '\n'
+
+def split_hn_contents(contents):
+    # 文章部分按段落切分, 评论部分按顶层评论的子树切分
+    article, _, comments = contents.partition(CONTENTS_SEP)
+    return mapreduce.split_paragraphs(article) + mapreduce.split_indented_tree(comments)
+
 
 if __name__ == "__main__":
     dict_item_converter = lambda s: tuple([s[:s.index('=')], s[s.index('=')+1:]]) if '=' in s else (s, None)
@@ -51,6 +58,8 @@ if __name__ == "__main__":
 
     parser.add_argument('--llm_use_case', type=str, default='sum_hn_comments', help='The use case for the llm model')
     parser.add_argument('--model_alt', default='gemini-2.5-pro', help='The alternative model to use for generating summary')
+    parser.add_argument('--hedge', action='store_true', default=False, help='Also send slow requests to model_alt, take the first to finish')
+    parser.add_argument('--hedge_after', type=float, default=60, help='Hedge threshold in seconds before enough latency samples')
     parser.add_argument('--daily_topn', type=int, default=15, help='The number of daily top articles to retrieve')
     parser.add_argument('--min_comments', type=int, default=30, help='The minimum number of comments to retrieve')
     parser.add_argument('--skip_processed', action='store_true', default=False, help='Skip processed articles')
@@ -156,20 +165,16 @@ if __name__ == "__main__":
 
     article_urls = dict(article_urls)
 
-    seq = 0
-    seq_retry = False
-    while seq < len(urls):
-        comment_url = urls[seq]
+    model_id = llm.get_model(args.model)
+    model_id_alt = llm.get_model(args.model_alt) if args.model_alt else None
+
+    for seq, comment_url in enumerate(urls):
         comments = article_comments[seq]
 
         if not comments:
             logger.error('Failed to retrieve comments for %s', comment_url)
-            seq += 1
             continue
 
-        model_id = llm.get_model(args.model)
-        model_id_alt = llm.get_model(args.model_alt)
-
         contents = ''
 
         url = article_urls.get(seq)
@@ -178,36 +183,27 @@ if __name__ == "__main__":
         contents += f'article url: {url}\n' if url else ''
         contents += f'comment url: {comment_url}\n\n'
         contents += ('artitle:\n' + article + '\n') if article else ''
-        contents += '=' * 80 + '\n'
+        contents += CONTENTS_SEP
 
         contents += comments + '\n'
 
-        model_to_use = model_id if not seq_retry else model_id_alt
-        
         t0 = time.time()
         try:
-            logger.info('Summarizing %s with %s (%d bytes) ...', comment_url, model_to_use, len(contents))
-            message, reasoning, filename = llm.chat_impl(
+            logger.info('Summarizing %s with %s (%d bytes) ...', comment_url, model_id, len(contents))
+            # 评论过多时按文章段落和评论子树分块并发摘要后合并. 失败时由llm自动切换到备用模型
+            message = mapreduce.summarize(
                 prompt=prompt,
                 contents=contents,
-                model_id=model_to_use,
+                model_id=model_id,
+                splitter=split_hn_contents,
                 use_case=args.llm_use_case,
-                save=True)
+                save=True,
+                fallback=[model_id_alt] if model_id_alt else None,
+                hedge={'backup': model_id_alt, 'after': args.hedge_after} if args.hedge and model_id_alt else None)
         except Exception as e:
-            
             logger.error('Failed!')
             logger.error('Error: %s', e)
-
-            # 如果失败了, 先尝试使用备用模型
-            if not seq_retry:
-                seq_retry = True
-                continue
-            else:
-                seq += 1
-                seq_retry = False
-                continue
+            continue
 
         t1 = time.time()
-        seq += 1
-        seq_retry = False
         logger.info('Success (%.2f seconds).', t1 - t0)
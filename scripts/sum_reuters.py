@@ -5,6 +5,7 @@ import sys
 
 from chat_with_llm import llm
 from chat_with_llm import logutils
+from chat_with_llm.web import boilerplate
 from chat_with_llm.web import online_content as oc
 from chat_with_llm.web import utils as web_utils
 
@@ -22,7 +23,7 @@ if __name__ == "__main__":
     parser.add_argument('-n', '--news_count', type=int, default=15, help='The number of news articles to retrieve')
     parser.add_argument('--home_url', type=str, default='https://www.reuters.com/business/', help='The home URL to retrieve news from') 
     parser.add_argument('--llm_use_case', type=str, default='sum_reuters', help='The use case for the llm model')
-    parser.add_argument('--boilerplate_threshold', type=int, default=3, help='The threshold for boilerplate content')
+    parser.add_argument('--boilerplate_threshold', type=int, default=3, help='Lines seen on at least this many pages of a site are boilerplate')
     parser.add_argument('--params', nargs='+', type=dict_item_converter, default=[], help='Parameters for the online retriever')
     parser.add_argument('-q', '--quiet', action='store_true', default=False, help='静默模式，只显示错误信息（不显示进度和结果）')
 
@@ -47,6 +48,7 @@ if __name__ == "__main__":
         parser='markdown',
         use_proxy=True,
         strip_boilerplate=True,
+        learn_boilerplate=True,
         cache_expire=24*7,
         mean_delay='10',
         **dict(args.params))
@@ -75,19 +77,24 @@ if __name__ == "__main__":
 
     articles_contents = list(sub_retriever.retrieve_many(urls))
 
+    # 按网站累积的行频率去掉样板, 只有一篇文章时也有效
+    line_model = boilerplate.get_line_model(threshold=args.boilerplate_threshold)
+
     raw_contents = ''
     article_sep = '-' * 80
     for item, s in zip(items, articles_contents):
         if not s:
             continue
 
+        s = line_model.strip(item['url'], s)
+
         if raw_contents:
             raw_contents += article_sep + '\n'
 
         raw_contents += f'({item["text"]})[{item["url"]}]\n'
         raw_contents += s + '\n'
 
-    # 通过统计多篇文章中出现的相同的行数来判断是否是多余的内容
+    # 通过统计本次多篇文章中出现的相同的行数来判断是否是多余的内容 (行频率统计还没有积累时)
     contents = web_utils.remove_duplicated_lines(raw_contents, args.boilerplate_threshold, whitelist_prefixes=[article_sep])
 
     logger.info('开始使用模型%s进行分析...', model_id)
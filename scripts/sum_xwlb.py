@@ -7,7 +7,7 @@ from tqdm import tqdm
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from chat_with_llm import llm, logutils
+from chat_with_llm import llm, logutils, mapreduce
 from chat_with_llm.web import online_content as oc
 
 if __name__ == '__main__':
@@ -72,8 +72,9 @@ if __name__ == '__main__':
             continue
 
         save_date = key_date if cur_date != key_date and args.use_news_date else None
-        message = llm.chat(
+        message = mapreduce.summarize(
             prompt=prompt, contents=contents, model_id=model_id,
+            splitter=mapreduce.split_paragraphs,
             use_case=args.llm_use_case, save=True, save_date=save_date,
             prompt_follow_contents=args.prompt_follow_contents,
             retries=3, throw_ex=False)
@@ -83,9 +84,5 @@ if __name__ == '__main__':
             continue
         
         outputs += f'{key_date}\n{message}\n\n'
-
-        delay = llm.get_model_query_delay(args.model)
-        if delay:
-            time.sleep(delay)
     
     
\ No newline at end of file
@@ -11,6 +11,7 @@ import downsub
 import argparse
 
 from chat_with_llm import llm
+from chat_with_llm import mapreduce
 from chat_with_llm import storage
 from chat_with_llm import logutils
 
@@ -204,7 +205,9 @@ if __name__ == '__main__':
     logger.info('Parsing subtitle using %s.', model_id)
     contents_url = f'视频地址: {youtube_link}\n'
     message = contents_url + contents_text
-    summary = llm.chat(prompt, message, model_id, use_case='sum_youtube', save=True)
+    # 字幕过长时按段落分块并发摘要后合并
+    summary = mapreduce.summarize(prompt, message, model_id, splitter=mapreduce.split_paragraphs,
+                                  use_case='sum_youtube', save=True)
     logger.result(summary)
 
     # 保存结果
@@ -0,0 +1,293 @@
+"""
+使用本地stub测试llm模块的重试, 备用模型, 流式调用和并发. 不需要网络, 但需要 ~/.chat_with_llm 下的配置文件.
+
+    python tests/test_llm_stub.py
+    python -m pytest tests/test_llm_stub.py
+"""
+
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from chat_with_llm import accounting
+from chat_with_llm import config
+from chat_with_llm import llm
+from chat_with_llm import openai_stub
+from chat_with_llm import ratelimit
+from chat_with_llm import resilience
+from chat_with_llm import singleflight
+from chat_with_llm import tokens
+
+# 测试用的模型. 写到临时的models.yaml中, config.yaml仍使用 ~/.chat_with_llm 下的
+STUB_MODELS = """
+- name: 'stub-chat'
+- name: 'stub-system'
+  message_layout: 'system'
+- name: 'stub-retry'
+- name: 'stub-broken'
+- name: 'stub-backup'
+- name: 'stub-stream'
+- name: 'stub-disconnect'
+- name: 'stub-concurrent'
+- name: 'stub-coalesce'
+- name: 'stub-primary'
+- name: 'stub-slow'
+- name: 'stub-slow-probe'
+- name: 'stub-fast'
+- name: 'stub-batch'
+- name: 'stub-batch-small'
+  context_window: 1000
+"""
+
+_config_dir = None
+def _use_stub_models():
+    global _config_dir
+    if _config_dir is None:
+        _config_dir = tempfile.mkdtemp()
+        with open(os.path.join(_config_dir, 'models.yaml'), 'w') as f:
+            f.write(STUB_MODELS)
+
+    os.environ['CHAT_WITH_LLM_CONFIG_DIR'] = _config_dir
+    config.reload_models()
+
+def _use_stub(server):
+    # 配置中环境变量优先, 聊天记录和限速状态写到临时目录
+    os.environ['OPENAI_API_BASE'] = server.base_url
+    os.environ['OPENAI_API_KEY'] = 'stub'
+    os.environ['STORAGE_BASE_DIR'] = tempfile.mkdtemp()
+    config.reload()
+    _use_stub_models()
+    llm.llm_storages.clear()
+
+def test_chat_with_reasoning():
+    with openai_stub.StubServer(latency=0, reasoning_tokens=4, output_tokens=8) as server:
+        _use_stub(server)
+        response, reasoning, filename = llm.chat_impl('prompt', 'contents', 'stub-chat', use_case='test')
+
+        assert response == ' '.join(f'tok{i}' for i in range(8))
+        assert reasoning == ' '.join(f'think{i}' for i in range(4))
+        assert filename and llm.get_storage('test').has(filename)
+        # 默认的prefix布局与原来的请求相同
+        assert server.requests[0]['messages'] == [{'role': 'user', 'content': 'prompt\ncontents'}]
+
+def test_message_layout():
+    with openai_stub.StubServer(latency=0) as server:
+        _use_stub(server)
+        llm.chat('prompt', 'contents', 'stub-system', save=False)
+        llm.chat('prompt', 'contents', 'stub-system', save=False, prompt_follow_contents=True)
+
+        assert server.requests[0]['messages'] == [{'role': 'system', 'content': 'prompt'},
+                                                  {'role': 'user', 'content': 'contents'}]
+        assert server.requests[1]['messages'] == [{'role': 'user', 'content': 'contents\nprompt'}]
+
+def test_retry_after_rate_limit():
+    with openai_stub.StubServer(latency=0, fail_first=2, retry_after=0) as server:
+        _use_stub(server)
+        response = llm.chat('prompt', 'contents', 'stub-retry', save=False, retries=2)
+
+        assert response
+        assert server.counts == {'requests': 3, 'ok': 1, '429': 2}
+
+def test_fallback_on_server_error():
+    # 备用模型必须是已配置的模型 (STUB_MODELS)
+    model_options = {'stub-broken': {'errors': {500: 1.0}}}
+    with openai_stub.StubServer(latency=0, model_options=model_options) as server:
+        _use_stub(server)
+        response, _, filename = llm.chat_impl('prompt', 'contents', 'stub-broken', use_case='test',
+                                              retries=0, fallback=['stub-backup'])
+
+        assert response
+        assert filename.endswith('_stub-backup.txt')
+        assert [r['model'] for r in server.requests] == ['stub-broken', 'stub-backup']
+
+def test_breaker_probe_released_on_non_retryable_error():
+    breaker = resilience.get_circuit_breaker('stub-probe')
+    breaker.recovery_time = 0
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+
+    # half-open的探测请求遇到不可重试的错误: 释放探测名额, 不重新打开
+    plan = resilience.FailoverPlan(['stub-probe'])
+    for model in plan:
+        plan.record_failure(model, ValueError('bad request'))
+        break
+
+    assert not breaker.probing
+    assert breaker.allow()
+    breaker.record_success()
+
+def test_stream():
+    with openai_stub.StubServer(latency=0.05, token_rate=200, reasoning_tokens=2, output_tokens=10) as server:
+        _use_stub(server)
+        stream = llm.chat_stream('prompt', 'contents', 'stub-stream', use_case='test')
+        kinds = [kind for kind, _ in stream]
+
+        assert kinds == ['reasoning'] * 2 + ['content'] * 10
+        assert stream.stats['complete']
+        assert stream.stats['completion_tokens'] == 12
+        assert stream.stats['ttft'] >= 0.05
+
+def test_stream_disconnect_keeps_partial():
+    with openai_stub.StubServer(latency=0, errors={'disconnect': 1.0}, output_tokens=10) as server:
+        _use_stub(server)
+        stream = llm.chat_stream('prompt', 'contents', 'stub-disconnect', use_case='test', retries=0)
+        try:
+            for _ in stream:
+                pass
+            assert False, 'expected a connection error'
+        except llm.openai.APIConnectionError:
+            pass
+
+        assert stream.response == ' '.join(f'tok{i}' for i in range(5))
+        assert not stream.stats['complete']
+        assert llm.get_storage('test').has(stream.filename)
+
+def test_concurrent_chats():
+    with openai_stub.StubServer(latency=0.2, token_rate=0) as server:
+        _use_stub(server)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(lambda i: llm.chat('prompt', str(i), 'stub-concurrent', save=False),
+                                          range(8)))
+
+        assert all(responses)
+        assert server.counts['ok'] == 8
+
+def test_coalesce_identical_requests():
+    with openai_stub.StubServer(latency=0.3, token_rate=0) as server:
+        _use_stub(server)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda i: llm.chat_impl('prompt', 'same', 'stub-coalesce', use_case='test',
+                                                                        coalesce=True),
+                                        range(4)))
+
+        assert server.counts['requests'] == 1
+        assert results[0][0] and all(r == results[0] for r in results)
+
+def test_single_flight_across_instances():
+    # 两个实例使用同一个数据库, 模拟两个进程
+    db_path = os.path.join(tempfile.mkdtemp(), 'singleflight.db')
+    first = singleflight.SingleFlight(db_path)
+    second = singleflight.SingleFlight(db_path, poll_interval=0.05)
+
+    def slow():
+        time.sleep(0.3)
+        return ['result']
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(first.do, 'key', slow)
+        time.sleep(0.1)
+        follower = executor.submit(second.do, 'key', lambda: ['not used'])
+
+        assert leader.result() == (['result'], False)
+        assert follower.result() == (['result'], True)
+
+    # 完成之后才发出的相同请求不共享结果
+    assert second.do('key', lambda: ['again']) == (['again'], False)
+
+def test_state_follows_storage_dir():
+    # config.reload()改变STORAGE_BASE_DIR后, 跨进程的状态写到新的llm_state下
+    for _ in range(2):
+        os.environ['STORAGE_BASE_DIR'] = base = tempfile.mkdtemp()
+        config.reload()
+        state_dir = os.path.join(base, 'llm_state')
+        assert os.path.dirname(ratelimit.get_rate_limiter().db_path) == state_dir
+        assert os.path.dirname(accounting.get_usage_log().db_path) == state_dir
+        assert os.path.dirname(singleflight.get_single_flight().db_path) == state_dir
+
+def test_token_calibration_across_instances():
+    # 两个实例使用同一个数据库, 模拟两个进程: 更新基于数据库中的当前值, 不会互相覆盖
+    db_path = os.path.join(tempfile.mkdtemp(), 'token_calibration.db')
+    first = tokens.CalibrationStore(db_path)
+    second = tokens.CalibrationStore(db_path, cache_ttl=0)
+
+    assert first.get('m') == 1.0
+    assert first.update('m', 2.0, weight=0.5) == 2.0
+    assert second.update('m', 1.0, weight=0.5) == 1.5
+    assert second.get('m') == 1.5
+    # first的缓存还没有过期
+    assert first.get('m') == 2.0
+
+def test_hedge_slow_primary():
+    model_options = {'stub-slow': {'latency': 3}}
+    with openai_stub.StubServer(latency=0, token_rate=0, model_options=model_options) as server:
+        _use_stub(server)
+        t0 = time.time()
+        response, _, filename = llm.chat_impl('prompt', 'contents', 'stub-slow', use_case='test',
+                                              hedge={'backup': 'stub-fast', 'after': 0.2})
+
+        assert response
+        assert time.time() - t0 < 2
+        assert filename.endswith('_stub-fast.txt')
+        stats = json.loads(llm.get_storage('test').load(filename[:-len('.txt')] + '.stats.json'))
+        assert stats['hedge']['fired'] and stats['hedge']['winner'] == 'stub-fast'
+        assert [r['model'] for r in server.requests] == ['stub-slow', 'stub-fast']
+
+def test_hedge_loser_releases_probe_and_records_usage():
+    model_options = {'stub-slow-probe': {'latency': 1}}
+    breaker = resilience.get_circuit_breaker('stub-slow-probe')
+    # 熔断器处于half-open, 下一个请求是探测
+    breaker.opened_at = time.time() - breaker.recovery_time - 1
+    with openai_stub.StubServer(latency=0, token_rate=0, model_options=model_options) as server:
+        _use_stub(server)
+        response, _, filename = llm.chat_impl('prompt', 'contents', 'stub-slow-probe', use_case='test',
+                                              hedge={'backup': 'stub-fast', 'after': 0.2})
+
+        assert filename.endswith('_stub-fast.txt')
+        # 输掉的主模型释放了探测名额, 下一个请求可以继续探测
+        assert not breaker.probing and breaker.allow()
+        breaker.record_success()
+
+        # 被取消的请求在连接关闭后记录估计的用量
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            rows = accounting.get_usage_log().summarize(group_by=('model',), model='stub-slow-probe')
+            if rows:
+                break
+            time.sleep(0.1)
+        assert rows and rows[0]['calls'] == 1 and rows[0]['incomplete'] == 1 and rows[0]['prompt_tokens'] > 0
+
+def test_hedge_not_fired_for_fast_primary():
+    with openai_stub.StubServer(latency=0, token_rate=0) as server:
+        _use_stub(server)
+        response, _, filename = llm.chat_impl('prompt', 'contents', 'stub-primary', use_case='test',
+                                              hedge={'backup': 'stub-fast', 'after': 1})
+
+        assert response
+        assert filename.endswith('_stub-primary.txt')
+        assert server.counts['requests'] == 1
+
+def test_batch():
+    with openai_stub.StubServer(batch_latency=0.1, fail_first=1, fail_kind=500, reasoning_tokens=2) as server:
+        _use_stub(server)
+        batch_id = llm.submit_batch('prompt', ['a', 'b', 'c'], 'stub-batch', use_case='test', save_date='20250101')
+        results = llm.wait_batch(batch_id, use_case='test', poll_interval=0.05, timeout=10)
+
+        assert results[0] is None
+        for response, reasoning, filename in results[1:]:
+            assert response and reasoning
+            assert filename.startswith('20250101_') and llm.get_storage('test').has(filename)
+        assert [r['messages'][0]['content'] for r in server.requests] == ['prompt\na', 'prompt\nb', 'prompt\nc']
+
+        # 结果已保存, 再次调用不会重复保存
+        assert llm.wait_batch(batch_id, use_case='test') == results
+
+def test_batch_overflow_reported_before_submit():
+    with openai_stub.StubServer() as server:
+        _use_stub(server)
+        contents = ['short', 'x' * 20000, 'short', 'y' * 20000]
+        try:
+            llm.submit_batch('prompt', contents, 'stub-batch-small', use_case='test')
+            assert False, 'expected ValueError'
+        except ValueError as ex:
+            assert '2 of 4' in str(ex) and '1 (~' in str(ex) and '3 (~' in str(ex)
+
+        # 没有上传文件或创建batch
+        assert not server.files and not server.batches
+
+if __name__ == '__main__':
+    for name, func in list(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print(f'{name}: OK')
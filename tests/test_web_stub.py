@@ -0,0 +1,276 @@
+"""
+使用本地的LinkSeek stub测试网页抓取的并发控制. 不需要网络, 但需要 ~/.chat_with_llm 下的配置文件.
+
+    python tests/test_web_stub.py
+    python -m pytest tests/test_web_stub.py
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+from chat_with_llm import config
+from chat_with_llm.web import boilerplate
+from chat_with_llm.web import c4ai
+from chat_with_llm.web import linkseek
+from chat_with_llm.web import linkseek_stub
+from chat_with_llm.web import online_content
+
+def _use_stub(server):
+    # 配置中环境变量优先, 网页缓存写到临时目录
+    os.environ['LINKSEEK_BASE_URL'] = server.base_url
+    os.environ['STORAGE_BASE_DIR'] = tempfile.mkdtemp()
+    config.reload()
+
+def test_async_fetch_bounded():
+    with linkseek_stub.StubServer(latency=0.1) as server:
+        _use_stub(server)
+        retriever = c4ai.Crawl4AI(num_workers=3)
+        urls = [f'https://example.com/{i}' for i in range(12)]
+        results = retriever.retrieve_many(urls)
+
+        assert [r.splitlines()[0] for r in results] == [f'# {url}' for url in urls]
+        assert server.counts['ok'] == 12
+        assert server.max_in_flight <= 3
+        # 连接池复用连接, 不会每个请求新建连接
+        assert server.connections <= 3
+
+def test_async_fetch_timeout_and_errors():
+    with linkseek_stub.StubServer(latency=0.3) as server:
+        _use_stub(server)
+        retriever = c4ai.Crawl4AI(num_workers=2, fetch_timeout=0.1, batch_crawl=False)
+        assert retriever.retrieve_many(['https://example.com/a', 'https://example.com/b']) == [None, None]
+
+    # 400错误不重试
+    with linkseek_stub.StubServer(latency=0, fail_first=1, fail_status=400) as server:
+        _use_stub(server)
+        retriever = c4ai.Crawl4AI(num_workers=1, batch_crawl=False)
+        urls = ['https://example.com/a', 'https://example.com/b']
+        results = retriever.retrieve_many(urls)
+
+        # 两个URL的请求顺序不确定, 先到达的返回400
+        failed = urls.index(server.requests[0]['url'])
+        assert results[failed] is None and results[1 - failed]
+        assert server.counts[400] == 1
+
+def test_crawl_batch_completion_order():
+    def responder(url, formats):
+        # 第一个URL最慢, 应该最后返回
+        if url.endswith('/0'):
+            time.sleep(0.4)
+        return f'# {url}'
+
+    with linkseek_stub.StubServer(latency=0.05, responder=responder) as server:
+        _use_stub(server)
+        urls = [f'https://example.com/{i}' for i in range(6)]
+        results = list(linkseek.crawl_batch(urls, concurrency=6, formats=['markdown']))
+
+        assert server.counts['batches'] == 1 and server.counts['ok'] == 6
+        assert results[-1][0] == 0
+        assert sorted((i, r[2]) for i, r, _ in results) == [(i, f'# {url}') for i, url in enumerate(urls)]
+
+def test_crawl_batch_fallback():
+    with linkseek_stub.StubServer(latency=0.05, batch=False) as server:
+        _use_stub(server)
+        retriever = c4ai.Crawl4AI(num_workers=4)
+        urls = [f'https://example.com/{i}' for i in range(8)]
+        results = retriever.retrieve_many(urls)
+
+        assert all(results)
+        assert 'batches' not in server.counts and server.counts['ok'] == 8
+        assert server.max_in_flight <= 4
+
+def test_crawl_batch_stops_with_consumer():
+    with linkseek_stub.StubServer(latency=0.05, batch=False) as server:
+        _use_stub(server)
+        urls = [f'https://example.com/{i}' for i in range(20)]
+        for _ in linkseek.crawl_batch(urls, concurrency=2, formats=['markdown']):
+            break
+
+        # 队列满后后台暂停读取结果, 提前停止迭代后不再抓取剩下的URL
+        time.sleep(1)
+        assert server.counts['ok'] < 10
+
+class _CountingRetriever(online_content.OnlineContent):
+    # 同步的retriever, 只记录fetch的次数
+    def __init__(self, **params):
+        super().__init__(name='counting', **params)
+        self.fetched = 0
+        self.lock = threading.Lock()
+
+    def url2id(self, url):
+        return url.rsplit('/', 1)[-1]
+
+    def id2url(self, site_id):
+        return f'https://example.com/{site_id}'
+
+    def list(self, n):
+        return []
+
+    def fetch(self, url):
+        with self.lock:
+            self.fetched += 1
+        time.sleep(0.01)
+        return url, {}, f'# {url}'
+
+    def parse(self, url, raw):
+        return raw
+
+def test_sync_iter_fetch_bounded():
+    os.environ['STORAGE_BASE_DIR'] = tempfile.mkdtemp()
+    config.reload()
+    retriever = _CountingRetriever(num_workers=2)
+    urls = [f'https://example.com/{i}' for i in range(50)]
+    assert all(r for r in retriever.fetch_many(urls))
+    assert retriever.fetched == 50
+
+    # 最多提交num_workers * 2个请求, 提前停止迭代后不再抓取
+    retriever.fetched = 0
+    for _ in retriever.iter_fetch(urls):
+        time.sleep(0.2)
+        break
+    time.sleep(0.2)
+    assert retriever.fetched <= 5
+
+def test_iter_retrieve_saves_as_completed():
+    def responder(url, formats):
+        if url.endswith('/0'):
+            time.sleep(0.5)
+        return f'# {url}'
+
+    with linkseek_stub.StubServer(latency=0, responder=responder) as server:
+        _use_stub(server)
+        retriever = c4ai.Crawl4AI(num_workers=4)
+        urls = [f'https://example.com/{i}' for i in range(4)]
+
+        order = []
+        for ind, url, parsed in retriever.iter_retrieve(urls):
+            # 产生时已经保存, 慢的URL不影响其他URL
+            assert url == urls[ind] and parsed == f'# {url}'
+            assert retriever.load_parsed(retriever.url2id(url)) == parsed
+            order.append(ind)
+
+        assert order[-1] == 0 and sorted(order) == [0, 1, 2, 3]
+        # 再次调用时全部来自缓存
+        assert [ind for ind, _, _ in retriever.iter_retrieve(urls)] == [0, 1, 2, 3]
+        assert server.counts['ok'] == 4
+
+def test_unchanged_page_not_reparsed():
+    version = ['v1']
+    with linkseek_stub.StubServer(latency=0, responder=lambda url, formats: f'# {url} {version[0]}') as server:
+        _use_stub(server)
+        retriever = c4ai.Crawl4AI(force_fetch=True)
+        parsed_urls = []
+        original_parse = retriever.parse
+        retriever.parse = lambda url, raw: parsed_urls.append(url) or original_parse(url, raw)
+
+        url = 'https://example.com/page'
+        assert retriever.retrieve(url, return_changed=True) == (f'# {url} v1', True)
+        assert retriever.retrieve(url, return_changed=True) == (f'# {url} v1', False)
+        assert len(parsed_urls) == 1
+
+        version[0] = 'v2'
+        assert retriever.retrieve(url, return_changed=True) == (f'# {url} v2', True)
+        assert len(parsed_urls) == 2 and server.counts['ok'] == 3
+
+def test_parse_in_process_pool():
+    def responder(url, formats):
+        return f'# {url}\n\n[a](https://a.com) [b](https://b.com)\n\ncontent of {url}\n'
+
+    with linkseek_stub.StubServer(latency=0, responder=responder) as server:
+        _use_stub(server)
+        urls = [f'https://example.com/{i}' for i in range(10)]
+        inline = c4ai.Crawl4AI(num_workers=4, strip_boilerplate=True).retrieve_many(urls)
+
+        retriever = c4ai.Crawl4AI(num_workers=4, strip_boilerplate=True, force_parse=True,
+                                  parse_processes=2, parse_chunksize=3, parse_min_batch=4)
+        assert retriever.use_parse_pool(len(urls)) and not retriever.use_parse_pool(3)
+        # 缓存的raw在子进程中重新解析, 结果与当前线程中解析的相同
+        assert retriever.retrieve_many(urls) == inline
+        assert retriever._parse_pool is not None
+
+        # 新抓取的页面也在子进程中解析并保存
+        new_urls = [f'https://example.com/new/{i}' for i in range(6)]
+        results = retriever.retrieve_many(new_urls, return_changed=True)
+        assert [changed for _, changed in results] == [True] * 6
+        for url, (parsed, _) in zip(new_urls, results):
+            assert parsed == retriever.parse(url, responder(url, ['markdown']))
+            assert retriever.load_parsed(retriever.url2id(url)) == parsed
+        assert server.counts['ok'] == 16
+
+def test_learn_boilerplate():
+    def responder(url, formats):
+        return f'Sign in | Subscribe\n\n# {url}\n\nbody of {url}\n'
+
+    with linkseek_stub.StubServer(latency=0, responder=responder) as server:
+        _use_stub(server)
+        retriever = c4ai.Crawl4AI(learn_boilerplate=True)
+        urls = [f'https://example.com/{i}' for i in range(3)]
+        assert all(retriever.retrieve_many(urls))
+        # 再次读取缓存不重复统计
+        assert all(retriever.retrieve_many(urls))
+
+        url = 'https://example.com/new'
+        assert boilerplate.get_line_model().strip(url, responder(url, ['markdown'])) == f'\n# {url}\n\nbody of {url}\n'
+
+def test_canonical_cache_key():
+    with linkseek_stub.StubServer(latency=0) as server:
+        _use_stub(server)
+        retriever = c4ai.Crawl4AI()
+        urls = ['https://www.example.com/post/1', 'http://example.com/post/1/', 'https://m.example.com/post/1#top',
+                'https://example.com/post/1?utm_source=hn&utm_medium=social']
+        assert len({retriever.url2id(url) for url in urls}) == 1
+
+        results = retriever.retrieve_many(urls)
+        # 同一页面只抓取一次
+        assert server.counts['ok'] == 1 and len(set(results)) == 1
+        assert retriever.url2id('https://example.com/post/2') != retriever.url2id(urls[0])
+
+def test_per_site_delay():
+    with linkseek_stub.StubServer(latency=0.05) as server:
+        _use_stub(server)
+        retriever = c4ai.Crawl4AI(num_workers=8, mean_delay=0.2, delay_jitter=0)
+        urls = [f'https://{site}/{i}' for i in range(4) for site in ('www.a.com', 'b.org')]
+        t0 = time.time()
+        assert all(retriever.retrieve_many(urls))
+
+        # 两个网站并行, 各自的请求间隔0.2秒, 同一网站同时只有一个请求
+        assert time.time() - t0 < 1.2
+        for site in ('www.a.com', 'b.org'):
+            starts = sorted(start for url, start, _ in server.timeline if site in url)
+            assert len(starts) == 4
+            # 服务端记录的开始时间包括建立连接的时间, 第一个请求可能晚到几十毫秒
+            assert all(b - a >= 0.15 for a, b in zip(starts, starts[1:]))
+
+        a_starts = [start for url, start, _ in server.timeline if 'a.com' in url]
+        b_starts = [start for url, start, _ in server.timeline if 'b.org' in url]
+        assert abs(min(a_starts) - min(b_starts)) < 0.1
+
+def test_sync_crawl_reuses_connection_and_retries():
+    with linkseek_stub.StubServer(latency=0, fail_first=2, fail_status=503) as server:
+        _use_stub(server)
+        linkseek.reset_stats()
+        for i in range(10):
+            final_url, metadata, raw = linkseek.crawl(f'https://example.com/{i}', formats=['markdown'])
+            assert final_url == f'https://example.com/{i}'
+
+        # 前两个请求返回503后重试成功
+        assert server.counts['requests'] == 12 and server.counts[503] == 2
+        stats = linkseek.get_stats()
+        assert stats['requests'] == 12 and stats['retries'] == 2
+        assert stats['connections'] == server.connections == 1
+
+def test_async_crawl_retries():
+    with linkseek_stub.StubServer(latency=0, fail_first=1) as server:
+        _use_stub(server)
+        linkseek.reset_stats()
+        retriever = c4ai.Crawl4AI(num_workers=1)
+        assert retriever.retrieve('https://example.com/a')
+        assert linkseek.get_stats()['retries'] == 1
+
+if __name__ == '__main__':
+    for name, func in list(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print(f'{name}: OK')
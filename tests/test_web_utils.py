@@ -0,0 +1,138 @@
+"""
+web.utils中链接扫描的差分测试: 新的实现与原来逐字符扫描的实现结果必须完全相同.
+语料为随机生成的文本, 加上STORAGE_BASE_DIR下web_cache中缓存的页面 (如果有).
+以及web.boilerplate的行频率模型和web.canonical的URL规范化.
+
+    python tests/test_web_utils.py
+    python -m pytest tests/test_web_utils.py
+"""
+
+import os
+import random
+import tempfile
+
+from chat_with_llm import config
+from chat_with_llm.web import boilerplate
+from chat_with_llm.web import canonical
+from chat_with_llm.web import utils as web_utils
+
+CASES = [
+    '',
+    'no links here',
+    '[text](https://a.com)',
+    '* [Home](/) | [News](/news) | [About](/about)',
+    'see [the docs](https://a.com/x_(y)) for details',
+    '[a] b (c)',
+    '[a [nested] b](url) tail',
+    '[a](url [b](c) d)',
+    '[unclosed](url',
+    '](x) [a]((b)) [c]',
+    '![img](https://a.com/i.png) caption [[–]](javascript:void\\(0\\))',
+    '[a](b)\n[c](d)\ntext [e](f) text\n\n',
+    'x' * 50 + ' [y](z)',
+]
+
+def _random_text(rng, n):
+    alphabet = ['[', ']', '(', ')', 'a', 'b', ' ', 'https://x.com/p', '\n', '中文', '[t](u)', '[t](u(v))']
+    return ''.join(rng.choice(alphabet) for _ in range(n))
+
+def _cached_pages(limit=200):
+    try:
+        base = os.path.join(config.snapshot().storage_base_dir, 'web_cache')
+    except Exception:
+        return []
+
+    pages = []
+    for root, _, files in os.walk(base):
+        for name in files:
+            if name.endswith('.raw'):
+                with open(os.path.join(root, name), encoding='utf-8', errors='replace') as f:
+                    pages.append(f.read())
+                if len(pages) >= limit:
+                    return pages
+
+    return pages
+
+def _corpus():
+    rng = random.Random(1)
+    return CASES + [_random_text(rng, rng.randint(0, 200)) for _ in range(2000)] + _cached_pages()
+
+def test_extract_links_same_as_charwise():
+    for doc in _corpus():
+        assert web_utils.extract_links_from_markdown(doc) == web_utils._extract_links_from_markdown_charwise(doc), doc
+        for line in doc.split('\n'):
+            assert web_utils.extract_links_from_markdown(line) == \
+                web_utils._extract_links_from_markdown_charwise(line), line
+
+def test_strip_boilerplate_same_as_by_line():
+    for doc in _corpus():
+        assert web_utils.strip_boilerplate(doc) == web_utils._strip_boilerplate_by_line(doc), doc
+
+    assert web_utils.strip_boilerplate('[Home](/) [News](/news)\nread [more](/m) here') == 'read more here'
+
+def test_line_model_decay():
+    model = boilerplate.LineModel(os.path.join(tempfile.mkdtemp(), 'boilerplate.db'), threshold=3, half_life=10)
+    nav = 'Home | Markets | Tech\nSubscribe to our newsletter'
+    for i in range(3):
+        assert model.add_page(f'https://www.a.com/{i}', f'{nav}\n\narticle {i}\n', now=100)
+    # 同一URL只统计一次
+    assert not model.add_page('https://www.a.com/0', nav, now=100)
+
+    # 样板只属于a.com; 只有一篇文章时也能去掉
+    assert model.strip('https://news.a.com/new', f'{nav}\n\n\n\nnew article\n', now=100) == '\n\nnew article\n'
+    assert model.strip('https://b.com/x', nav, now=100) == nav
+
+    # 一个半衰期后页面数衰减为1.5, 不再是样板
+    assert model.boilerplate_hashes('a.com', now=100) == {boilerplate.line_hash(l) for l in nav.split('\n')}
+    assert model.boilerplate_hashes('a.com', now=110) == frozenset()
+
+def test_line_model_threshold():
+    # 脚本的--boilerplate_threshold传给get_line_model; 不同threshold共享同一个数据库
+    os.environ['STORAGE_BASE_DIR'] = tempfile.mkdtemp()
+    config.reload()
+    strict, loose = boilerplate.get_line_model(threshold=3), boilerplate.get_line_model(threshold=2)
+    assert (strict.threshold, loose.threshold) == (3, 2)
+    assert strict.db_path == loose.db_path
+    assert boilerplate.get_line_model(threshold=2) is loose
+
+    nav = 'Home | Markets | Tech'
+    for i in range(2):
+        strict.add_page(f'https://www.a.com/{i}', f'{nav}\n\narticle {i}\n')
+    assert strict.strip('https://www.a.com/new', nav) == nav
+    assert loose.strip('https://www.a.com/new', nav) == ''
+
+def test_canonicalize_url():
+    canonical_url = 'https://example.com/a/b?id=1&page=2'
+    for url in [
+        'https://example.com/a/b?id=1&page=2',
+        'http://EXAMPLE.com:80/a/b/?page=2&id=1#comments',
+        'https://example.com/a/b?utm_source=x&id=1&utm_medium=y&page=2&fbclid=z',
+        'https://example.com./a/b?page=2&id=1&gclid=1',
+    ]:
+        assert canonical.canonicalize_url(url) == canonical_url, url
+
+    assert canonical.canonicalize_url('https://example.com') == 'https://example.com/'
+    assert canonical.canonicalize_url('https://example.com:8080/?a=1&ref=x', strip_params=['ref']) == \
+        'https://example.com:8080/?a=1'
+    assert canonical.canonicalize_url('https://m.example.com/a', host_aliases=True) == 'https://example.com/a'
+    assert canonical.canonicalize_url('https://www.co.uk/a', host_aliases=True) == 'https://www.co.uk/a'
+
+def test_public_suffix_trie():
+    trie = canonical.PublicSuffixTrie(['// comment', 'com', 'uk', 'co.uk', '*.ck', '!www.ck', 'github.io'])
+    assert trie.registered_domain('a.b.example.com') == 'example.com'
+    assert trie.registered_domain('news.bbc.co.uk') == 'bbc.co.uk'
+    assert trie.registered_domain('a.b.ck') == 'a.b.ck'
+    assert trie.registered_domain('x.www.ck') == 'www.ck'
+    assert trie.registered_domain('user.github.io') == 'user.github.io'
+    assert trie.registered_domain('a.example.unknown') == 'example.unknown'
+    assert trie.registered_domain('co.uk') == 'co.uk' and trie.registered_domain('127.0.0.1') == '127.0.0.1'
+
+    assert web_utils.url_to_site('https://old.reddit.com/r/x') == 'reddit.com'
+    assert web_utils.url_to_site('http://www.sina.com.cn/') == 'sina.com.cn'
+    assert web_utils.url_to_site('https://www.me.com/') == 'me.com'
+
+if __name__ == '__main__':
+    for name, func in list(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print(f'{name}: OK')